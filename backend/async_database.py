@@ -0,0 +1,162 @@
+"""Async variants of the database functions, used when PONY_DB_MODE=async.
+
+The queries are shared with `backend.database`; only their execution
+differs. An AsyncSession cannot lazy load, so every function eagerly loads
+whatever its callers serialize.
+"""
+from datetime import datetime
+from typing import Optional, Sequence
+
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from backend import database as db
+from backend import events
+from backend.instrumentation import instrument_engine
+from backend.entities import (
+    ChatInDB,
+    CreateMessage,
+    MessageInDB,
+    UserChatLinkInDB,
+    UserInDB,
+)
+
+_engine: Optional[AsyncEngine] = None
+
+
+def get_async_engine() -> AsyncEngine:
+    """Get the async engine, creating it on first use."""
+    global _engine
+    if _engine is None:
+        _engine = create_async_engine(
+            f"sqlite+aiosqlite:///{db.database_path}",
+            pool_size=db.pool_size,
+            max_overflow=db.pool_overflow,
+            echo=db.echo,
+        )
+        db.apply_sqlite_profile(_engine.sync_engine)
+        instrument_engine(_engine.sync_engine)
+    return _engine
+
+
+async def dispose_async_engine():
+    global _engine
+    if _engine is not None:
+        await _engine.dispose()
+        _engine = None
+
+
+async def get_async_session():
+    # nothing is lazy loaded after a commit, so nothing needs expiring
+    async with AsyncSession(get_async_engine(), expire_on_commit=False) as session:
+        yield session
+
+
+async def get_cached_user(session: AsyncSession, user_id: int) -> Optional[UserInDB]:
+    """See `database.get_cached_user`; shares its cache."""
+    snapshot = db.user_cache.get(user_id)
+    if snapshot is None:
+        user = await session.get(UserInDB, user_id)
+        if user is not None:
+            db.user_cache.set(user_id, user.model_dump())
+        return user
+    return await session.merge(db.user_from_snapshot(snapshot), load=False)
+
+
+async def get_user_chats(session: AsyncSession, user_id: int) -> Sequence[ChatInDB]:
+    """See `database.get_user_chats`."""
+    return (await session.exec(db.user_chats_query(user_id))).all()
+
+
+async def get_user_chats_with_reads(
+    session: AsyncSession,
+    user_id: int,
+    order: str = "name",
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+) -> tuple[list[tuple[ChatInDB, UserChatLinkInDB]], Optional[str]]:
+    """See `database.get_user_chats_with_reads`."""
+    query = db.user_chats_with_reads_query(user_id, order, cursor, limit)
+    rows = [tuple(row) for row in (await session.exec(query)).all()]
+    return db.page_of_chats(rows, order, limit)
+
+
+async def is_chat_member(session: AsyncSession, chat_id: int, user_id: int) -> bool:
+    """See `database.is_chat_member`; shares its cache."""
+    key = (user_id, chat_id)
+    member = db.membership_cache.get(key)
+    if member is None:
+        member = await session.scalar(db.membership_query(chat_id, user_id))
+        db.membership_cache.set(key, member)
+    return member
+
+
+async def get_chat_by_id(session: AsyncSession, chat_id: int) -> ChatInDB:
+    """See `database.get_chat_by_id`."""
+    chat = (await session.exec(select(ChatInDB).where(ChatInDB.id == chat_id))).first()
+    if chat is None:
+        raise KeyError
+    return chat
+
+
+async def get_chat_version(session: AsyncSession, chat_id: int) -> int:
+    """See `database.get_chat_version`."""
+    version = await session.scalar(db.chat_version_query(chat_id))
+    if version is None:
+        raise KeyError
+    return version
+
+
+async def get_user_chats_version(session: AsyncSession, user_id: int) -> list[tuple[int, int, int]]:
+    """See `database.get_user_chats_version`."""
+    return [tuple(row) for row in (await session.exec(db.user_chats_version_query(user_id))).all()]
+
+
+async def get_chat_for_response(
+    session: AsyncSession,
+    chat_id: int,
+    include_messages: bool,
+    include_users: bool,
+) -> ChatInDB:
+    """See `database.get_chat_for_response`."""
+    query = db.chat_for_response_query(chat_id, include_messages, include_users)
+    chat = (await session.exec(query)).first()
+    if chat is None:
+        raise KeyError
+    return chat
+
+
+async def get_chat_messages(
+    session: AsyncSession,
+    chat_id: int,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = 50,
+) -> tuple[list[MessageInDB], bool]:
+    """See `database.get_chat_messages`."""
+    query, newest_first = db.chat_messages_query(chat_id, before, after, limit)
+    msgs = list((await session.exec(query)).all())
+    return db.page_of(msgs, limit, newest_first)
+
+
+async def create_message(session: AsyncSession, chat_id: int, message: CreateMessage, user: UserInDB) -> MessageInDB:
+    """See `database.create_message`."""
+    chat = await session.get(ChatInDB, chat_id)
+    if chat is None:
+        raise KeyError
+    joined = not await is_chat_member(session, chat_id, user.id)
+    msg = MessageInDB(id=db.id_generator.next_id(), text=message.text, user_id=user.id, chat_id=chat_id, created_at=datetime.now(), user=user)
+    session.add(msg)
+    if joined:
+        session.add(UserChatLinkInDB(user_id=user.id, chat_id=chat_id))
+    # assigns the id when the database picks it, which the UPDATEs need
+    await session.flush()
+    await session.exec(db.chat_counters_update(chat_id, messages=1, users=int(joined), last_message_at=msg.created_at, last_message_id=msg.id))
+    await session.exec(db.read_cursor_update(chat_id, user.id, msg.id, msg.created_at))
+    await session.commit()
+
+    if joined:
+        db.membership_cache.pop((user.id, chat_id))
+    events.hub.publish(db.message_event("message_created", msg))
+    return msg
@@ -1,33 +1,43 @@
-import os
-from datetime import datetime, timezone
+import hashlib
+import secrets
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Optional
 # from typing import Annotated
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.requests import HTTPConnection
 from fastapi.security import (
     OAuth2PasswordBearer,
     OAuth2PasswordRequestForm,
 )
 from jose import ExpiredSignatureError, JWTError, jwt
-from passlib.context import CryptContext
 from pydantic import BaseModel, ValidationError
-from sqlmodel import Session, SQLModel, select
+from sqlalchemy import func, literal_column, update
+from starlette.concurrency import run_in_threadpool
+from sqlmodel import Session, SQLModel, delete, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
+from backend import async_database as adb
 from backend import database as db
-from backend.entities import User, UserInDB
+from backend.cache import TTLCache
+from backend.config import env
+from backend.entities import RefreshTokenInDB, RevokedTokenInDB, User, UserInDB
+from backend.passwords import hash_password, login_throttle, verify_password
+from backend.revocation import RevocationList, RevocationPoller
 
-try:
-    env_file = open(".env", "r")
-    for line in env_file.readlines():
-        key, value = line.split("=")
-        os.environ[key] = value
-except FileNotFoundError:
-    pass
-
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 access_token_duration = 3600  # seconds
+refresh_token_duration = int(env("PONY_REFRESH_TOKEN_DURATION", str(30 * 24 * 3600)))  # seconds
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/token")
-jwt_key = os.environ.get("JWT_KEY", default="insecure-jwt-key-for-dev")
+jwt_key = env("JWT_KEY", "insecure-jwt-key-for-dev")
 jwt_alg = "HS256"
+claims_cache = TTLCache(maxsize=10_000, ttl=access_token_duration)
+# consulted on every request; revocations made by other processes are
+# picked up within this many seconds (0 turns polling off, for a single
+# process)
+revocation_poll_interval = float(env("PONY_REVOCATION_POLL_INTERVAL", "1"))
+revocation_list = RevocationList()
 
 auth_router = APIRouter(prefix="/auth", tags=["Authentication"])
 
@@ -46,6 +56,13 @@ class AccessToken(BaseModel):
     access_token: str
     token_type: str
     expires_in: int
+    refresh_token: Optional[str] = None
+
+
+class RefreshRequest(BaseModel):
+    """Request model to exchange a refresh token."""
+
+    refresh_token: str
 
 
 class Claims(BaseModel):
@@ -53,6 +70,9 @@ class Claims(BaseModel):
 
     sub: str  # id of user
     exp: int  # unix timestamp
+    # id of token, used to revoke it; tokens issued before ids were added
+    # have none and stay valid until they expire
+    jti: Optional[str] = None
 
 
 class AuthException(HTTPException):
@@ -90,28 +110,79 @@ class ExpiredToken(AuthException):
         )
 
 
+class RevokedToken(AuthException):
+    def __init__(self):
+        super().__init__(
+            error="invalid_client",
+            description="revoked access token",
+        )
+
+
+class InvalidRefreshToken(AuthException):
+    def __init__(self):
+        super().__init__(
+            error="invalid_grant",
+            description="invalid refresh token",
+        )
+
+
 def get_current_user(
-    session: Session = Depends(db.get_session),
+    session: Session = Depends(db.get_read_session),
     token: str = Depends(oauth2_scheme),
 ) -> UserInDB:
-    """FastAPI dependency to get current user from bearer token."""
+    """FastAPI dependency to get current user from bearer token.
+
+    The user is loaded through the read pool and returned detached, so that
+    routes that write can attach it to their own session.
+    """
     user = _decode_access_token(session, token)
+    session.expunge(user)
+    return user
+
+
+async def get_current_user_async(
+    session: AsyncSession = Depends(adb.get_async_session),
+    token: str = Depends(oauth2_scheme),
+) -> UserInDB:
+    """FastAPI dependency to get current user from bearer token over an async session."""
+    user = await adb.get_cached_user(session, int(_verified_claims(token).sub))
+    if user is None:
+        raise InvalidToken()
     return user
 
 
+def get_connection_user(session: Session, connection: HTTPConnection) -> UserInDB:
+    """Get the user of a WebSocket or event-stream connection.
+
+    Browsers cannot set headers on WebSocket and EventSource connections, so
+    the bearer token may also be passed as the `access_token` query parameter.
+    """
+    scheme, _, token = connection.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        token = connection.query_params.get("access_token")
+    if not token:
+        raise InvalidToken()
+    return _decode_access_token(session, token)
+
+
 @auth_router.post("/registration", status_code=201)
-def register_new_user(
+async def register_new_user(
     registration: UserRegistration,
     session: Session = Depends(db.get_session),
     # session: Annotated[Session, Depends(db.get_session)],
 ):
     """Register new user."""
 
-    hashed_password = pwd_context.hash(registration.password)
+    hashed_password = await hash_password(registration.password)
     user = UserInDB(
         **registration.model_dump(),
         hashed_password=hashed_password,
     )
+    await run_in_threadpool(_add_new_user, session, user)
+    return {"user": User.from_db(user)}
+
+
+def _add_new_user(session: Session, user: UserInDB):
     session.add(user)
     try:
         session.commit()
@@ -133,38 +204,191 @@ def register_new_user(
                 # }
             }
         )
+    db.invalidate_user_count()
     session.refresh(user)
-    return {"user": User.from_db(user)}
 
 
 @auth_router.post("/token", response_model=AccessToken)
-def get_access_token(
+async def get_access_token(
+    request: Request,
     form: OAuth2PasswordRequestForm = Depends(),
     session: Session = Depends(db.get_session),
 ):
     """Get access token for user."""
 
-    user = _get_authenticated_user(session, form)
-    return _build_access_token(user)
+    address = request.client.host if request.client is not None else ""
+    user = await _get_authenticated_user(session, form, address)
+    return await run_in_threadpool(_issue_tokens, session, user)
+
+
+@auth_router.post("/refresh", response_model=AccessToken)
+def refresh_access_token(
+    request: RefreshRequest,
+    session: Session = Depends(db.get_session),
+):
+    """Exchange a refresh token for new access and refresh tokens."""
+
+    stored = session.exec(
+        select(RefreshTokenInDB).where(
+            RefreshTokenInDB.token_hash == _hash_refresh_token(request.refresh_token)
+        )
+    ).first()
+    if stored is None or stored.expires_at <= datetime.now():
+        raise InvalidRefreshToken()
+
+    # only one of two concurrent refreshes with the same token gets through
+    rotated = session.exec(
+        update(RefreshTokenInDB)
+        .where(RefreshTokenInDB.id == stored.id, RefreshTokenInDB.used == False)  # noqa: E712
+        .values(used=True)
+    ).rowcount
+    if not rotated:
+        # the token was used before, so someone else has a copy of it
+        _revoke_family(session, stored.family)
+        session.commit()
+        raise InvalidRefreshToken()
+
+    user = db.get_cached_user(session, stored.user_id)
+    if user is None:
+        raise InvalidRefreshToken()
+    return _issue_tokens(session, user, family=stored.family)
 
 
-def _get_authenticated_user(
+@auth_router.post("/logout", status_code=204)
+def logout(
+    session: Session = Depends(db.get_session),
+    token: str = Depends(oauth2_scheme),
+):
+    """Revoke the access token and the refresh tokens issued with it."""
+
+    claims = _verified_claims(token)
+    if claims.jti is None:
+        # issued before tokens had ids, so nothing can be revoked
+        return
+    family = session.exec(
+        select(RefreshTokenInDB.family).where(RefreshTokenInDB.access_jti == claims.jti)
+    ).first()
+    if family is not None:
+        _revoke_family(session, family)
+    _revoke_access_token(session, claims.jti, claims.exp)
+    session.commit()
+
+
+def load_revocation_list():
+    """Fill the revocation list from the database, dropping expired entries."""
+    with Session(db.engine) as session:
+        # the newest row is kept so rowids never go back, which
+        # `refresh_revocation_list` relies on
+        session.exec(delete(RevokedTokenInDB).where(
+            RevokedTokenInDB.expires_at <= int(time.time()),
+            literal_column("rowid") < select(func.max(literal_column("rowid"))).select_from(RevokedTokenInDB).scalar_subquery(),
+        ))
+        session.exec(delete(RefreshTokenInDB).where(RefreshTokenInDB.expires_at <= datetime.now()))
+        session.commit()
+        last_seen = session.exec(select(func.coalesce(func.max(literal_column("rowid")), 0)).select_from(RevokedTokenInDB)).one()
+        revocation_list.load(
+            session.exec(select(RevokedTokenInDB.jti, RevokedTokenInDB.expires_at)).all(),
+            last_seen,
+        )
+
+
+def refresh_revocation_list(session: Session):
+    """Add the tokens revoked by any process since the list was last refreshed."""
+    revocation_list.catch_up(session.exec(
+        select(literal_column("rowid"), RevokedTokenInDB.jti, RevokedTokenInDB.expires_at)
+        .where(literal_column("rowid") > revocation_list.last_seen)
+        .order_by(literal_column("rowid"))
+    ).all())
+
+
+def _poll_revocations():
+    with Session(db.read_engine) as session:
+        refresh_revocation_list(session)
+
+
+revocation_poller = RevocationPoller(_poll_revocations, revocation_poll_interval)
+
+
+async def _get_authenticated_user(
     session: Session,
     form: OAuth2PasswordRequestForm,
+    address: str,
 ) -> UserInDB:
-    user = session.exec(
-        select(UserInDB).where(UserInDB.username == form.username)
-    ).first()
+    login_throttle.check(form.username, address)
+    user = await run_in_threadpool(
+        lambda: session.exec(
+            select(UserInDB).where(UserInDB.username == form.username)
+        ).first()
+    )
 
-    if user is None or not pwd_context.verify(form.password, user.hashed_password):
+    if user is None:
+        login_throttle.failed(form.username, address)
+        raise InvalidCredentials()
+    valid, new_hash = await verify_password(form.password, user.hashed_password)
+    if not valid:
+        login_throttle.failed(form.username, address)
         raise InvalidCredentials()
 
+    login_throttle.succeeded(form.username, address)
+    if new_hash is not None:
+        # the stored hash used fewer rounds than currently configured
+        await run_in_threadpool(_store_password_hash, session, user, new_hash)
     return user
 
 
-def _build_access_token(user: UserInDB) -> AccessToken:
+def _store_password_hash(session: Session, user: UserInDB, hashed_password: str):
+    user.hashed_password = hashed_password
+    session.commit()
+    session.refresh(user)
+    db.invalidate_user(user.id)
+
+
+def _issue_tokens(
+    session: Session,
+    user: UserInDB,
+    family: Optional[str] = None,
+) -> AccessToken:
+    jti = uuid.uuid4().hex
+    token = _build_access_token(user, jti)
+    refresh_token = secrets.token_urlsafe(32)
+    session.add(
+        RefreshTokenInDB(
+            token_hash=_hash_refresh_token(refresh_token),
+            family=family or uuid.uuid4().hex,
+            user_id=user.id,
+            access_jti=jti,
+            expires_at=datetime.now() + timedelta(seconds=refresh_token_duration),
+        )
+    )
+    session.commit()
+    token.refresh_token = refresh_token
+    return token
+
+
+def _hash_refresh_token(refresh_token: str) -> str:
+    # refresh tokens are random, so a fast hash is as good as bcrypt here
+    return hashlib.sha256(refresh_token.encode()).hexdigest()
+
+
+def _revoke_family(session: Session, family: str):
+    access_jtis = session.exec(
+        select(RefreshTokenInDB.access_jti).where(RefreshTokenInDB.family == family)
+    ).all()
+    # the access tokens' exact expiry is unknown, but none outlives this
+    expires_at = int(time.time()) + access_token_duration
+    for jti in access_jtis:
+        _revoke_access_token(session, jti, expires_at)
+    session.exec(delete(RefreshTokenInDB).where(RefreshTokenInDB.family == family))
+
+
+def _revoke_access_token(session: Session, jti: str, expires_at: int):
+    session.merge(RevokedTokenInDB(jti=jti, expires_at=expires_at))
+    revocation_list.add(jti, expires_at)
+
+
+def _build_access_token(user: UserInDB, jti: Optional[str] = None) -> AccessToken:
     expiration = int(datetime.now(timezone.utc).timestamp()) + access_token_duration
-    claims = Claims(sub=str(user.id), exp=expiration)
+    claims = Claims(sub=str(user.id), exp=expiration, jti=jti or uuid.uuid4().hex)
     access_token = jwt.encode(claims.model_dump(), key=jwt_key, algorithm=jwt_alg)
 
     return AccessToken(
@@ -175,19 +399,37 @@ def _build_access_token(user: UserInDB) -> AccessToken:
 
 
 def _decode_access_token(session: Session, token: str) -> UserInDB:
+    user = db.get_cached_user(session, int(_verified_claims(token).sub))
+    if user is None:
+        raise InvalidToken()
+    return user
+
+
+def _verified_claims(token: str) -> Claims:
+    claims = _decode_claims(token)
+    # checked on every use, since a token can be revoked after its claims
+    # were cached
+    if claims.jti is not None and claims.jti in revocation_list:
+        raise RevokedToken()
+    return claims
+
+
+def _decode_claims(token: str) -> Claims:
+    # verified claims are reused until the token expires
+    claims = claims_cache.get(token)
+    if claims is not None:
+        return claims
     try:
         claims_dict = jwt.decode(token, key=jwt_key, algorithms=[jwt_alg])
         claims = Claims(**claims_dict)
-        user_id = claims.sub
-        user = session.get(UserInDB, user_id)
-
-        if user is None:
-            raise InvalidToken()
-
-        return user
     except ExpiredSignatureError:
         raise ExpiredToken()
     except JWTError:
         raise InvalidToken()
     except ValidationError:
         raise InvalidToken()
+
+    lifetime = claims.exp - datetime.now(timezone.utc).timestamp()
+    if lifetime > 0:
+        claims_cache.set(token, claims, ttl=min(lifetime, claims_cache.ttl))
+    return claims
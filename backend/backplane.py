@@ -0,0 +1,301 @@
+import logging
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Callable, Optional
+
+from backend.config import env
+from backend.entities import ChatEvent
+
+logger = logging.getLogger(__name__)
+
+
+class Backplane(ABC):
+    """Carries chat events between the processes serving the API.
+
+    Every published event gets a sequence number that increases by one per
+    chat, so subscribers can detect gaps and resume after the last event
+    they saw. Events are handed to the `deliver` callback of every process,
+    including the one that published them.
+    """
+
+    def __init__(self):
+        self.deliver: Callable[[ChatEvent], None] = lambda event: None
+
+    def start(self):
+        """Start any background machinery."""
+
+    def stop(self):
+        """Stop any background machinery, flushing pending events."""
+
+    @abstractmethod
+    def publish(self, event: ChatEvent):
+        """
+        Send an event to every process, assigning its sequence number.
+
+        :param event: the event to be published
+        """
+
+    @abstractmethod
+    def replay(self, chat_id: int, since: int) -> Optional[list[ChatEvent]]:
+        """
+        Retrieve the events of a chat published after a sequence number.
+
+        :param chat_id: id of the chat to be replayed
+        :param since: the last sequence number the subscriber saw
+        :return: the missed events in order, or None when some of them are
+            no longer retained
+        """
+
+
+class InMemoryBackplane(Backplane):
+    """Backplane for a single process; keeps a short history per chat."""
+
+    def __init__(self, history_size: int = 1000):
+        super().__init__()
+        self.history_size = history_size
+        self._lock = threading.Lock()
+        self._history: dict[int, deque[ChatEvent]] = {}
+        self._last_seq: dict[int, int] = {}
+
+    def publish(self, event: ChatEvent):
+        with self._lock:
+            seq = self._last_seq.get(event.chat_id, 0) + 1
+            self._last_seq[event.chat_id] = seq
+            event = event.model_copy(update={"seq": seq})
+            history = self._history.setdefault(event.chat_id, deque(maxlen=self.history_size))
+            history.append(event)
+        self.deliver(event)
+
+    def replay(self, chat_id: int, since: int) -> Optional[list[ChatEvent]]:
+        with self._lock:
+            history = list(self._history.get(chat_id, ()))
+            last_seq = self._last_seq.get(chat_id, 0)
+        if since > last_seq:
+            # the subscriber saw events from before a restart
+            return None
+        if since == last_seq:
+            return []
+        missed = [event for event in history if event.seq > since]
+        if not missed or missed[0].seq != since + 1:
+            return None
+        return missed
+
+
+class SqliteBackplane(Backplane):
+    """Backplane shared by the processes of one host through a SQLite file.
+
+    Published events are buffered and written in batches by a background
+    thread, which also polls the table by id for events written by any
+    process and delivers them locally. Old events are pruned after
+    `retention` seconds.
+
+    When the file cannot be written, for instance because it stays locked
+    past `timeout`, the thread logs the error and retries after a growing
+    backoff. Meanwhile at most `max_pending` events are buffered; beyond
+    that the oldest ones are dropped.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        poll_interval: float = 0.05,
+        batch_size: int = 500,
+        retention: float = 600,
+        max_pending: int = 10_000,
+        timeout: float = 5,
+        max_backoff: float = 5,
+    ):
+        super().__init__()
+        self.path = path
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.retention = retention
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        self._pending: list[ChatEvent] = []
+        self._pending_lock = threading.Lock()
+        # events dropped since the last successful flush
+        self._dropped = 0
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._last_id = 0
+
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS chat_events ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " chat_id INTEGER NOT NULL,"
+                " seq INTEGER NOT NULL,"
+                " published_at REAL NOT NULL,"
+                " payload TEXT NOT NULL)"
+            )
+            conn.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS ix_chat_events_chat_id_seq"
+                " ON chat_events (chat_id, seq)"
+            )
+        finally:
+            conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        conn = self._connect()
+        try:
+            # only events published from now on are delivered live
+            self._last_id = conn.execute("SELECT MAX(id) FROM chat_events").fetchone()[0] or 0
+        finally:
+            conn.close()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="sqlite-backplane", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+
+    def publish(self, event: ChatEvent):
+        with self._pending_lock:
+            self._pending.append(event)
+            self._trim_pending()
+
+    def _trim_pending(self):
+        # called with _pending_lock held
+        excess = len(self._pending) - self.max_pending
+        if excess <= 0:
+            return
+        del self._pending[:excess]
+        if not self._dropped:
+            logger.warning("backplane is not keeping up, dropping the oldest pending events")
+        self._dropped += excess
+
+    def replay(self, chat_id: int, since: int) -> Optional[list[ChatEvent]]:
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT seq, payload FROM chat_events WHERE chat_id = ? AND seq > ? ORDER BY seq",
+                (chat_id, since),
+            ).fetchall()
+            if rows and rows[0][0] != since + 1:
+                return None
+            if not rows:
+                last = conn.execute("SELECT MAX(seq) FROM chat_events WHERE chat_id = ?", (chat_id,)).fetchone()[0]
+                if last is not None and last < since:
+                    # the subscriber is ahead of us; treat it as a gap
+                    return None
+        finally:
+            conn.close()
+        return [ChatEvent.model_validate_json(payload) for _, payload in rows]
+
+    def _run(self):
+        conn = self._connect()
+        last_prune = 0.0
+        backoff = self.poll_interval
+        try:
+            while True:
+                stopping = self._stopped.is_set()
+                try:
+                    self._flush(conn)
+                    self._poll(conn)
+                    if not stopping and time.monotonic() - last_prune > self.retention / 10:
+                        self._prune(conn)
+                        last_prune = time.monotonic()
+                except sqlite3.Error:
+                    if stopping:
+                        logger.exception("backplane stopped with undelivered events")
+                        return
+                    logger.exception("backplane failed, retrying in %.2f s", backoff)
+                    self._stopped.wait(backoff)
+                    backoff = min(backoff * 2, self.max_backoff)
+                    continue
+                if stopping:
+                    return
+                backoff = self.poll_interval
+                self._stopped.wait(self.poll_interval)
+        finally:
+            conn.close()
+
+    def _prune(self, conn: sqlite3.Connection):
+        # the newest event of each chat is kept so its sequence numbers
+        # never restart
+        conn.execute(
+            "DELETE FROM chat_events WHERE published_at < ? AND seq < "
+            "(SELECT MAX(seq) FROM chat_events AS newest WHERE newest.chat_id = chat_events.chat_id)",
+            (time.time() - self.retention,),
+        )
+
+    def _flush(self, conn: sqlite3.Connection):
+        with self._pending_lock:
+            pending, self._pending = self._pending, []
+        for start in range(0, len(pending), self.batch_size):
+            try:
+                self._write(conn, pending[start:start + self.batch_size])
+            except sqlite3.Error:
+                with self._pending_lock:
+                    # back in front of what was published since, to be retried
+                    self._pending[:0] = pending[start:]
+                    self._trim_pending()
+                raise
+        if pending:
+            with self._pending_lock:
+                if self._dropped:
+                    logger.warning("backplane recovered after dropping %d events", self._dropped)
+                    self._dropped = 0
+
+    def _write(self, conn: sqlite3.Connection, batch: list[ChatEvent]):
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            last_seq = {}
+            for chat_id in {event.chat_id for event in batch}:
+                row = conn.execute("SELECT MAX(seq) FROM chat_events WHERE chat_id = ?", (chat_id,)).fetchone()
+                last_seq[chat_id] = row[0] or 0
+            rows = []
+            now = time.time()
+            for event in batch:
+                last_seq[event.chat_id] += 1
+                event = event.model_copy(update={"seq": last_seq[event.chat_id]})
+                rows.append((event.chat_id, event.seq, now, event.model_dump_json()))
+            conn.executemany(
+                "INSERT INTO chat_events (chat_id, seq, published_at, payload) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+
+    def _poll(self, conn: sqlite3.Connection):
+        while True:
+            rows = conn.execute(
+                "SELECT id, payload FROM chat_events WHERE id > ? ORDER BY id LIMIT ?",
+                (self._last_id, self.batch_size),
+            ).fetchall()
+            for event_id, payload in rows:
+                self._last_id = event_id
+                self.deliver(ChatEvent.model_validate_json(payload))
+            if len(rows) < self.batch_size:
+                return
+
+
+def backplane_from_env() -> Backplane:
+    """Build the backplane selected by the PONY_BACKPLANE environment variable."""
+
+    kind = env("PONY_BACKPLANE", "memory")
+    if kind == "memory":
+        return InMemoryBackplane()
+    if kind == "sqlite":
+        path = env("PONY_BACKPLANE_PATH", "backend/pony_express_events.db")
+        return SqliteBackplane(path)
+    raise ValueError(f"unknown backplane: {kind}")
@@ -0,0 +1,28 @@
+"""Maintenance commands, run as `python -m backend.commands <command>`."""
+import argparse
+
+from sqlmodel import Session
+
+from backend import database as db
+
+
+def reconcile_counters():
+    """Rebuild the message and user counters of every chat."""
+    with Session(db.engine) as session:
+        db.reconcile_chat_counters(session)
+
+
+commands = {
+    "reconcile-counters": reconcile_counters,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("command", choices=commands)
+    args = parser.parse_args()
+    commands[args.command]()
+
+
+if __name__ == "__main__":
+    main()
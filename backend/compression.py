@@ -0,0 +1,170 @@
+"""Response compression negotiated through Accept-Encoding.
+
+gzip is always available; brotli and zstd are offered when the `brotli` and
+`zstandard` packages are installed (the `compression` extra). Responses are
+compressed as they are sent, so streamed exports stay streamed.
+"""
+import zlib
+from typing import Callable, Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from backend.config import env
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - optional dependency
+    brotli = None
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional dependency
+    zstandard = None
+
+# comma separated, most preferred first; unavailable encodings are skipped
+compression_encodings = env("PONY_COMPRESSION", "br,zstd,gzip")
+compression_min_size = int(env("PONY_COMPRESSION_MIN_SIZE", "1024"))  # bytes
+compression_level = int(env("PONY_COMPRESSION_LEVEL", "5"))  # 1 (fast) to 9 (small)
+# events have to reach clients as soon as they are sent, and everything
+# else is either small or already compressed
+compressible_types = ("application/json", "application/x-ndjson", "text/plain", "text/html")
+
+
+class _BrotliCompressor:
+    def __init__(self, level: int):
+        # brotli qualities go up to 11, its default, which is far too slow
+        # for responses
+        self._compressor = brotli.Compressor(quality=min(level, 11))
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.finish()
+
+
+def _gzip(level: int):
+    return zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+
+
+def _zstd(level: int):
+    return zstandard.ZstdCompressor(level=level).compressobj()
+
+
+compressors: dict[str, Callable] = {"gzip": _gzip}
+if brotli is not None:
+    compressors["br"] = _BrotliCompressor
+if zstandard is not None:
+    compressors["zstd"] = _zstd
+
+
+def choose_encoding(accept_encoding: str, preferred: list[str]) -> Optional[str]:
+    """
+    Pick the encoding of a response.
+
+    :param accept_encoding: the Accept-Encoding header of the request
+    :param preferred: the encodings on offer, most preferred first
+    :return: the first encoding on offer that the client accepts, if any
+    """
+
+    accepted = set()
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        params = params.replace(" ", "")
+        if params.startswith("q="):
+            try:
+                if float(params[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name.strip().lower())
+    for encoding in preferred:
+        if encoding in accepted or "*" in accepted:
+            return encoding
+    return None
+
+
+class CompressionMiddleware:
+    """Compresses responses of compressible types above a size threshold."""
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        encodings: str = compression_encodings,
+        minimum_size: int = compression_min_size,
+        level: int = compression_level,
+    ):
+        self.app = app
+        self.encodings = [name.strip() for name in encodings.split(",") if name.strip() in compressors]
+        self.minimum_size = minimum_size
+        self.level = level
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""), self.encodings)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await _CompressingResponder(self, encoding, send).run(self.app, scope, receive)
+
+
+class _CompressingResponder:
+    def __init__(self, middleware: CompressionMiddleware, encoding: str, send: Send):
+        self.middleware = middleware
+        self.encoding = encoding
+        self.send = send
+        self.start: Optional[Message] = None
+        self.compressor = None
+        self.passthrough = False
+
+    async def run(self, app: ASGIApp, scope: Scope, receive: Receive):
+        await app(scope, receive, self.on_send)
+
+    async def on_send(self, message: Message):
+        if message["type"] == "http.response.start":
+            # held back until the first body chunk tells whether it is worth it
+            self.start = message
+            headers = Headers(raw=message["headers"])
+            media_type = headers.get("content-type", "").split(";")[0].strip()
+            self.passthrough = (
+                "content-encoding" in headers
+                or media_type not in compressible_types
+                or message["status"] in (204, 304)
+            )
+            if self.passthrough:
+                await self.send(message)
+            return
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.start is not None:
+            start, self.start = self.start, None
+            if not more_body and len(body) < self.middleware.minimum_size:
+                self.passthrough = True
+                await self.send(start)
+                await self.send(message)
+                return
+            self.compressor = compressors[self.encoding](self.middleware.level)
+            headers = MutableHeaders(raw=start["headers"])
+            headers["Content-Encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+            if more_body:
+                del headers["Content-Length"]
+            else:
+                body = self.compressor.compress(body) + self.compressor.flush()
+                headers["Content-Length"] = str(len(body))
+                await self.send(start)
+                await self.send({"type": "http.response.body", "body": body})
+                return
+            await self.send(start)
+
+        data = self.compressor.compress(body)
+        if not more_body:
+            data += self.compressor.flush()
+        if data or not more_body:
+            await self.send({"type": "http.response.body", "body": data, "more_body": more_body})
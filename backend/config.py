@@ -0,0 +1,14 @@
+import os
+
+try:
+    env_file = open(".env", "r")
+    for line in env_file.readlines():
+        key, value = line.split("=")
+        os.environ[key] = value
+except FileNotFoundError:
+    pass
+
+
+def env(key: str, default: str) -> str:
+    """Read a setting from the environment (or .env file)."""
+    return os.environ.get(key, default).strip()
@@ -1,27 +1,189 @@
+import base64
+import json
 from datetime import datetime
-from random import randint
-from typing import Sequence
-from sqlmodel import Session, SQLModel, create_engine, select, insert, delete
+from typing import Iterator, Optional, Sequence
+from sqlalchemy import Engine, bindparam, case, column, event, exists, func, inspect, literal_column, table, text, update
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.orm import joinedload, make_transient_to_detached, selectinload
+from sqlmodel import Session, SQLModel, and_, create_engine, or_, select, insert, delete
 
+from backend import events
+from backend.cache import TTLCache
+from backend.config import env
+from backend.ids import id_generator_from_env
+from backend.instrumentation import instrument_engine
 from backend.entities import (
+    BulkMessage,
+    BulkMessageResult,
+    ChatEvent,
     ChatInDB,
     CreateMessage,
+    Message,
     MessageInDB,
+    ReadState,
+    RefreshTokenInDB,
     UpdateChat,
     UpdateMessage,
+    UserChatLinkInDB,
+    User,
     UserInDB,
     UserCreate,
 )
 
+database_path = env("PONY_DB_PATH", "backend/pony_express.db")
+# "sync" serves requests from a threadpool, "async" swaps the hottest routes
+# for the aiosqlite-backed ones in `backend.async_database`
+database_mode = env("PONY_DB_MODE", "sync")
+# requests keep their connection until their response is serialized, so the
+# pool has to outgrow the threadpool or sync requests can starve each other
+pool_size = int(env("PONY_DB_POOL_SIZE", "20"))
+pool_overflow = int(env("PONY_DB_POOL_OVERFLOW", "100"))
+
+# PRAGMAs applied to every new connection; each can be overridden with a
+# PONY_SQLITE_<NAME> variable
+sqlite_profiles = {
+    "production": {
+        "journal_mode": "WAL",  # readers no longer wait for the writer
+        "synchronous": "NORMAL",  # WAL stays consistent without a sync per commit
+        "cache_size": "-65536",  # KiB
+        "mmap_size": "268435456",
+        "temp_store": "MEMORY",
+        "busy_timeout": "5000",  # ms
+    },
+    "default": {},
+}
+sqlite_profile = {
+    name: env(f"PONY_SQLITE_{name.upper()}", value)
+    for name, value in sqlite_profiles[env("PONY_SQLITE_PROFILE", "production")].items()
+}
+id_generator = id_generator_from_env()
+echo = env("PONY_DB_ECHO", "false").lower() in ("1", "true", "yes")
+# a bulk import publishes a single resync event for a chat that got more
+# messages than this, instead of one event per message
+bulk_event_limit = 20
+
 engine = create_engine(
-    "sqlite:///backend/pony_express.db",
-    echo=True,
+    f"sqlite:///{database_path}",
+    echo=echo,
     connect_args={"check_same_thread": False},
+    pool_size=pool_size,
+    max_overflow=pool_overflow,
 )
+# read-only requests get their own pool, so they never queue behind
+# connections held by writers
+read_engine = create_engine(
+    f"sqlite:///{database_path}",
+    echo=echo,
+    connect_args={"check_same_thread": False},
+    pool_size=pool_size,
+    max_overflow=pool_overflow,
+)
+
+
+def apply_sqlite_profile(engine: Engine, read_only: bool = False):
+    """
+    Run the PRAGMAs of the configured profile on every new connection of an engine.
+
+    :param read_only: also refuse writes on the engine's connections
+    """
+
+    @event.listens_for(engine, "connect")
+    def _on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in sqlite_profile.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        if read_only:
+            cursor.execute("PRAGMA query_only=ON")
+        cursor.close()
+
+
+instrument_engine(engine)
+instrument_engine(read_engine)
+
+
+# external-content FTS5 index of message texts, kept in sync by triggers so
+# that every way of writing messages is covered
+_search_index_ddl = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(text, content='messages', content_rowid='id')",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF text ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+    END""",
+]
+messages_fts = table("messages_fts", column("rowid"), column("rank"))
+
+
+@event.listens_for(MessageInDB.__table__, "after_create")
+def create_search_index(target, connection, **kw):
+    """Create the full-text index of messages and the triggers that maintain it."""
+    existed = connection.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").first()
+    for statement in _search_index_ddl:
+        connection.exec_driver_sql(statement)
+    if not existed:
+        # index the messages written before the index existed
+        connection.exec_driver_sql("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+
+_app_profile_applied = False
+
+
+def apply_app_profile():
+    """
+    Apply the SQLite profile to the app's engines.
+
+    The profile switches the database file to WAL, so it is applied when the
+    app starts rather than when this module is imported.
+    """
+    global _app_profile_applied
+    if _app_profile_applied:
+        return
+    apply_sqlite_profile(engine)
+    apply_sqlite_profile(read_engine, read_only=True)
+    _app_profile_applied = True
+    # connections opened before now never saw the profile
+    engine.dispose()
+    read_engine.dispose()
 
 
 def create_db_and_tables():
     SQLModel.metadata.create_all(engine)
+    with engine.begin() as connection:
+        create_search_index(MessageInDB.__table__, connection)
+    if _add_missing_columns():
+        with Session(engine) as session:
+            reconcile_chat_counters(session)
+    # create_all skips tables that already exist, so indexes added to an
+    # existing table have to be created on their own
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+
+def _add_missing_columns() -> bool:
+    """
+    Add columns that were added to the models after their table was created.
+
+    :return: whether any column was added
+    """
+
+    inspector = inspect(engine)
+    added = False
+    with engine.begin() as conn:
+        for table in SQLModel.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = CreateColumn(column).compile(dialect=engine.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {ddl}"))
+                added = True
+    return added
 
 
 def get_session():
@@ -29,17 +191,117 @@ def get_session():
         yield session
 
 
+def get_read_session():
+    """Session for requests that only read; writing through it fails."""
+    with Session(read_engine) as session:
+        yield session
+
+
 #   -------- users --------   #
 
 
-def get_all_users(session: Session) -> Sequence[UserInDB]:
+user_cache = TTLCache(maxsize=10_000, ttl=60)
+
+
+user_count_cache = TTLCache(maxsize=1024, ttl=30)
+
+
+def get_users_page(
+    session: Session,
+    username_prefix: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = 50,
+) -> tuple[Sequence[UserInDB], Optional[str]]:
     """
-    Retrieve all users from the database.
+    Retrieve a page of users ordered by id.
 
-    :return: ordered list of users
+    Pages continue from the id in the cursor, so the cost depends on the
+    page size and not on how far the client has paged. A username prefix
+    is matched as a range over the unique index on username.
+
+    :param username_prefix: only return users whose username starts with it
+    :param cursor: cursor from the previous page
+    :param limit: maximum number of users to return
+    :return: the page and the cursor of the next one, if there is one
+    :raises ValueError: if the cursor is malformed
     """
 
-    return session.exec(select(UserInDB)).all()
+    query = select(UserInDB).order_by(UserInDB.id).limit(limit + 1)
+    if username_prefix:
+        query = query.where(*username_prefix_filter(username_prefix))
+    if cursor is not None:
+        query = query.where(UserInDB.id > decode_user_cursor(cursor))
+    users = session.exec(query).all()
+    if len(users) > limit:
+        return users[:limit], encode_user_cursor(users[limit - 1])
+    return users, None
+
+
+def count_users(session: Session, username_prefix: Optional[str] = None) -> int:
+    """
+    Count the users, or those whose username starts with a prefix.
+
+    Counts are cached for a short time and dropped when a user is added or
+    deleted, so they can lag behind only by changes made elsewhere.
+
+    :param username_prefix: only count users whose username starts with it
+    """
+
+    key = username_prefix or ""
+    count = user_count_cache.get(key)
+    if count is None:
+        query = select(func.count()).select_from(UserInDB)
+        if username_prefix:
+            query = query.where(*username_prefix_filter(username_prefix))
+        count = session.scalar(query)
+        user_count_cache.set(key, count)
+    return count
+
+
+def username_prefix_filter(prefix: str) -> list:
+    """
+    Match usernames starting with a prefix as a range, which SQLite can
+    answer from the username index, unlike LIKE with its default case
+    insensitivity.
+    """
+
+    conditions = [UserInDB.username >= prefix]
+    # the smallest string greater than every string with the prefix
+    upper = prefix.rstrip(chr(0x10FFFF))
+    if upper:
+        conditions.append(UserInDB.username < upper[:-1] + chr(ord(upper[-1]) + 1))
+    return conditions
+
+
+def encode_user_cursor(user: UserInDB) -> str:
+    """
+    Build an opaque pagination cursor pointing at a user.
+
+    :param user: the last user of a page
+    :return: the encoded cursor
+    """
+
+    return base64.urlsafe_b64encode(str(user.id).encode()).decode()
+
+
+def decode_user_cursor(cursor: str) -> int:
+    """
+    Decode a pagination cursor built by `encode_user_cursor`.
+
+    :param cursor: the encoded cursor
+    :return: the id of the user the cursor points at
+    :raises ValueError: if the cursor is malformed
+    """
+
+    try:
+        return int(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (UnicodeError, ValueError) as e:
+        raise ValueError(f"invalid cursor: {cursor}") from e
+
+
+def invalidate_user_count():
+    """Drop the cached user counts after a user was added or deleted."""
+    user_count_cache.clear()
 
 
 def create_user(session: Session, user_create: UserCreate) -> UserInDB:
@@ -55,6 +317,7 @@ def create_user(session: Session, user_create: UserCreate) -> UserInDB:
         **user_create.model_dump(),
     )
     session.exec(insert(UserInDB).values(**user.model_dump()))
+    invalidate_user_count()
     return user
 
 
@@ -72,6 +335,43 @@ def get_user_by_id(session: Session, user_id: str) -> UserInDB:
     return user
 
 
+def get_cached_user(session: Session, user_id: int) -> Optional[UserInDB]:
+    """
+    Retrieve a user, from a cached snapshot when one is available.
+
+    Snapshots are attached to the session without a query, so the returned
+    user behaves like a loaded one. They live for a short time and are
+    dropped by `invalidate_user`.
+
+    :param user_id: id of the user to be retrieved
+    :return: the retrieved user, or None if there is no such user
+    """
+
+    snapshot = user_cache.get(user_id)
+    if snapshot is None:
+        user = session.get(UserInDB, user_id)
+        if user is not None:
+            user_cache.set(user_id, user.model_dump())
+        return user
+    return session.merge(user_from_snapshot(snapshot), load=False)
+
+
+def user_from_snapshot(snapshot: dict) -> UserInDB:
+    user = UserInDB(**snapshot)
+    make_transient_to_detached(user)
+    return user
+
+
+def invalidate_user(user_id: int):
+    """
+    Drop the cached snapshot of a user after it changed or was deleted.
+
+    :param user_id: id of the changed user
+    """
+
+    user_cache.pop(int(user_id))
+
+
 def delete_user(session: Session, user_id: str):
     """
     Delete an user from the database.
@@ -79,23 +379,184 @@ def delete_user(session: Session, user_id: str):
     :param user_id: the id of the user to be deleted
     """
 
+    session.exec(delete(RefreshTokenInDB).where(RefreshTokenInDB.user_id == user_id))
     session.exec(delete(UserInDB).where(UserInDB.id == user_id))
+    invalidate_user(user_id)
+    invalidate_user_count()
+
+
+def get_user_chats(session: Session, user_id: int) -> Sequence[ChatInDB]:
+    """
+    Retrieve the chats that a user is in.
+
+    Goes through the (user_id, chat_id) primary key of user_chat_links, so
+    the cost depends on the number of chats the user is in, not on the
+    total number of chats.
+
+    :param user_id: the id of the user whose chats are retrieved
+    :return: the chats ordered by name
+    """
+
+    return session.exec(user_chats_query(user_id)).all()
+
+
+def get_user_chats_with_reads(
+    session: Session,
+    user_id: int,
+    order: str = "name",
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+) -> tuple[list[tuple[ChatInDB, UserChatLinkInDB]], Optional[str]]:
+    """
+    Retrieve the chats that a user is in, each with the user's link to it
+    and its last message.
+
+    The unread count of a chat is its message_count minus the read_count
+    of the link, and the last message is found through the chat's
+    last_message_id, so a page of any size takes a single query that
+    neither counts nor scans messages.
+
+    :param user_id: the id of the user whose chats are retrieved
+    :param order: "name", or "activity" for the most recently active first
+    :param cursor: cursor from the previous page, which has to be in the
+        same order
+    :param limit: maximum number of chats to return, all of them if None
+    :return: the chats, each paired with its link, and the cursor of the
+        next page if there is one
+    :raises ValueError: if the cursor is malformed or of another order
+    """
+
+    rows = [tuple(row) for row in session.exec(user_chats_with_reads_query(user_id, order, cursor, limit)).all()]
+    return page_of_chats(rows, order, limit)
+
+
+def user_chats_with_reads_query(user_id: int, order: str = "name", cursor: Optional[str] = None, limit: Optional[int] = None):
+    query = (
+        select(ChatInDB, UserChatLinkInDB)
+        .join(UserChatLinkInDB, UserChatLinkInDB.chat_id == ChatInDB.id)
+        .where(UserChatLinkInDB.user_id == user_id)
+        .options(
+            joinedload(ChatInDB.owner),
+            joinedload(ChatInDB.last_message).joinedload(MessageInDB.user),
+        )
+    )
+    if order == "activity":
+        # SQLite sorts NULLs first, so chats without messages come last
+        query = query.order_by(ChatInDB.last_message_at.desc(), ChatInDB.id.desc())
+    else:
+        query = query.order_by(ChatInDB.name, ChatInDB.id)
+    if cursor is not None:
+        key, chat_id = decode_chat_cursor(cursor, order)
+        if order == "activity" and key is None:
+            query = query.where(ChatInDB.last_message_at.is_(None), ChatInDB.id < chat_id)
+        elif order == "activity":
+            query = query.where(or_(
+                ChatInDB.last_message_at < key,
+                and_(ChatInDB.last_message_at == key, ChatInDB.id < chat_id),
+                ChatInDB.last_message_at.is_(None),
+            ))
+        else:
+            query = query.where(or_(ChatInDB.name > key, and_(ChatInDB.name == key, ChatInDB.id > chat_id)))
+    if limit is not None:
+        query = query.limit(limit + 1)
+    return query
+
+
+def page_of_chats(rows: list, order: str, limit: Optional[int]) -> tuple[list, Optional[str]]:
+    """Trim the rows of `user_chats_with_reads_query` into a page and the cursor of the next one."""
+    if limit is None or len(rows) <= limit:
+        return rows, None
+    return rows[:limit], encode_chat_cursor(rows[limit - 1][0], order)
+
+
+def encode_chat_cursor(chat: ChatInDB, order: str) -> str:
+    """
+    Build an opaque pagination cursor pointing at a chat in a list.
+
+    :param chat: the last chat of a page
+    :param order: the order of the list
+    """
+
+    if order == "activity":
+        key = chat.last_message_at.isoformat() if chat.last_message_at is not None else None
+    else:
+        key = chat.name
+    return base64.urlsafe_b64encode(json.dumps([order, key, chat.id]).encode()).decode()
+
+
+def decode_chat_cursor(cursor: str, order: str) -> tuple:
+    """
+    Decode a pagination cursor built by `encode_chat_cursor`.
+
+    :return: the sort key and the id of the chat the cursor points at
+    :raises ValueError: if the cursor is malformed or of another order
+    """
+
+    try:
+        cursor_order, key, chat_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if cursor_order != order or not isinstance(chat_id, int):
+            raise ValueError
+        if order == "activity" and key is not None:
+            key = datetime.fromisoformat(key)
+        elif order != "activity" and not isinstance(key, str):
+            raise ValueError
+        return key, chat_id
+    except (UnicodeError, ValueError, TypeError) as e:
+        raise ValueError(f"invalid cursor: {cursor}") from e
+
+
+def get_user_chats_version(session: Session, user_id: int) -> list[tuple[int, int, int]]:
+    """
+    Retrieve what `get_user_chats_with_reads` depends on, which is far
+    cheaper than the chats themselves.
+
+    :param user_id: the id of the user whose chats are checked
+    :return: the (id, version, read_count) of each of the user's chats
+    """
+
+    return [tuple(row) for row in session.exec(user_chats_version_query(user_id)).all()]
 
 
-def get_user_chats(session: Session, user_id: str) -> list[ChatInDB]:
+def user_chats_version_query(user_id: int):
+    return (
+        select(ChatInDB.id, ChatInDB.version, UserChatLinkInDB.read_count)
+        .join(UserChatLinkInDB, UserChatLinkInDB.chat_id == ChatInDB.id)
+        .where(UserChatLinkInDB.user_id == user_id)
+        .order_by(ChatInDB.id)
+    )
+
+
+def touch_user_chats(session: Session, user_id: int):
     """
-    Gets all the chats that the user is in
+    Bump the version of every chat showing a user, after the user changed.
 
-    :param user_id: the id of the user to be scan
+    :param user_id: the id of the user that changed
     """
 
-    user = get_user_by_id(session, user_id)
-    return [chat for chat in get_all_chats(session) if user in chat.users]
+    member_of = select(UserChatLinkInDB.chat_id).where(UserChatLinkInDB.user_id == user_id)
+    session.exec(
+        update(ChatInDB)
+        .where(or_(ChatInDB.id.in_(member_of), ChatInDB.owner_id == user_id))
+        .values(version=ChatInDB.version + 1)
+    )
+
+
+def user_chats_query(user_id: int):
+    return (
+        select(ChatInDB)
+        .join(UserChatLinkInDB, UserChatLinkInDB.chat_id == ChatInDB.id)
+        .where(UserChatLinkInDB.user_id == user_id)
+        .order_by(ChatInDB.name)
+        .options(selectinload(ChatInDB.owner))
+    )
 
 
 #   -------- chats --------   #
 
 
+membership_cache = TTLCache(maxsize=100_000, ttl=60)
+
+
 def get_all_chats(session: Session) -> Sequence[ChatInDB]:
     """
     Retrieve all chats from the database.
@@ -106,6 +567,33 @@ def get_all_chats(session: Session) -> Sequence[ChatInDB]:
     return session.exec(select(ChatInDB)).all()
 
 
+def is_chat_member(session: Session, chat_id: int, user_id: int) -> bool:
+    """
+    Check whether a user is in a chat.
+
+    Answers come from an EXISTS lookup on the user_chat_links primary key and
+    are cached for a short time.
+
+    :param chat_id: id of the chat
+    :param user_id: id of the user
+    :return: whether the user is in the chat
+    """
+
+    key = (user_id, chat_id)
+    member = membership_cache.get(key)
+    if member is None:
+        member = session.scalar(membership_query(chat_id, user_id))
+        membership_cache.set(key, member)
+    return member
+
+
+def membership_query(chat_id: int, user_id: int):
+    return select(exists().where(
+        UserChatLinkInDB.user_id == user_id,
+        UserChatLinkInDB.chat_id == chat_id,
+    ))
+
+
 def get_chat_by_id(session: Session, chat_id: int) -> ChatInDB:
     """
     Retrieve a chat from the database.
@@ -120,6 +608,58 @@ def get_chat_by_id(session: Session, chat_id: int) -> ChatInDB:
     return chat
 
 
+def get_chat_version(session: Session, chat_id: int) -> int:
+    """
+    Retrieve the version of a chat, see `ChatInDB.version`.
+
+    :param chat_id: id of the chat
+    :raises KeyError: if the chat does not exist
+    """
+
+    version = session.scalar(chat_version_query(chat_id))
+    if version is None:
+        raise KeyError
+    return version
+
+
+def chat_version_query(chat_id: int):
+    return select(ChatInDB.version).where(ChatInDB.id == chat_id)
+
+
+def get_chat_for_response(
+    session: Session,
+    chat_id: int,
+    include_messages: bool,
+    include_users: bool,
+) -> ChatInDB:
+    """
+    Retrieve a chat with everything `ChatResponse.from_db` touches loaded.
+
+    The owner is joined into the chat query and each included relationship
+    is loaded with one extra SELECT (plus one for message authors), so the
+    number of queries does not depend on the number of messages or users.
+
+    :param chat_id: id of the chat to be retrieved
+    :param include_messages: load the messages and their authors
+    :param include_users: load the members of the chat
+    :return: the retrieved chat
+    """
+
+    chat = session.exec(chat_for_response_query(chat_id, include_messages, include_users)).first()
+    if chat is None:
+        raise KeyError
+    return chat
+
+
+def chat_for_response_query(chat_id: int, include_messages: bool, include_users: bool):
+    options = [joinedload(ChatInDB.owner), joinedload(ChatInDB.last_message).joinedload(MessageInDB.user)]
+    if include_messages:
+        options.append(selectinload(ChatInDB.messages).selectinload(MessageInDB.user))
+    if include_users:
+        options.append(selectinload(ChatInDB.users))
+    return select(ChatInDB).where(ChatInDB.id == chat_id).options(*options)
+
+
 def update_chat(session: Session, chat_id: int, chat_update: UpdateChat) -> ChatInDB:
     """
     Update a chat in the database.
@@ -131,6 +671,7 @@ def update_chat(session: Session, chat_id: int, chat_update: UpdateChat) -> Chat
 
     chat = get_chat_by_id(session, chat_id)
     chat.name = chat_update.name
+    chat.version = ChatInDB.version + 1
     session.add(chat)
     session.commit()
     session.refresh(chat)
@@ -147,26 +688,451 @@ def delete_chat(session: Session, chat_id: int):
     session.exec(delete(ChatInDB).where(ChatInDB.id == chat_id))
 
 
+def chat_counters_update(
+    chat_id: int,
+    messages: int = 0,
+    users: int = 0,
+    last_message_at: Optional[datetime] = None,
+    last_message_id: Optional[int] = None,
+):
+    """
+    Build the UPDATE that adjusts the denormalized counters of a chat and
+    bumps its version. It has to run in the same transaction as the change
+    it accounts for.
+
+    :param chat_id: id of the chat to be updated
+    :param messages: change of the message count
+    :param users: change of the user count
+    :param last_message_at: creation time of a newly added message
+    :param last_message_id: id of that message, when it is known already
+    """
+
+    values = {"version": ChatInDB.version + 1}
+    if messages:
+        values["message_count"] = ChatInDB.message_count + messages
+    if users:
+        values["user_count"] = ChatInDB.user_count + users
+    if last_message_at is not None:
+        values["last_message_at"] = func.max(func.coalesce(ChatInDB.last_message_at, last_message_at), last_message_at)
+        if last_message_id is not None:
+            # SET sees the old last_message_at
+            is_latest = or_(ChatInDB.last_message_at.is_(None), ChatInDB.last_message_at <= last_message_at)
+            values["last_message_id"] = case((is_latest, last_message_id), else_=ChatInDB.last_message_id)
+    elif messages < 0:
+        values["last_message_at"] = (
+            select(func.max(MessageInDB.created_at))
+            .where(MessageInDB.chat_id == chat_id)
+            .scalar_subquery()
+        )
+        values["last_message_id"] = latest_message_id(chat_id)
+    return update(ChatInDB).where(ChatInDB.id == chat_id).values(**values)
+
+
+def latest_message_id(chat_id):
+    """Build the id of the latest message of a chat, one step down the (chat_id, created_at, id) index."""
+    return (
+        select(MessageInDB.id)
+        .where(MessageInDB.chat_id == chat_id)
+        .order_by(MessageInDB.created_at.desc(), MessageInDB.id.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
+
+
+def reconcile_chat_counters(session: Session):
+    """
+    Rebuild the denormalized counters of every chat from the messages and
+    user_chat_links tables.
+    """
+
+    session.exec(update(ChatInDB).values(
+        message_count=select(func.count()).where(MessageInDB.chat_id == ChatInDB.id).scalar_subquery(),
+        user_count=select(func.count()).where(UserChatLinkInDB.chat_id == ChatInDB.id).scalar_subquery(),
+        last_message_at=select(func.max(MessageInDB.created_at)).where(MessageInDB.chat_id == ChatInDB.id).scalar_subquery(),
+        last_message_id=latest_message_id(ChatInDB.id),
+    ))
+    session.exec(read_counts_recount())
+    session.commit()
+
+
 def create_message(session: Session, chat_id: int, message: CreateMessage, user: UserInDB) -> MessageInDB:
-    while True:
-        chat = get_chat_by_id(session, chat_id)
-        msg = MessageInDB(id=randint(1, 100000000), text=message.text, user_id=user.id, chat_id=chat.id, created_at=datetime.now(), user=user, chat=chat)
-        chat.messages.append(msg)
-        if user not in chat.users:
-            chat.users.append(user)
-        session.add(chat)
-        try:
-            session.commit()
-        except Exception as e:
-            if not hasattr(e, "args"):
-                raise e
-            err: str = e.args[0]
-            if "UNIQUE constraint failed: messages.id" not in err:
-                raise e
+    """
+    Create a new message in a chat, adding its author to the chat if needed.
+
+    :param chat_id: id of the chat the message is posted in
+    :param message: attributes of the message to be created
+    :param user: the author of the message
+    :return: the newly created message
+    """
+
+    # usually already in the identity map from user_guard
+    chat = session.get(ChatInDB, chat_id)
+    if chat is None:
+        raise KeyError
+    joined = not is_chat_member(session, chat_id, user.id)
+    # the author comes detached from the read session of `get_current_user`
+    user = session.merge(user, load=False)
+    msg = MessageInDB(id=id_generator.next_id(), text=message.text, user_id=user.id, chat_id=chat_id, created_at=datetime.now(), user=user)
+    session.add(msg)
+    if joined:
+        session.add(UserChatLinkInDB(user_id=user.id, chat_id=chat_id))
+    # assigns the id when the database picks it, which the UPDATEs need
+    session.flush()
+    session.exec(chat_counters_update(chat_id, messages=1, users=int(joined), last_message_at=msg.created_at, last_message_id=msg.id))
+    # writing a message counts as reading the chat up to it
+    session.exec(read_cursor_update(chat_id, user.id, msg.id, msg.created_at))
+    session.commit()
+
+    if joined:
+        membership_cache.pop((user.id, chat_id))
+        # a loaded member list no longer matches the database
+        session.expire(chat, ["users"])
+    events.hub.publish(message_event("message_created", msg))
+    return msg
+
+
+def create_messages(
+    session: Session,
+    user: UserInDB,
+    messages: Sequence[tuple[int, BulkMessage]],
+) -> list[BulkMessageResult]:
+    """
+    Insert a batch of messages by one author in a single transaction.
+
+    The rows go in with a single executemany instead of going through the
+    ORM one by one. Messages are only accepted in chats the author is
+    already in; unlike `create_message`, nobody is added to a chat.
+
+    :param user: the author of the messages
+    :param messages: the messages, each paired with its index in the request
+    :return: the outcome of each message, in order
+    """
+
+    chat_ids = {message.chat_id for _, message in messages}
+    existing = set(session.exec(select(ChatInDB.id).where(ChatInDB.id.in_(chat_ids))).all())
+    member_of = set(session.exec(
+        select(UserChatLinkInDB.chat_id)
+        .where(UserChatLinkInDB.user_id == user.id, UserChatLinkInDB.chat_id.in_(existing))
+    ).all())
+
+    now = datetime.now()
+    results, rows = [], []
+    for index, message in messages:
+        if message.chat_id not in existing:
+            results.append(BulkMessageResult(index=index, status=404, error="entity_not_found"))
+        elif message.chat_id not in member_of:
+            results.append(BulkMessageResult(index=index, status=403, error="no_permission"))
+        else:
+            created_at = message.created_at or now
+            if created_at.tzinfo is not None:
+                # stored timestamps are naive local times
+                created_at = created_at.astimezone().replace(tzinfo=None)
+            row = {"text": message.text, "user_id": user.id, "chat_id": message.chat_id, "created_at": created_at}
+            msg_id = id_generator.next_id()
+            if msg_id is not None:
+                row["id"] = msg_id
+            rows.append(row)
+            results.append(BulkMessageResult(index=index, status=201))
+    if not rows:
+        return results
+
+    per_chat = insert_message_rows(session, rows, now)
+    created = (result for result in results if result.status == 201)
+    for result, row in zip(created, rows):
+        result.id = row["id"]
+    # the author is expired by the commit
+    author = User.from_db(user)
+    session.commit()
+
+    for chat_id, chat_rows in per_chat.items():
+        if len(chat_rows) > bulk_event_limit:
+            events.hub.publish(ChatEvent(type="resync", chat_id=chat_id))
             continue
+        for row in chat_rows:
+            events.hub.publish(ChatEvent(type="message_created", chat_id=chat_id, message=Message(**row, user=author)))
+    return results
 
-        session.refresh(chat)
-        return msg
+
+def insert_message_rows(session: Session, rows: list[dict], now: datetime) -> dict[int, list[dict]]:
+    """
+    Insert message rows with a single executemany and account for them in
+    the counters of their chats, without committing.
+
+    :param rows: the message rows; those without an id get the one
+        SQLite would pick
+    :param now: the current time; rows created at any other time are
+        backdated and have the read counts past them recounted
+    :return: the rows grouped by chat
+    """
+
+    per_chat: dict[int, list[dict]] = {}
+    for row in rows:
+        per_chat.setdefault(row["chat_id"], []).append(row)
+    for chat_id, chat_rows in per_chat.items():
+        latest = max(row["created_at"] for row in chat_rows)
+        session.exec(chat_counters_update(chat_id, messages=len(chat_rows), last_message_at=latest))
+    backdated = {
+        chat_id: min(row["created_at"] for row in chat_rows)
+        for chat_id, chat_rows in per_chat.items()
+        if any(row["created_at"] != now for row in chat_rows)
+    }
+    if "id" not in rows[0]:
+        # RETURNING would force a statement per row, so the ids SQLite would
+        # pick are assigned up front; the UPDATEs above hold the write lock,
+        # so no other insert can take them in the meantime
+        last_id = session.scalar(select(func.coalesce(func.max(MessageInDB.id), 0)))
+        for msg_id, row in enumerate(rows, last_id + 1):
+            row["id"] = msg_id
+    # a Core insert skips the ORM's per-row bookkeeping and goes straight
+    # to the driver's executemany
+    session.connection().execute(insert(MessageInDB.__table__), rows)
+    for chat_id in per_chat:
+        # the ids were not known yet when the counters were updated
+        session.exec(update(ChatInDB).where(ChatInDB.id == chat_id).values(last_message_id=latest_message_id(chat_id)))
+    for chat_id, earliest in backdated.items():
+        # replayed history can land before read cursors
+        session.exec(read_counts_recount(chat_id, since=earliest))
+    return per_chat
+
+
+def stage_member_messages(session: Session, messages: Sequence[tuple[int, str, int]]) -> list[Optional[dict]]:
+    """
+    Add messages by several authors to chats they are in, without
+    committing. The messages go in through `insert_message_rows`, and the
+    authors' read cursors move with a single executemany, so the cost per
+    message stays flat as batches grow.
+
+    :param messages: the (chat_id, text, user_id) of each message
+    :return: the inserted row of each message, in order, or None where its
+        author is not in its chat
+    """
+
+    now = datetime.now()
+    rows: list[Optional[dict]] = []
+    for chat_id, text, user_id in messages:
+        if not is_chat_member(session, chat_id, user_id):
+            rows.append(None)
+            continue
+        row = {"text": text, "user_id": user_id, "chat_id": chat_id, "created_at": now}
+        msg_id = id_generator.next_id()
+        if msg_id is not None:
+            row["id"] = msg_id
+        rows.append(row)
+    inserted = [row for row in rows if row is not None]
+    if not inserted:
+        return rows
+
+    insert_message_rows(session, inserted, now)
+    # writing a message counts as reading the chat up to it; only the
+    # latest message of each author in each chat moves a cursor
+    latest = {(row["chat_id"], row["user_id"]): row for row in inserted}
+    cursor_update = read_cursor_update(bindparam("read_chat_id"), bindparam("read_user_id"), bindparam("read_id"), bindparam("read_at"))
+    session.connection().execute(cursor_update, [
+        {"read_chat_id": chat_id, "read_user_id": user_id, "read_id": row["id"], "read_at": row["created_at"]}
+        for (chat_id, user_id), row in latest.items()
+    ])
+    return rows
+
+
+def message_event(event_type: str, msg: MessageInDB) -> ChatEvent:
+    return ChatEvent(type=event_type, chat_id=msg.chat_id, message=Message.from_db(msg))
+
+
+def encode_message_cursor(msg: MessageInDB) -> str:
+    """
+    Build an opaque pagination cursor pointing at a message.
+
+    :param msg: the message the cursor points at
+    :return: the encoded cursor
+    """
+
+    raw = f"{msg.created_at.isoformat()}|{msg.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_message_cursor(cursor: str) -> tuple[datetime, int]:
+    """
+    Decode a pagination cursor built by `encode_message_cursor`.
+
+    :param cursor: the encoded cursor
+    :return: the (created_at, id) position of the cursor
+    :raises ValueError: if the cursor is malformed
+    """
+
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        created_at, msg_id = raw.split("|")
+        return datetime.fromisoformat(created_at), int(msg_id)
+    except (UnicodeError, ValueError) as e:
+        raise ValueError(f"invalid cursor: {cursor}") from e
+
+
+def get_chat_messages(
+    session: Session,
+    chat_id: int,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = 50,
+) -> tuple[list[MessageInDB], bool]:
+    """
+    Retrieve a page of messages from a chat, ordered by (created_at, id).
+
+    Without a cursor the latest page is returned. The lookup walks the
+    (chat_id, created_at, id) index, so the cost depends on the page size
+    and not on the size of the chat history.
+
+    :param chat_id: id of the chat to be paged
+    :param before: cursor; only return messages older than it
+    :param after: cursor; only return messages newer than it
+    :param limit: maximum number of messages to return
+    :return: the page in chronological order and whether more messages
+        exist past the page in the direction of paging
+    """
+
+    query, newest_first = chat_messages_query(chat_id, before, after, limit)
+    msgs = list(session.exec(query).all())
+    return page_of(msgs, limit, newest_first)
+
+
+def chat_messages_query(chat_id: int, before: Optional[str], after: Optional[str], limit: int):
+    """
+    Build the query behind `get_chat_messages`.
+
+    :return: the query, which fetches one row more than `limit`, and
+        whether it walks from the newest message backwards
+    """
+
+    query = (
+        select(MessageInDB)
+        .where(MessageInDB.chat_id == chat_id)
+        .options(selectinload(MessageInDB.user))
+    )
+    if before is not None:
+        created_at, msg_id = decode_message_cursor(before)
+        query = query.where(or_(
+            MessageInDB.created_at < created_at,
+            and_(MessageInDB.created_at == created_at, MessageInDB.id < msg_id),
+        ))
+    if after is not None:
+        created_at, msg_id = decode_message_cursor(after)
+        query = query.where(or_(
+            MessageInDB.created_at > created_at,
+            and_(MessageInDB.created_at == created_at, MessageInDB.id > msg_id),
+        ))
+
+    newest_first = after is None or before is not None
+    if newest_first:
+        query = query.order_by(MessageInDB.created_at.desc(), MessageInDB.id.desc())
+    else:
+        query = query.order_by(MessageInDB.created_at, MessageInDB.id)
+    return query.limit(limit + 1), newest_first
+
+
+def page_of(msgs: list[MessageInDB], limit: int, newest_first: bool) -> tuple[list[MessageInDB], bool]:
+    """Trim the rows of `chat_messages_query` into a chronological page."""
+    has_more = len(msgs) > limit
+    msgs = msgs[:limit]
+    if newest_first:
+        msgs.reverse()
+    return msgs, has_more
+
+
+def iter_chat_messages(session: Session, chat_id: int, batch_size: int = 1000) -> Iterator[Message]:
+    """
+    Iterate over every message of a chat, oldest first, in constant memory.
+
+    Plain columns are read through a server-side cursor, batch by batch, so
+    no ORM objects pile up in the session however long the chat is.
+
+    :param chat_id: id of the chat whose messages are iterated
+    :param batch_size: rows fetched from the cursor at a time
+    """
+
+    query = (
+        select(
+            MessageInDB.id,
+            MessageInDB.chat_id,
+            MessageInDB.created_at,
+            MessageInDB.text,
+            MessageInDB.user_id,
+        )
+        .where(MessageInDB.chat_id == chat_id)
+        .order_by(MessageInDB.created_at, MessageInDB.id)
+        .execution_options(yield_per=batch_size)
+    )
+    # bounded by the number of authors, not of messages
+    authors: dict[int, User] = {}
+    for msg_id, msg_chat_id, created_at, text, user_id in session.exec(query):
+        author = authors.get(user_id)
+        if author is None:
+            author = authors[user_id] = User.from_db(session.get(UserInDB, user_id))
+        yield Message(id=msg_id, chat_id=msg_chat_id, created_at=created_at, text=text, user=author)
+
+
+def search_messages(
+    session: Session,
+    user_id: int,
+    terms: str,
+    chat_id: Optional[int] = None,
+    cursor: Optional[str] = None,
+    limit: int = 50,
+) -> tuple[list[tuple[MessageInDB, str]], Optional[str]]:
+    """
+    Search the messages of the chats a user is in, best matches first.
+
+    Every word of `terms` has to appear in a message. Words are matched
+    literally, so FTS5 operators in them have no effect.
+
+    :param user_id: id of the user searching
+    :param terms: the words to search for
+    :param chat_id: id of a chat to limit the search to
+    :param cursor: cursor returned with the previous page
+    :param limit: maximum number of messages returned
+    :return: the messages with a snippet of each, matches wrapped in
+        <mark> tags, and the cursor of the next page if there is one
+    :raises ValueError: if `terms` has no words or the cursor is malformed
+    """
+
+    words = terms.split()
+    if not words:
+        raise ValueError("nothing to search for")
+    match = " ".join('"' + word.replace('"', '""') + '"' for word in words)
+    offset = _decode_search_cursor(cursor) if cursor is not None else 0
+
+    fts = literal_column("messages_fts")
+    query = (
+        select(MessageInDB, func.snippet(fts, 0, "<mark>", "</mark>", "…", 16))
+        .join(messages_fts, messages_fts.c.rowid == MessageInDB.id)
+        .join(UserChatLinkInDB, and_(
+            UserChatLinkInDB.chat_id == MessageInDB.chat_id,
+            UserChatLinkInDB.user_id == user_id,
+        ))
+        .where(fts.op("MATCH")(match))
+        .order_by(messages_fts.c.rank, MessageInDB.id)
+        .options(selectinload(MessageInDB.user))
+        .offset(offset)
+        .limit(limit + 1)
+    )
+    if chat_id is not None:
+        query = query.where(MessageInDB.chat_id == chat_id)
+    hits = [tuple(row) for row in session.exec(query).all()]
+
+    next_cursor = None
+    if len(hits) > limit:
+        hits = hits[:limit]
+        next_cursor = base64.urlsafe_b64encode(str(offset + limit).encode()).decode()
+    return hits, next_cursor
+
+
+def _decode_search_cursor(cursor: str) -> int:
+    # ranks shift as messages are written, so search pages are by position
+    try:
+        offset = int(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (UnicodeError, ValueError) as e:
+        raise ValueError(f"invalid cursor: {cursor}") from e
+    if offset < 0:
+        raise ValueError(f"invalid cursor: {cursor}")
+    return offset
 
 
 def get_msg_by_id(session: Session, chat_id: int, msg_id: str) -> MessageInDB:
@@ -200,8 +1166,10 @@ def update_msg(session: Session, chat_id: int, message_id: str, msg_update: Upda
     msg = get_msg_by_id(session, chat_id, message_id)
     msg.text = msg_update.text
     session.add(msg)
+    session.exec(chat_counters_update(chat_id))
     session.commit()
     session.refresh(msg)
+    events.hub.publish(message_event("message_updated", msg))
     return msg
 
 
@@ -214,5 +1182,141 @@ def delete_msg(session: Session, chat_id: int, message_id: str) :
     """
 
     msg = get_msg_by_id(session, chat_id, message_id)
+    event = message_event("message_deleted", msg)
+    msg_id, created_at = msg.id, msg.created_at
     session.delete(msg)
+    session.flush()
+    session.exec(chat_counters_update(chat_id, messages=-1))
+    # cursors at or past the message had counted it as read
+    session.exec(
+        update(UserChatLinkInDB)
+        .where(UserChatLinkInDB.chat_id == chat_id, read_cursor_at_or_past(created_at, msg_id))
+        .values(read_count=UserChatLinkInDB.read_count - 1)
+    )
     session.commit()
+    events.hub.publish(event)
+
+
+#   -------- read cursors --------   #
+
+
+def mark_chat_read(session: Session, chat_id: int, user_id: int, message_id: Optional[int] = None) -> ReadState:
+    """
+    Move a user's read cursor in a chat forward to a message.
+
+    Cursors never move back, so marking an older message read changes
+    nothing. The new read count is derived from the messages past the
+    cursor, so the cost depends on how many are left unread.
+
+    :param chat_id: id of the chat
+    :param user_id: id of the reader, who has to be in the chat
+    :param message_id: id of the last message read, defaults to the latest
+    :return: the read state of the user in the chat
+    :raises KeyError: if the message is not in the chat or the user is not
+    """
+
+    query = select(MessageInDB.id, MessageInDB.created_at).where(MessageInDB.chat_id == chat_id)
+    if message_id is None:
+        query = query.order_by(MessageInDB.created_at.desc(), MessageInDB.id.desc()).limit(1)
+    else:
+        query = query.where(MessageInDB.id == message_id)
+    target = session.exec(query).first()
+    if target is None and message_id is not None:
+        raise KeyError
+    if target is not None:
+        session.exec(read_cursor_update(chat_id, user_id, *target))
+        session.commit()
+    return get_read_state(session, chat_id, user_id)
+
+
+def get_read_state(session: Session, chat_id: int, user_id: int) -> ReadState:
+    """
+    Retrieve how far a user has read a chat.
+
+    :param chat_id: id of the chat
+    :param user_id: id of the reader
+    :raises KeyError: if the user is not in the chat
+    """
+
+    row = session.exec(
+        select(UserChatLinkInDB.last_read_message_id, UserChatLinkInDB.read_count, ChatInDB.message_count)
+        .join(ChatInDB, ChatInDB.id == UserChatLinkInDB.chat_id)
+        .where(UserChatLinkInDB.user_id == user_id, UserChatLinkInDB.chat_id == chat_id)
+    ).first()
+    if row is None:
+        raise KeyError
+    last_read_message_id, read_count, message_count = row
+    return ReadState(chat_id=chat_id, last_read_message_id=last_read_message_id, unread_count=max(message_count - read_count, 0))
+
+
+def read_cursor_at_or_past(created_at, msg_id):
+    """Build the condition of a read cursor being at or past a message position."""
+    return or_(
+        UserChatLinkInDB.last_read_at > created_at,
+        and_(UserChatLinkInDB.last_read_at == created_at, UserChatLinkInDB.last_read_message_id >= msg_id),
+    )
+
+
+def read_count_at(chat_id, read_at, read_id):
+    """
+    Build the read count of a cursor: the chat's message count minus the
+    messages past the cursor, which the (chat_id, created_at, id) index
+    counts without visiting the messages already read.
+    """
+
+    message_count = select(ChatInDB.message_count).where(ChatInDB.id == chat_id).scalar_subquery()
+    unread = select(func.count()).where(
+        MessageInDB.chat_id == chat_id,
+        or_(
+            MessageInDB.created_at > read_at,
+            and_(MessageInDB.created_at == read_at, MessageInDB.id > read_id),
+        ),
+    ).scalar_subquery()
+    return message_count - unread
+
+
+def read_cursor_update(chat_id: int, user_id: int, msg_id: int, created_at: datetime):
+    """
+    Build the UPDATE that moves a read cursor forward to a message. It has
+    to run after the chat's counters account for the message.
+
+    :param chat_id: id of the chat
+    :param user_id: id of the reader
+    :param msg_id: id of the message read
+    :param created_at: creation time of the message read
+    """
+
+    return (
+        update(UserChatLinkInDB)
+        .where(
+            UserChatLinkInDB.user_id == user_id,
+            UserChatLinkInDB.chat_id == chat_id,
+            or_(UserChatLinkInDB.last_read_at.is_(None), ~read_cursor_at_or_past(created_at, msg_id)),
+        )
+        .values(
+            last_read_message_id=msg_id,
+            last_read_at=created_at,
+            read_count=read_count_at(chat_id, created_at, msg_id),
+        )
+    )
+
+
+def read_counts_recount(chat_id: Optional[int] = None, since: Optional[datetime] = None):
+    """
+    Build the UPDATE that recomputes the read counts of cursors from the
+    messages.
+
+    :param chat_id: only recount the cursors in this chat
+    :param since: only recount cursors at or past this time
+    """
+
+    query = update(UserChatLinkInDB).where(UserChatLinkInDB.last_read_at.is_not(None))
+    if chat_id is not None:
+        query = query.where(UserChatLinkInDB.chat_id == chat_id)
+    if since is not None:
+        query = query.where(UserChatLinkInDB.last_read_at >= since)
+    return query.values(read_count=read_count_at(
+        UserChatLinkInDB.chat_id,
+        UserChatLinkInDB.last_read_at,
+        UserChatLinkInDB.last_read_message_id,
+    ))
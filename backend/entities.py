@@ -1,9 +1,10 @@
 from datetime import datetime
 
 from pydantic import BaseModel
-from typing import Optional
+from typing import Iterable, Optional
 
-from sqlmodel import Field, Relationship, SQLModel
+from sqlalchemy import inspect
+from sqlmodel import Field, Index, Relationship, SQLModel
 
 
 class User(BaseModel):
@@ -15,8 +16,28 @@ class User(BaseModel):
     username: str
 
     @staticmethod
-    def from_db(user_in_db: "UserInDB") -> "User":
-        return User(**user_in_db.model_dump())
+    def from_db(user_in_db: "UserInDB", authors: Optional[dict[int, "User"]] = None) -> "User":
+        """
+        Build the response for a user.
+
+        :param user_in_db: the user to project
+        :param authors: users already built for the same response, by id;
+            the result is looked up and stored there, so a response that
+            mentions a user many times builds it only once
+        """
+
+        if authors is not None:
+            user = authors.get(user_in_db.id)
+            if user is None:
+                user = authors[user_in_db.id] = User.from_db(user_in_db)
+            return user
+        # keyword arguments skip the dict round trip of model_dump
+        return User(
+            id=user_in_db.id,
+            created_at=user_in_db.created_at,
+            email=user_in_db.email,
+            username=user_in_db.username,
+        )
 
 
 class UserCreate(BaseModel):
@@ -40,6 +61,12 @@ class Metadata(BaseModel):
     count: int
 
 
+class UserMetadata(Metadata):
+    """Represents metadata for a page of users."""
+
+    next_cursor: Optional[str] = None
+
+
 class UserCollection(BaseModel):
     """Represents an API response for a collection of users."""
 
@@ -47,6 +74,13 @@ class UserCollection(BaseModel):
     users: list[User]
 
 
+class UserPage(BaseModel):
+    """Represents an API response for a page of users."""
+
+    meta: UserMetadata
+    users: list[User]
+
+
 class Message(BaseModel):
     """Represents a public message in a chat."""
     id: int
@@ -56,16 +90,61 @@ class Message(BaseModel):
     text: str
 
     @staticmethod
-    def from_db(msg_in_db: "MessageInDB") -> "Message":
-        return Message(id=msg_in_db.id, chat_id=msg_in_db.chat_id, created_at=msg_in_db.created_at, text=msg_in_db.text, user=User.from_db(msg_in_db.user))
+    def from_db(msg_in_db: "MessageInDB", authors: Optional[dict[int, User]] = None) -> "Message":
+        """
+        Build the response for a message.
+
+        :param msg_in_db: the message to project, with its author loaded
+        :param authors: authors already built for the same response, by id
+        """
+
+        if authors is not None and msg_in_db.user_id in authors:
+            # found without touching the relationship
+            author = authors[msg_in_db.user_id]
+        else:
+            author = User.from_db(msg_in_db.user, authors)
+        return Message(id=msg_in_db.id, chat_id=msg_in_db.chat_id, created_at=msg_in_db.created_at, text=msg_in_db.text, user=author)
+
+    @staticmethod
+    def many_from_db(msgs: Iterable["MessageInDB"], authors: Optional[dict[int, User]] = None) -> list["Message"]:
+        """Build the responses for messages, each distinct author once."""
+        authors = {} if authors is None else authors
+        return [Message.from_db(msg, authors) for msg in msgs]
+
+
+class MessageMetadata(Metadata):
+    """Represents metadata for a page of messages."""
+
+    next_cursor: Optional[str] = None
+
+
+class ChatEvent(BaseModel):
+    """Represents a real-time event about a message in a chat."""
+
+    type: str  # message_created, message_updated, message_deleted or resync
+    chat_id: int
+    seq: Optional[int] = None  # increases by one per event in the chat
+    message: Optional[Message] = None
 
 
 class MessageCollection(BaseModel):
     """Represents an API response for a collection of messages."""
-    meta: Metadata
+    meta: MessageMetadata
     messages: list[Message]
 
 
+class MessageSearchHit(BaseModel):
+    """Represents a message matching a search."""
+    message: Message
+    snippet: str  # excerpt of the text with the matches wrapped in <mark> tags
+
+
+class MessageSearchResponse(BaseModel):
+    """Represents an API response for a page of search results."""
+    meta: MessageMetadata
+    hits: list[MessageSearchHit]
+
+
 class UpdateChat(BaseModel):
     """Represents parameters for updating a chat."""
     name: str
@@ -89,10 +168,37 @@ class Chat(BaseModel):
     name: str
     owner: User
     created_at: datetime
+    last_message: Optional[Message] = None  # only filled in where it was loaded with the chat
+
+    @staticmethod
+    def from_db(chat_in_db: "ChatInDB", authors: Optional[dict[int, User]] = None) -> "Chat":
+        """
+        Build the response for a chat.
+
+        :param chat_in_db: the chat to project, with its owner loaded
+        :param authors: users already built for the same response, by id
+        """
+
+        return Chat(
+            id=chat_in_db.id,
+            name=chat_in_db.name,
+            owner=User.from_db(chat_in_db.owner, authors),
+            created_at=chat_in_db.created_at,
+            last_message=last_message_of(chat_in_db, authors),
+        )
 
     @staticmethod
-    def from_db(chat_in_db: "ChatInDB") -> "Chat":
-        return Chat(**chat_in_db.model_dump(), owner=User(**chat_in_db.owner.model_dump()))
+    def many_from_db(chats: Iterable["ChatInDB"]) -> list["Chat"]:
+        """Build the responses for chats, each distinct owner once."""
+        owners: dict[int, User] = {}
+        return [Chat.from_db(chat, owners) for chat in chats]
+
+
+def last_message_of(chat_in_db: "ChatInDB", authors: Optional[dict[int, User]] = None) -> Optional[Message]:
+    """Build the last message of a chat if it was loaded, without loading it otherwise."""
+    if "last_message" in inspect(chat_in_db).unloaded or chat_in_db.last_message is None:
+        return None
+    return Message.from_db(chat_in_db.last_message, authors)
 
 
 class ChatResponse(BaseModel):
@@ -104,16 +210,18 @@ class ChatResponse(BaseModel):
 
     @staticmethod
     def from_db(chat_in_db: "ChatInDB", include_messages: bool, include_users: bool) -> "ChatResponse":
+        # the owner and the members are usually the authors too
+        authors: dict[int, User] = {}
         response = ChatResponse(
-            chat=Chat(**chat_in_db.model_dump(), owner=User(**chat_in_db.owner.model_dump())),
-            meta=ChatMetadata(message_count=len(chat_in_db.messages), user_count=len(chat_in_db.users)),
+            chat=Chat.from_db(chat_in_db, authors),
+            meta=ChatMetadata(message_count=chat_in_db.message_count, user_count=chat_in_db.user_count),
             messages=None,
             users=None
         )
-        if include_messages:
-            response.messages = [Message.from_db(msg) for msg in chat_in_db.messages]
         if include_users:
-            response.users = [User.from_db(user) for user in chat_in_db.users]
+            response.users = [User.from_db(user, authors) for user in chat_in_db.users]
+        if include_messages:
+            response.messages = Message.many_from_db(chat_in_db.messages, authors)
         return response
 
 
@@ -123,18 +231,104 @@ class ChatCollection(BaseModel):
     chats: list[Chat]
 
 
+class UserChat(Chat):
+    """Represents a chat as seen by one of its members."""
+    unread_count: int
+    last_read_message_id: Optional[int] = None
+
+    @staticmethod
+    def many_from_db(rows: Iterable[tuple["ChatInDB", "UserChatLinkInDB"]]) -> list["UserChat"]:
+        """Build the responses for chats and the member's links to them, each distinct user once."""
+        authors: dict[int, User] = {}
+        return [
+            UserChat(
+                id=chat_in_db.id,
+                name=chat_in_db.name,
+                owner=User.from_db(chat_in_db.owner, authors),
+                created_at=chat_in_db.created_at,
+                last_message=last_message_of(chat_in_db, authors),
+                unread_count=max(chat_in_db.message_count - link.read_count, 0),
+                last_read_message_id=link.last_read_message_id,
+            )
+            for chat_in_db, link in rows
+        ]
+
+
+class ChatListMetadata(Metadata):
+    """Represents metadata for a page of chats."""
+
+    next_cursor: Optional[str] = None
+
+
+class UserChatCollection(BaseModel):
+    """Represents an API response for the chats of the current user."""
+    meta: ChatListMetadata
+    chats: list[UserChat]
+
+
+class MarkRead(BaseModel):
+    """Represents parameters for advancing a read cursor."""
+    message_id: Optional[int] = None  # defaults to the latest message
+
+
+class ReadState(BaseModel):
+    """Represents how far a user has read a chat."""
+    chat_id: int
+    last_read_message_id: Optional[int]
+    unread_count: int
+
+
 class CreateMessage(BaseModel):
     """Represents parameters for adding a new message to a chat."""
     text: str
 
 
+class BulkMessage(BaseModel):
+    """Represents a message in a bulk import, which names its own chat."""
+    chat_id: int
+    text: str
+    # set when replaying history; defaults to the time of the import
+    created_at: Optional[datetime] = None
+
+
+class BulkMessageResult(BaseModel):
+    """Represents the outcome of importing a single message."""
+    index: int  # position of the message in the request
+    status: int  # HTTP status the message would have gotten on its own
+    id: Optional[int] = None
+    error: Optional[str] = None
+
+
+class BulkMetadata(Metadata):
+    """Represents metadata for the results of a bulk import."""
+
+    created: int
+
+
+class BulkMessageResponse(BaseModel):
+    """Represents an API response for a bulk import of messages."""
+
+    meta: BulkMetadata
+    results: list[BulkMessageResult]
+
+
 class UserChatLinkInDB(SQLModel, table=True):
     """Database model for many-to-many relation of users to chats."""
 
     __tablename__ = "user_chat_links"
 
     user_id: int = Field(foreign_key="users.id", primary_key=True)
-    chat_id: int = Field(foreign_key="chats.id", primary_key=True)
+    # the primary key already indexes lookups by user_id; this one serves
+    # lookups of a chat's members
+    chat_id: int = Field(foreign_key="chats.id", primary_key=True, index=True)
+    # the read cursor of the user in the chat: the last message read, with
+    # its created_at so positions compare without a join
+    last_read_message_id: Optional[int] = None
+    last_read_at: Optional[datetime] = None
+    # messages of the chat at or before the cursor, so the unread count is
+    # the chat's message_count minus this; kept up to date by the database
+    # module and rebuilt by `reconcile_chat_counters`
+    read_count: int = Field(default=0, sa_column_kwargs={"server_default": "0"})
 
 
 class UserInDB(SQLModel, table=True):
@@ -163,19 +357,43 @@ class ChatInDB(SQLModel, table=True):
     name: str
     owner_id: int = Field(foreign_key="users.id")
     created_at: Optional[datetime] = Field(default_factory=datetime.now)
+    # denormalized so reading a chat never counts its rows; kept up to date
+    # by the database module and rebuilt by `reconcile_chat_counters`
+    message_count: int = Field(default=0, sa_column_kwargs={"server_default": "0"})
+    user_count: int = Field(default=0, sa_column_kwargs={"server_default": "0"})
+    last_message_at: Optional[datetime] = None
+    # the latest message by (created_at, id), kept alongside last_message_at
+    last_message_id: Optional[int] = None
+    # bumped by every change to what reading the chat returns, which makes
+    # it the basis of the chat routes' ETags
+    version: int = Field(default=0, sa_column_kwargs={"server_default": "0"})
 
     owner: UserInDB = Relationship()
     users: list[UserInDB] = Relationship(
         back_populates="chats",
         link_model=UserChatLinkInDB,
     )
-    messages: list["MessageInDB"] = Relationship(back_populates="chat")
+    messages: list["MessageInDB"] = Relationship(
+        back_populates="chat",
+        sa_relationship_kwargs={"order_by": "(MessageInDB.created_at, MessageInDB.id)"},
+    )
+    # no foreign key, which would make chats and messages depend on each other
+    last_message: Optional["MessageInDB"] = Relationship(
+        sa_relationship_kwargs={
+            "primaryjoin": "foreign(ChatInDB.last_message_id) == MessageInDB.id",
+            "uselist": False,
+            "viewonly": True,
+        },
+    )
 
 
 class MessageInDB(SQLModel, table=True):
     """Database model for message."""
 
     __tablename__ = "messages"
+    __table_args__ = (
+        Index("ix_messages_chat_id_created_at_id", "chat_id", "created_at", "id"),
+    )
 
     id: Optional[int] = Field(default=None, primary_key=True)
     text: str
@@ -185,3 +403,32 @@ class MessageInDB(SQLModel, table=True):
 
     user: UserInDB = Relationship()
     chat: ChatInDB = Relationship(back_populates="messages")
+
+
+class RefreshTokenInDB(SQLModel, table=True):
+    """Database model for refresh token.
+
+    Only a hash of the token is stored. Every refresh replaces the token with
+    a new one of the same family, so a token that is presented twice was
+    stolen and its whole family is revoked.
+    """
+
+    __tablename__ = "refresh_tokens"
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    token_hash: str = Field(unique=True, index=True)
+    family: str = Field(index=True)
+    user_id: int = Field(foreign_key="users.id", index=True)
+    # id of the access token issued alongside, revoked with the family
+    access_jti: str
+    expires_at: datetime
+    used: bool = False
+
+
+class RevokedTokenInDB(SQLModel, table=True):
+    """Database model for revoked access token."""
+
+    __tablename__ = "revoked_tokens"
+
+    jti: str = Field(primary_key=True)
+    expires_at: int  # unix timestamp, after which the entry can be dropped
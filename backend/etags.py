@@ -0,0 +1,46 @@
+"""Weak ETags for conditional GETs.
+
+A route builds its ETag from whatever its response depends on, typically
+chat versions, and answers 304 before loading anything else when the
+client already has that representation.
+"""
+import hashlib
+from typing import Optional
+
+from fastapi import Response
+
+
+def weak_etag(*parts) -> str:
+    """
+    Build a weak ETag.
+
+    :param parts: the values the representation depends on
+    """
+
+    digest = hashlib.blake2b(repr(parts).encode(), digest_size=12).hexdigest()
+    return f'W/"{digest}"'
+
+
+def etag_matches(etag: str, if_none_match: Optional[str]) -> bool:
+    """
+    Check an If-None-Match header against an ETag, using weak comparison.
+
+    :param etag: the current ETag of the representation
+    :param if_none_match: the header, if the client sent one
+    """
+
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(","))
+
+
+def cache_headers(etag: str) -> dict[str, str]:
+    # responses depend on who asks, and must be revalidated before reuse
+    return {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers=cache_headers(etag))
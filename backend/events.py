@@ -0,0 +1,138 @@
+import asyncio
+import threading
+from typing import Optional
+
+from backend.backplane import Backplane, InMemoryBackplane, backplane_from_env
+from backend.entities import ChatEvent
+
+default_queue_size = 256
+
+
+class Subscription:
+    """A subscriber's bounded queue of events for a single chat.
+
+    Must be created from inside a running event loop; events are handed to
+    that loop from whichever thread publishes them.
+    """
+
+    def __init__(self, hub: "EventHub", chat_id: int, queue_size: int):
+        self.hub = hub
+        self.chat_id = chat_id
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue[ChatEvent] = asyncio.Queue(queue_size)
+        self.dropped = False
+        self.last_seq = 0
+
+    async def get(self) -> Optional[ChatEvent]:
+        """
+        Wait for the next event.
+
+        :return: the next event, or None once the subscriber was dropped
+        """
+
+        if self.dropped:
+            return None
+        return await self.queue.get()
+
+    def _offer(self, event: ChatEvent):
+        # runs on self.loop, so it never races with get()
+        if self.dropped:
+            return
+        if event.seq is not None:
+            # replayed and live events can overlap right after subscribing
+            if event.seq <= self.last_seq:
+                return
+            self.last_seq = event.seq
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # a consumer this far behind gets disconnected instead of
+            # holding back the broadcaster or growing without bound
+            self.dropped = True
+            self.hub.unsubscribe(self)
+
+
+class EventHub:
+    """Fan-out of chat events to the subscribers of this process.
+
+    Events are published through a backplane, which assigns their sequence
+    numbers and delivers them back to the hub of every process.
+    """
+
+    def __init__(self, backplane: Optional[Backplane] = None, queue_size: int = default_queue_size):
+        self.backplane = backplane if backplane is not None else InMemoryBackplane()
+        self.backplane.deliver = self._deliver
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._subscribers: dict[int, set[Subscription]] = {}
+
+    def start(self):
+        self.backplane.start()
+
+    def stop(self):
+        self.backplane.stop()
+
+    def subscribe(self, chat_id: int, since: Optional[int] = None) -> Subscription:
+        """
+        Start receiving the events of a chat.
+
+        :param chat_id: id of the chat to follow
+        :param since: sequence number of the last event already seen; the
+            events after it are replayed, or a resync event is queued when
+            they are no longer available
+        :return: the new subscription
+        """
+
+        subscription = Subscription(self, chat_id, self.queue_size)
+        with self._lock:
+            self._subscribers.setdefault(chat_id, set()).add(subscription)
+        if since is None:
+            return subscription
+
+        subscription.last_seq = since
+        missed = self.backplane.replay(chat_id, since)
+        if missed is None or len(missed) >= self.queue_size:
+            subscription._offer(ChatEvent(type="resync", chat_id=chat_id))
+        else:
+            for event in missed:
+                subscription._offer(event)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        """
+        Stop delivering events to a subscription. Unknown subscriptions are ignored.
+
+        :param subscription: the subscription to be removed
+        """
+
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.chat_id)
+            if subscribers is None:
+                return
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscribers[subscription.chat_id]
+
+    def publish(self, event: ChatEvent):
+        """
+        Publish an event to the subscribers of its chat in every process.
+
+        Safe to call from any thread.
+
+        :param event: the event to be delivered
+        """
+
+        self.backplane.publish(event)
+
+    def _deliver(self, event: ChatEvent):
+        with self._lock:
+            subscribers = list(self._subscribers.get(event.chat_id, ()))
+        for subscription in subscribers:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription._offer, event)
+            except RuntimeError:
+                # the subscriber's event loop is already closed
+                self.unsubscribe(subscription)
+
+
+hub = EventHub(backplane_from_env())
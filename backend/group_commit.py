@@ -0,0 +1,241 @@
+"""Group commit of new messages.
+
+With PONY_GROUP_COMMIT=on, `POST /chats/{chat_id}/messages` hands its message
+to a single writer thread instead of committing on its own. The writer
+collects the messages that arrive within a few milliseconds into one
+transaction, so posters share a commit instead of queueing on the database
+lock for one each. Every request is answered once the transaction holding
+its message is committed.
+"""
+import asyncio
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Optional
+
+from fastapi import HTTPException
+from sqlalchemy import Connection, Engine
+from sqlmodel import Session
+
+from backend import database as db
+from backend import events
+from backend.config import env
+from backend.entities import ChatEvent, CreateMessage, Message, User
+
+group_commit_enabled = env("PONY_GROUP_COMMIT", "off") == "on"
+group_commit_max_batch = int(env("PONY_GROUP_COMMIT_MAX_BATCH", "256"))  # messages
+group_commit_max_delay = float(env("PONY_GROUP_COMMIT_MAX_DELAY_MS", "5")) / 1000  # seconds
+
+
+class NotChatMember(HTTPException):
+    def __init__(self):
+        super().__init__(
+            status_code=403,
+            detail={
+                "error": "no_permission",
+                "error_description": "requires permission to view chat",
+            },
+        )
+
+
+class WriterStopped(HTTPException):
+    def __init__(self):
+        super().__init__(
+            status_code=503,
+            detail={
+                "error": "temporarily_unavailable",
+                "error_description": "messages are not being written right now, retry shortly",
+            },
+            headers={"Retry-After": "1"},
+        )
+
+
+class _PendingMessage:
+    def __init__(self, chat_id: int, message: CreateMessage, user_id: int):
+        self.chat_id = chat_id
+        self.message = message
+        self.user_id = user_id
+        self.future: Future = Future()
+
+
+class GroupCommitStats:
+    """Batch sizes and commit latencies of a writer."""
+
+    def __init__(self, window: int = 1024):
+        self.batches = 0
+        self.messages = 0
+        self.max_batch_size = 0
+        self.commit_seconds = 0.0
+        self._lock = threading.Lock()
+        # (batch size, commit seconds) of the latest batches
+        self._recent: deque[tuple[int, float]] = deque(maxlen=window)
+
+    def record(self, size: int, seconds: float):
+        with self._lock:
+            self.batches += 1
+            self.messages += size
+            self.max_batch_size = max(self.max_batch_size, size)
+            self.commit_seconds += seconds
+            self._recent.append((size, seconds))
+
+    def snapshot(self) -> dict:
+        """
+        :return: totals since the start, and percentiles of the latest
+            batches
+        """
+
+        with self._lock:
+            recent = list(self._recent)
+            totals = {
+                "batches": self.batches,
+                "messages": self.messages,
+                "max_batch_size": self.max_batch_size,
+                "mean_batch_size": self.messages / self.batches if self.batches else 0.0,
+                "mean_commit_ms": self.commit_seconds / self.batches * 1000 if self.batches else 0.0,
+            }
+        sizes = sorted(size for size, _ in recent)
+        latencies = sorted(seconds for _, seconds in recent)
+        for name, values, scale in [("batch_size", sizes, 1), ("commit_ms", latencies, 1000)]:
+            for percentile in (50, 99):
+                key = f"p{percentile}_{name}"
+                totals[key] = values[min(len(values) * percentile // 100, len(values) - 1)] * scale if values else 0
+        return totals
+
+
+class GroupCommitWriter:
+    """A thread that writes new messages in batches sharing one commit.
+
+    A batch is written once `max_batch` messages are waiting or `max_delay`
+    seconds after its first message arrived, whichever comes first. When a
+    batch fails as a whole, its messages are retried one by one, so a bad
+    message only fails its own request.
+    """
+
+    def __init__(self, engine: Engine, max_batch: int, max_delay: float):
+        self.engine = engine
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.stats = GroupCommitStats()
+        self._queue: queue.Queue[Optional[_PendingMessage]] = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        # keeps messages from being queued behind the None that stops the thread
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the thread once the messages already submitted are written."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is None:
+                return
+            self._queue.put(None)
+        thread.join()
+
+    async def submit(self, chat_id: int, message: CreateMessage, user_id: int) -> Message:
+        """
+        Create a message in the next batch.
+
+        :param chat_id: id of the chat the message is posted in
+        :param message: attributes of the message to be created
+        :param user_id: id of the author of the message
+        :return: the new message, once it is committed
+        :raises KeyError: if the chat does not exist
+        :raises NotChatMember: if the author is not in the chat
+        :raises WriterStopped: if the writer is not running, since nothing
+            would ever write the message
+        """
+
+        pending = _PendingMessage(chat_id, message, user_id)
+        with self._lock:
+            if self._thread is None:
+                raise WriterStopped()
+            self._queue.put(pending)
+        return await asyncio.wrap_future(pending.future)
+
+    def _run(self):
+        # requests hold their pooled connections while they wait for their
+        # batch, so the writer cannot count on getting one from the pool
+        with self.engine.connect() as connection:
+            self._drain(connection)
+
+    def _drain(self, connection: Connection):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = time.monotonic() + self.max_delay
+            stopping = False
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                try:
+                    pending = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if pending is None:
+                    stopping = True
+                    break
+                batch.append(pending)
+            self._write(connection, batch)
+            if stopping:
+                return
+
+    def _write(self, connection: Connection, batch: list[_PendingMessage]):
+        started = time.perf_counter()
+        with Session(connection) as session:
+            try:
+                rows = db.stage_member_messages(session, [
+                    (pending.chat_id, pending.message.text, pending.user_id) for pending in batch
+                ])
+                # built before the commit expires the authors
+                authors: dict[int, User] = {}
+                messages = [
+                    None if row is None else Message(**row, user=User.from_db(db.get_cached_user(session, row["user_id"]), authors))
+                    for row in rows
+                ]
+                # worked out before the commit, so that a failure here still
+                # leaves the batch to be retried
+                errors = {
+                    index: self._rejection(session, pending.chat_id)
+                    for index, (pending, message) in enumerate(zip(batch, messages))
+                    if message is None
+                }
+                session.commit()
+            except Exception as e:
+                session.rollback()
+                if len(batch) == 1:
+                    batch[0].future.set_exception(e)
+                    return
+                for pending in batch:
+                    self._write(connection, [pending])
+                return
+        self.stats.record(sum(message is not None for message in messages), time.perf_counter() - started)
+
+        for index, (pending, message) in enumerate(zip(batch, messages)):
+            if message is None:
+                pending.future.set_exception(errors[index])
+                continue
+            events.hub.publish(ChatEvent(type="message_created", chat_id=message.chat_id, message=message))
+            pending.future.set_result(message)
+
+    @staticmethod
+    def _rejection(session: Session, chat_id: int) -> Exception:
+        """:return: the error of a message whose author is not in its chat, as `member_guard` would raise it"""
+        try:
+            db.get_chat_by_id(session, chat_id)
+        except KeyError as e:
+            return e
+        return NotChatMember()
+
+
+message_writer: Optional[GroupCommitWriter] = None
+if group_commit_enabled:
+    message_writer = GroupCommitWriter(db.engine, group_commit_max_batch, group_commit_max_delay)
@@ -0,0 +1,91 @@
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Optional
+
+from backend.config import env
+
+
+class IdGenerator(ABC):
+    """Chooses primary keys for new rows."""
+
+    @abstractmethod
+    def next_id(self) -> Optional[int]:
+        """
+        Get the id for a new row.
+
+        :return: the id, or None to let the database assign one
+        """
+
+
+class AutoIncrementIdGenerator(IdGenerator):
+    """Leaves ids to SQLite, which hands out increasing rowids.
+
+    The ids follow insertion order, not `created_at`: backdated imports get
+    the highest ids, and rows kept from the random ids of old versions are
+    scattered anywhere.
+    """
+
+    def next_id(self) -> Optional[int]:
+        return None
+
+
+class SnowflakeIdGenerator(IdGenerator):
+    """Time-ordered 64-bit ids that need no coordination between processes.
+
+    The ids are ordered by when they were generated, which is not
+    `created_at` for backdated imports, and rows kept from the random ids of
+    old versions fit nowhere in that order.
+
+    An id is the milliseconds since `epoch` (41 bits), the worker id
+    (10 bits) and a per-millisecond sequence (12 bits). Each process needs
+    its own worker id. The ids exceed 2**53, so JavaScript clients have to
+    handle them as strings or BigInts.
+    """
+
+    epoch = 1704067200000  # 2024-01-01T00:00:00Z in milliseconds
+    worker_bits = 10
+    sequence_bits = 12
+
+    def __init__(self, worker_id: int):
+        if not 0 <= worker_id < 1 << self.worker_bits:
+            raise ValueError(f"worker id must be below {1 << self.worker_bits}")
+        self.worker_id = worker_id
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._sequence = 0
+
+    def next_id(self) -> int:
+        with self._lock:
+            now = self._now_ms()
+            # never go back in time, even if the clock does
+            now = max(now, self._last_ms)
+            if now == self._last_ms:
+                self._sequence = (self._sequence + 1) & ((1 << self.sequence_bits) - 1)
+                if self._sequence == 0:
+                    # sequence exhausted for this millisecond
+                    while now <= self._last_ms:
+                        now = self._now_ms()
+            else:
+                self._sequence = 0
+            self._last_ms = now
+            return (
+                (now - self.epoch) << (self.worker_bits + self.sequence_bits)
+                | self.worker_id << self.sequence_bits
+                | self._sequence
+            )
+
+    @staticmethod
+    def _now_ms() -> int:
+        return time.time_ns() // 1_000_000
+
+
+def id_generator_from_env() -> IdGenerator:
+    """Build the generator selected by the PONY_ID_GENERATOR environment variable."""
+
+    kind = env("PONY_ID_GENERATOR", "autoincrement")
+    if kind == "autoincrement":
+        return AutoIncrementIdGenerator()
+    if kind == "snowflake":
+        return SnowflakeIdGenerator(int(env("PONY_WORKER_ID", "0")))
+    raise ValueError(f"unknown id generator: {kind}")
@@ -0,0 +1,229 @@
+"""Per-request accounting of SQL statements.
+
+Engines passed to `instrument_engine` time every statement they run and
+charge it to the request being served, which `QueryTimingMiddleware` sets
+up. Each response then carries its statement count and database time in a
+Server-Timing header, requests over the slow thresholds are logged with
+their slowest statement, and `route_stats` keeps histograms of every route,
+so an N+1 regression shows up as soon as the route runs.
+"""
+import bisect
+import logging
+import threading
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from sqlalchemy import Engine, event
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from backend.config import env
+
+logger = logging.getLogger(__name__)
+
+server_timing_enabled = env("PONY_SERVER_TIMING", "on") == "on"
+slow_request_ms = float(env("PONY_SLOW_REQUEST_MS", "500"))
+slow_request_statements = int(env("PONY_SLOW_REQUEST_STATEMENTS", "50"))
+# serves the route histograms at /debug/routes, and the other debug metrics
+# next to it; they tell anybody how the API is used, so they are off by
+# default
+route_stats_endpoint = env("PONY_ROUTE_STATS", "off") == "on"
+# upper bounds of the histogram buckets, the last one catches the rest
+duration_buckets_ms = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500]
+statement_buckets = [0, 1, 2, 3, 5, 10, 20, 50, 100]
+
+
+class RequestQueries:
+    """The statements run for one request."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.slowest_seconds = 0.0
+        self.slowest_statement: Optional[str] = None
+
+    def record(self, statement: str, seconds: float):
+        self.count += 1
+        self.seconds += seconds
+        if seconds > self.slowest_seconds:
+            self.slowest_seconds = seconds
+            self.slowest_statement = statement
+
+
+# the request being served; sync routes and dependencies run on a copy of
+# the context, which still points at the same RequestQueries
+_current: ContextVar[Optional[RequestQueries]] = ContextVar("request_queries", default=None)
+
+
+def current_queries() -> Optional[RequestQueries]:
+    """:return: the statements of the request being served, if any"""
+    return _current.get()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    queries = _current.get()
+    if queries is None:
+        return
+    started = conn.info.get("query_started")
+    if started:
+        queries.record(statement, time.perf_counter() - started.pop())
+
+
+def instrument_engine(engine: Engine):
+    """
+    Charge the statements an engine runs to the request being served.
+
+    :param engine: the engine, or the `sync_engine` of an async one
+    """
+
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+class _Histogram:
+    def __init__(self, bounds: list[float]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+
+    def add(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+
+    def snapshot(self) -> dict[str, int]:
+        labels = [f"le_{bound:g}" for bound in self.bounds] + ["inf"]
+        return dict(zip(labels, self.counts))
+
+
+class _RouteStats:
+    def __init__(self):
+        self.requests = 0
+        self.seconds = 0.0
+        self.db_seconds = 0.0
+        self.statements = 0
+        self.max_statements = 0
+        self.durations = _Histogram(duration_buckets_ms)
+        self.statement_counts = _Histogram(statement_buckets)
+
+    def add(self, seconds: float, queries: RequestQueries):
+        self.requests += 1
+        self.seconds += seconds
+        self.db_seconds += queries.seconds
+        self.statements += queries.count
+        self.max_statements = max(self.max_statements, queries.count)
+        self.durations.add(seconds * 1000)
+        self.statement_counts.add(queries.count)
+
+    def snapshot(self) -> dict:
+        return {
+            "requests": self.requests,
+            "mean_ms": self.seconds / self.requests * 1000,
+            "mean_db_ms": self.db_seconds / self.requests * 1000,
+            "mean_statements": self.statements / self.requests,
+            "max_statements": self.max_statements,
+            "duration_ms": self.durations.snapshot(),
+            "statements": self.statement_counts.snapshot(),
+        }
+
+
+class RouteStats:
+    """Durations and statement counts of requests, per route."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes: dict[str, _RouteStats] = {}
+
+    def record(self, route: str, seconds: float, queries: RequestQueries):
+        with self._lock:
+            stats = self._routes.get(route)
+            if stats is None:
+                stats = self._routes[route] = _RouteStats()
+            stats.add(seconds, queries)
+
+    def snapshot(self) -> dict[str, dict]:
+        """:return: the totals and histograms of every route seen so far"""
+        with self._lock:
+            return {route: stats.snapshot() for route, stats in sorted(self._routes.items())}
+
+    def clear(self):
+        with self._lock:
+            self._routes.clear()
+
+
+route_stats = RouteStats()
+
+
+def route_name(scope: Scope) -> str:
+    """:return: the method and path template of the route that served a request"""
+    route = scope.get("route")
+    return f"{scope['method']} {route.path if route is not None else '<unmatched>'}"
+
+
+class QueryTimingMiddleware:
+    """Accounts for the SQL statements of each request."""
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        server_timing: bool = server_timing_enabled,
+        slow_ms: float = slow_request_ms,
+        slow_statements: int = slow_request_statements,
+        stats: RouteStats = route_stats,
+    ):
+        self.app = app
+        self.server_timing = server_timing
+        self.slow_ms = slow_ms
+        self.slow_statements = slow_statements
+        self.stats = stats
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        queries = RequestQueries()
+        token = _current.set(queries)
+        started = time.perf_counter()
+        event_stream = False
+
+        async def send_with_timing(message: Message):
+            nonlocal event_stream
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(raw=message.setdefault("headers", []))
+                event_stream = headers.get("content-type", "").startswith("text/event-stream")
+                if self.server_timing:
+                    # statements run while a streamed body is sent come too
+                    # late for the header, but still count below
+                    elapsed = time.perf_counter() - started
+                    headers.append("Server-Timing", ", ".join([
+                        f'db;dur={queries.seconds * 1000:.2f};desc="{queries.count} statements"',
+                        f"db-slowest;dur={queries.slowest_seconds * 1000:.2f}",
+                        f"app;dur={elapsed * 1000:.2f}",
+                    ]))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current.reset(token)
+            # an event stream lasts as long as its client stays, which says
+            # nothing about the route
+            if not event_stream:
+                self._account(route_name(scope), time.perf_counter() - started, queries)
+
+    def _account(self, route: str, elapsed: float, queries: RequestQueries):
+        self.stats.record(route, elapsed, queries)
+        if elapsed * 1000 >= self.slow_ms or queries.count >= self.slow_statements:
+            logger.warning(
+                "slow request %s: %.1f ms, %d statements taking %.1f ms, slowest %.1f ms: %s",
+                route,
+                elapsed * 1000,
+                queries.count,
+                queries.seconds * 1000,
+                queries.slowest_seconds * 1000,
+                queries.slowest_statement,
+            )
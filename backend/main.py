@@ -2,18 +2,36 @@ from fastapi import FastAPI
 from fastapi.responses import HTMLResponse
 from fastapi.middleware.cors import CORSMiddleware
 
+from backend.routers.async_chats import async_chats_router
 from backend.routers.chats import chats_router
 from backend.routers.users import users_router
-from backend.auth import auth_router
-from backend.database import create_db_and_tables
+from backend.auth import auth_router, claims_cache, load_revocation_list, revocation_poller
+from backend.compression import CompressionMiddleware
+from backend.async_database import dispose_async_engine
+from backend.database import apply_app_profile, create_db_and_tables, database_mode, membership_cache, user_cache, user_count_cache
+from backend.events import hub
+from backend.group_commit import message_writer
+from backend.instrumentation import QueryTimingMiddleware, route_stats, route_stats_endpoint
 
 from contextlib import asynccontextmanager
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    apply_app_profile()
     create_db_and_tables()
+    load_revocation_list()
+    revocation_poller.start()
+    hub.start()
+    if message_writer is not None:
+        message_writer.start()
     yield
+    if message_writer is not None:
+        # answers the requests still waiting for their batch
+        message_writer.stop()
+    hub.stop()
+    revocation_poller.stop()
+    await dispose_async_engine()
 
 
 app = FastAPI(
@@ -24,10 +42,32 @@ app = FastAPI(
 )
 
 app.include_router(auth_router)
+if database_mode == "async":
+    app.include_router(async_chats_router)
 app.include_router(chats_router)
 app.include_router(users_router)
 
 
+if route_stats_endpoint:
+    @app.get("/debug/routes", include_in_schema=False)
+    def debug_routes() -> dict:
+        return route_stats.snapshot()
+
+    @app.get("/debug/caches", include_in_schema=False)
+    def debug_caches() -> dict:
+        return {
+            "claims": claims_cache.snapshot(),
+            "users": user_cache.snapshot(),
+            "user_counts": user_count_cache.snapshot(),
+            "memberships": membership_cache.snapshot(),
+        }
+
+    if message_writer is not None:
+        @app.get("/debug/group-commit", include_in_schema=False)
+        def debug_group_commit() -> dict:
+            return message_writer.stats.snapshot()
+
+
 @app.get("/", include_in_schema=False)
 def default() -> str:
     return HTMLResponse(
@@ -54,3 +94,6 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(CompressionMiddleware)
+# outermost, so its timings cover the whole app
+app.add_middleware(QueryTimingMiddleware)
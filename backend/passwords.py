@@ -0,0 +1,139 @@
+import asyncio
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, TypeVar
+
+from fastapi import HTTPException
+from passlib.context import CryptContext
+
+from backend.cache import TTLCache
+from backend.config import env
+
+T = TypeVar("T")
+
+bcrypt_rounds = int(env("PONY_BCRYPT_ROUNDS", "12"))
+# min_rounds makes hashes with fewer rounds count as outdated, so they are
+# upgraded the next time their user logs in
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=bcrypt_rounds,
+    bcrypt__min_rounds=bcrypt_rounds,
+)
+
+
+class HashingBusy(HTTPException):
+    def __init__(self):
+        super().__init__(
+            status_code=503,
+            detail={
+                "error": "temporarily_unavailable",
+                "error_description": "too many password checks in progress, retry shortly",
+            },
+            headers={"Retry-After": "1"},
+        )
+
+
+class TooManyAttempts(HTTPException):
+    def __init__(self, retry_after: int):
+        super().__init__(
+            status_code=429,
+            detail={
+                "error": "too_many_attempts",
+                "error_description": "too many failed logins, retry later",
+            },
+            headers={"Retry-After": str(retry_after)},
+        )
+
+
+class HashingPool:
+    """A few dedicated threads for bcrypt with a bounded backlog.
+
+    bcrypt releases the GIL while hashing, so threads are enough to keep it
+    off the event loop and out of the request threadpool. Work beyond
+    `workers + queue_limit` is refused instead of queued.
+    """
+
+    def __init__(self, workers: int, queue_limit: int):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self._slots = threading.BoundedSemaphore(workers + queue_limit)
+
+    async def run(self, fn: Callable[..., T], *args) -> T:
+        """
+        Run a function on the pool.
+
+        :raises HashingBusy: if the backlog is full
+        """
+
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy()
+        try:
+            return await asyncio.wrap_future(self._executor.submit(fn, *args))
+        finally:
+            self._slots.release()
+
+
+class LoginThrottle:
+    """Refuses logins for a username from a client address after repeated
+    failures.
+
+    Failures are counted per (username, address), so nobody can lock a
+    user out from elsewhere, in fixed windows that start with the first
+    failure; later failures do not extend them.
+    """
+
+    def __init__(self, max_failures: int, window: int):
+        self.max_failures = max_failures
+        self.window = window
+        self._lock = threading.Lock()
+        # (username, address) -> (end of the window, failures in it)
+        self._failures = TTLCache(maxsize=100_000, ttl=window)
+
+    def check(self, username: str, address: str):
+        """
+        :raises TooManyAttempts: if the username failed too often recently
+            from the address
+        """
+
+        window_end, failures = self._failures.get((username, address), (0.0, 0))
+        if failures >= self.max_failures:
+            raise TooManyAttempts(max(math.ceil(window_end - time.monotonic()), 1))
+
+    def failed(self, username: str, address: str):
+        key = (username, address)
+        with self._lock:
+            now = time.monotonic()
+            window_end, failures = self._failures.get(key, (now + self.window, 0))
+            self._failures.set(key, (window_end, failures + 1), ttl=window_end - now)
+
+    def succeeded(self, username: str, address: str):
+        with self._lock:
+            self._failures.pop((username, address))
+
+
+hashing_pool = HashingPool(
+    workers=int(env("PONY_HASH_WORKERS", "2")),
+    queue_limit=int(env("PONY_HASH_QUEUE_LIMIT", "32")),
+)
+login_throttle = LoginThrottle(
+    max_failures=int(env("PONY_LOGIN_MAX_FAILURES", "5")),
+    window=int(env("PONY_LOGIN_WINDOW", "300")),  # seconds
+)
+
+
+async def hash_password(password: str) -> str:
+    """Hash a password on the hashing pool."""
+    return await hashing_pool.run(pwd_context.hash, password)
+
+
+async def verify_password(password: str, hashed_password: str) -> tuple[bool, Optional[str]]:
+    """
+    Check a password on the hashing pool.
+
+    :return: whether the password matches, and a new hash to store when the
+        old one uses outdated parameters
+    """
+
+    return await hashing_pool.run(pwd_context.verify_and_update, password, hashed_password)
@@ -0,0 +1,37 @@
+from typing import Any, Mapping, Optional
+
+import orjson
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, BaseModel):
+        return value.model_dump(mode="json")
+    raise TypeError(f"cannot serialize {type(value).__name__}")
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON response serialized without FastAPI's `jsonable_encoder` pass.
+
+    Pydantic models are serialized by pydantic-core straight to bytes, and
+    anything else by orjson. The full speedup needs the route to return the
+    response itself; when a route returns plain content, FastAPI encodes it
+    first and only the final dump is faster.
+    """
+
+    def __init__(
+        self,
+        content: Any,
+        status_code: int = 200,
+        headers: Optional[Mapping[str, str]] = None,
+        exclude_none: bool = False,
+        **kwargs,
+    ):
+        self.exclude_none = exclude_none
+        super().__init__(content, status_code=status_code, headers=headers, **kwargs)
+
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, BaseModel):
+            return content.__pydantic_serializer__.to_json(content, exclude_none=self.exclude_none)
+        return orjson.dumps(content, default=_default)
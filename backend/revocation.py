@@ -0,0 +1,109 @@
+import logging
+import threading
+import time
+from typing import Callable, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class RevocationList:
+    """In-memory set of revoked access token ids.
+
+    Checked on every authenticated request, so it never touches the
+    database; it is filled from the revoked_tokens table at startup, kept
+    in step with it by whoever revokes a token in this process, and
+    catches up with the other processes through a `RevocationPoller`.
+    Entries are dropped once the token would have expired anyway.
+    """
+
+    prune_interval = 1024  # additions between sweeps of expired entries
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._expirations: dict[str, int] = {}
+        self._additions = 0
+        # rowid of the newest revoked_tokens row seen
+        self.last_seen = 0
+
+    def __contains__(self, jti: str) -> bool:
+        return jti in self._expirations
+
+    def __len__(self) -> int:
+        return len(self._expirations)
+
+    def add(self, jti: str, expires_at: int):
+        """
+        Revoke a token.
+
+        :param jti: id of the token
+        :param expires_at: unix timestamp at which the token expires
+        """
+
+        with self._lock:
+            self._expirations[jti] = expires_at
+            self._additions += 1
+            if self._additions % self.prune_interval == 0:
+                self._prune()
+
+    def load(self, entries: Iterable[tuple[str, int]], last_seen: int = 0):
+        """
+        Replace the contents of the list.
+
+        :param entries: (jti, expires_at) of every revoked token
+        :param last_seen: rowid of the newest of them
+        """
+
+        with self._lock:
+            self._expirations = dict(entries)
+            self.last_seen = last_seen
+            self._prune()
+
+    def catch_up(self, rows: Iterable[tuple[int, str, int]]):
+        """
+        Revoke the tokens of rows added since the last one seen.
+
+        :param rows: (rowid, jti, expires_at) of the new rows
+        """
+
+        for rowid, jti, expires_at in rows:
+            self.add(jti, expires_at)
+            with self._lock:
+                self.last_seen = max(self.last_seen, rowid)
+
+    def _prune(self):
+        now = int(time.time())
+        self._expirations = {
+            jti: expires_at for jti, expires_at in self._expirations.items() if expires_at > now
+        }
+
+
+class RevocationPoller:
+    """A thread that runs `refresh` every `interval` seconds, so tokens
+    revoked by other processes are refused here within that time."""
+
+    def __init__(self, refresh: Callable[[], None], interval: float):
+        self.refresh = refresh
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is not None or self.interval <= 0:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="revocation-poller", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("refreshing the revocation list failed")
@@ -0,0 +1,130 @@
+from typing import Annotated, Literal, Optional
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from sqlmodel.ext.asyncio.session import AsyncSession
+from backend.auth import get_current_user_async
+
+from backend.entities import (
+    ChatInDB,
+    ChatListMetadata,
+    ChatResponse,
+    CreateMessage,
+    Message,
+    MessageCollection,
+    UserChat,
+    UserChatCollection,
+    UserInDB,
+)
+from backend import async_database as adb
+from backend import group_commit
+from backend.etags import cache_headers, etag_matches, not_modified, weak_etag
+from backend.responses import FastJSONResponse
+from backend.routers.chats import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, message_page
+
+# Async versions of the hottest chat routes. When PONY_DB_MODE=async this
+# router is included ahead of chats_router, so these routes take precedence
+# and every other chat route keeps its sync implementation.
+async_chats_router = APIRouter(prefix="/chats", tags=["Chats"], default_response_class=FastJSONResponse)
+
+
+async def user_guard(session: AsyncSession, other_user: UserInDB, chat_id: int, include_messages: bool = False, include_users: bool = False) -> ChatInDB:
+    """Load a chat, requiring the user to be in it; see `db.get_chat_for_response` for the include flags."""
+    await member_guard(session, other_user, chat_id)
+    return await adb.get_chat_for_response(session, chat_id, include_messages, include_users)
+
+
+async def member_guard(session: AsyncSession, other_user: UserInDB, chat_id: int):
+    """Require the user to be in a chat, raising KeyError when there is no such chat."""
+    if not await adb.is_chat_member(session, chat_id, other_user.id):
+        # raises KeyError when the chat does not exist at all
+        await adb.get_chat_by_id(session, chat_id)
+        raise HTTPException(403, {
+                "error": "no_permission",
+                "error_description": "requires permission to view chat"
+        })
+
+
+async def chat_etag(session: AsyncSession, other_user: UserInDB, chat_id: int, *parts) -> str:
+    """Require the user to be in a chat, then build the ETag of a read of the chat from its version."""
+    await member_guard(session, other_user, chat_id)
+    return weak_etag(chat_id, await adb.get_chat_version(session, chat_id), *parts)
+
+
+@async_chats_router.get("", description="Gets the chats the current user is in with their unread counts and last messages, ordered by name or with the most recently active first, optionally a page at a time", response_model=UserChatCollection)
+async def get_chats(order: Literal["name", "activity"] = "name", cursor: Optional[str] = None, limit: Annotated[Optional[int], Query(ge=1, le=MAX_PAGE_SIZE)] = None, if_none_match: Annotated[Optional[str], Header()] = None, session: AsyncSession = Depends(adb.get_async_session), user: UserInDB = Depends(get_current_user_async)):
+    etag = weak_etag("chats", user.id, order, cursor, limit, await adb.get_user_chats_version(session, user.id))
+    if etag_matches(etag, if_none_match):
+        return not_modified(etag)
+    try:
+        rows, next_cursor = await adb.get_user_chats_with_reads(session, user.id, order, cursor, limit)
+    except ValueError:
+        raise HTTPException(422, {
+            "type": "invalid_cursor",
+            "entity_name": "Chat",
+            "entity_value": cursor
+        })
+    chats = UserChat.many_from_db(rows)
+
+    return FastJSONResponse(UserChatCollection(meta=ChatListMetadata(count=len(chats), next_cursor=next_cursor), chats=chats), headers=cache_headers(etag))
+
+
+@async_chats_router.get("/{chat_id}", description="Gets a chat with the given id, optionally including users, messages, or both", response_model=ChatResponse, response_model_exclude_none=True)
+async def get_chat(chat_id: int, include: Annotated[list[str], Query()] = [], if_none_match: Annotated[Optional[str], Header()] = None, session: AsyncSession = Depends(adb.get_async_session), user: UserInDB = Depends(get_current_user_async)):
+    try:
+        include_messages, include_users = "messages" in include, "users" in include
+        etag = await chat_etag(session, user, chat_id, "chat", include_messages, include_users)
+        if etag_matches(etag, if_none_match):
+            return not_modified(etag)
+        chat = await adb.get_chat_for_response(session, chat_id, include_messages, include_users)
+        return FastJSONResponse(ChatResponse.from_db(chat, include_messages, include_users), headers=cache_headers(etag), exclude_none=True)
+    except KeyError:
+        raise HTTPException(404, {
+            "detail": {
+                "type": "entity_not_found",
+                "entity_name": "Chat",
+                "entity_id": chat_id
+            }
+        })
+
+
+@async_chats_router.get("/{chat_id}/messages", description="Get a page of messages inside the chat with the given id, newest page first unless paging forward with `after`", response_model=MessageCollection)
+async def get_chat_messages(chat_id: int, before: Optional[str] = None, after: Optional[str] = None, limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = DEFAULT_PAGE_SIZE, if_none_match: Annotated[Optional[str], Header()] = None, session: AsyncSession = Depends(adb.get_async_session), user: UserInDB = Depends(get_current_user_async)):
+    try:
+        etag = await chat_etag(session, user, chat_id, "messages", before, after, limit)
+        if etag_matches(etag, if_none_match):
+            return not_modified(etag)
+        msgs, has_more = await adb.get_chat_messages(session, chat_id, before=before, after=after, limit=limit)
+    except KeyError:
+        raise HTTPException(404, {
+            "detail": {
+                "type": "entity_not_found",
+                "entity_name": "Chat",
+                "entity_id": chat_id
+            }
+        })
+    except ValueError:
+        raise HTTPException(422, {
+            "type": "invalid_cursor",
+            "entity_name": "Message",
+            "entity_value": before if before is not None else after
+        })
+
+    return FastJSONResponse(message_page(msgs, has_more, forward=after is not None and before is None), headers=cache_headers(etag))
+
+
+@async_chats_router.post("/{chat_id}/messages", description="Creates a new message in the given chat", status_code=201)
+async def create_chat_message(chat_id: int, message: CreateMessage, session: AsyncSession = Depends(adb.get_async_session), user: UserInDB = Depends(get_current_user_async)):
+    try:
+        writer = group_commit.message_writer
+        if writer is not None:
+            await member_guard(session, user, chat_id)
+            return {"message": await writer.submit(chat_id, message, user.id)}
+        await user_guard(session, user, chat_id)
+        return {"message": Message.from_db(await adb.create_message(session, chat_id, message, user))}
+    except KeyError:
+        raise HTTPException(404, {
+            "detail": {
+                "type": "entity_not_found",
+                "entity_name": "Chat",
+                "entity_id": chat_id
+            }
+        })
@@ -1,61 +1,107 @@
-from typing import Annotated
-from fastapi import APIRouter, Depends, HTTPException, Query
+import asyncio
+import json
+import zlib
+from typing import Annotated, AsyncIterator, Iterator, Literal, Optional
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.requests import HTTPConnection
+from fastapi.responses import StreamingResponse
+from pydantic import TypeAdapter, ValidationError
 from sqlmodel import Session
-from backend.auth import get_current_user
+from starlette.concurrency import run_in_threadpool
+from backend.auth import get_connection_user, get_current_user
 
 from backend.entities import (
+    BulkMessage,
+    BulkMessageResponse,
+    BulkMessageResult,
+    BulkMetadata,
     Chat,
-    ChatCollection,
     ChatInDB,
+    ChatListMetadata,
     ChatResponse,
     CreateMessage,
     Message,
     MessageCollection,
+    MessageInDB,
+    MessageMetadata,
+    MessageSearchHit,
+    MessageSearchResponse,
     UpdateChat,
+    MarkRead,
     Metadata,
+    ReadState,
     UpdateMessage,
     User,
+    UserChat,
+    UserChatCollection,
     UserCollection,
     UserInDB,
 )
 from backend import database as db
+from backend import group_commit
+from backend import events
+from backend.etags import cache_headers, etag_matches, not_modified, weak_etag
+from backend.responses import FastJSONResponse
 
-chats_router = APIRouter(prefix="/chats", tags=["Chats"])
+chats_router = APIRouter(prefix="/chats", tags=["Chats"], default_response_class=FastJSONResponse)
 
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+SSE_KEEPALIVE_INTERVAL = 15  # seconds
+BULK_CHUNK_SIZE = 1000  # messages per transaction of a bulk import
+EXPORT_CHUNK_SIZE = 64 * 1024  # bytes per chunk of an export
 
-def chat_has_user(chat: ChatInDB, other_user: UserInDB) -> bool:
-    for user in chat.users:
-        if user.id == other_user.id:
-            return True
-    return False
 
+def user_guard(session: Session, other_user: UserInDB, chat_id: int, include_messages: bool = False, include_users: bool = False) -> ChatInDB:
+    """Load a chat, requiring the user to be in it; see `db.get_chat_for_response` for the include flags."""
+    member_guard(session, other_user, chat_id)
+    return db.get_chat_for_response(session, chat_id, include_messages, include_users)
 
-def user_guard(session: Session, other_user: UserInDB, chat_id: int):
-    chat = db.get_chat_by_id(session, chat_id)
-    if chat_has_user(chat, other_user):
-        return
 
-    raise HTTPException(403, {
-            "error": "no_permission",
-            "error_description": "requires permission to view chat"
-    })
+def member_guard(session: Session, other_user: UserInDB, chat_id: int):
+    """Require the user to be in a chat, raising KeyError when there is no such chat."""
+    if not db.is_chat_member(session, chat_id, other_user.id):
+        # raises KeyError when the chat does not exist at all
+        db.get_chat_by_id(session, chat_id)
+        raise HTTPException(403, {
+                "error": "no_permission",
+                "error_description": "requires permission to view chat"
+        })
 
 
-@chats_router.get("", description="Gets all chats created under the Pony Express")
-def get_chats(session: Session = Depends(db.get_session), user: UserInDB = Depends(get_current_user)):
-    chats = db.get_all_chats(session)
-    chats = [Chat.from_db(chat) for chat in chats if chat_has_user(chat, user)]
-    chats.sort(key=lambda x: x.name)
+def chat_etag(session: Session, other_user: UserInDB, chat_id: int, *parts) -> str:
+    """Require the user to be in a chat, then build the ETag of a read of the chat from its version."""
+    member_guard(session, other_user, chat_id)
+    return weak_etag(chat_id, db.get_chat_version(session, chat_id), *parts)
 
-    return ChatCollection(meta=Metadata(count=len(chats)), chats=chats)
+
+@chats_router.get("", description="Gets the chats the current user is in with their unread counts and last messages, ordered by name or with the most recently active first, optionally a page at a time", response_model=UserChatCollection)
+def get_chats(order: Literal["name", "activity"] = "name", cursor: Optional[str] = None, limit: Annotated[Optional[int], Query(ge=1, le=MAX_PAGE_SIZE)] = None, if_none_match: Annotated[Optional[str], Header()] = None, session: Session = Depends(db.get_read_session), user: UserInDB = Depends(get_current_user)):
+    etag = weak_etag("chats", user.id, order, cursor, limit, db.get_user_chats_version(session, user.id))
+    if etag_matches(etag, if_none_match):
+        return not_modified(etag)
+    try:
+        rows, next_cursor = db.get_user_chats_with_reads(session, user.id, order, cursor, limit)
+    except ValueError:
+        raise HTTPException(422, {
+            "type": "invalid_cursor",
+            "entity_name": "Chat",
+            "entity_value": cursor
+        })
+    chats = UserChat.many_from_db(rows)
+
+    return FastJSONResponse(UserChatCollection(meta=ChatListMetadata(count=len(chats), next_cursor=next_cursor), chats=chats), headers=cache_headers(etag))
 
 
 @chats_router.get("/{chat_id}", description="Gets a chat with the given id, optionally including users, messages, or both", response_model=ChatResponse, response_model_exclude_none=True)
-def get_chat(chat_id: int, include: Annotated[list[str], Query()] = [], session: Session = Depends(db.get_session), user: UserInDB = Depends(get_current_user)):
+def get_chat(chat_id: int, include: Annotated[list[str], Query()] = [], if_none_match: Annotated[Optional[str], Header()] = None, session: Session = Depends(db.get_read_session), user: UserInDB = Depends(get_current_user)):
     try:
-        user_guard(session, user, chat_id)
-        chat = db.get_chat_by_id(session, chat_id)
-        return ChatResponse.from_db(chat, "messages" in include, "users" in include)
+        include_messages, include_users = "messages" in include, "users" in include
+        etag = chat_etag(session, user, chat_id, "chat", include_messages, include_users)
+        if etag_matches(etag, if_none_match):
+            return not_modified(etag)
+        chat = db.get_chat_for_response(session, chat_id, include_messages, include_users)
+        return FastJSONResponse(ChatResponse.from_db(chat, include_messages, include_users), headers=cache_headers(etag), exclude_none=True)
     except KeyError:
         raise HTTPException(404, {
             "detail": {
@@ -89,14 +135,13 @@ def update_chat(chat_id: int, update: UpdateChat, session: Session = Depends(db.
         })
 
 
-@chats_router.get("/{chat_id}/messages", description="Get all messages inside the chat with the given id")
-def get_chat_messages(chat_id: int, session: Session = Depends(db.get_session), user: UserInDB = Depends(get_current_user)):
+@chats_router.get("/{chat_id}/messages", description="Get a page of messages inside the chat with the given id, newest page first unless paging forward with `after`", response_model=MessageCollection)
+def get_chat_messages(chat_id: int, before: Optional[str] = None, after: Optional[str] = None, limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = DEFAULT_PAGE_SIZE, if_none_match: Annotated[Optional[str], Header()] = None, session: Session = Depends(db.get_read_session), user: UserInDB = Depends(get_current_user)):
     try:
-        user_guard(session, user, chat_id)
-        chat = db.get_chat_by_id(session, chat_id)
-        messages = [Message.from_db(msg) for msg in chat.messages]
-
-        return MessageCollection(meta=Metadata(count=len(messages)), messages=messages)
+        etag = chat_etag(session, user, chat_id, "messages", before, after, limit)
+        if etag_matches(etag, if_none_match):
+            return not_modified(etag)
+        msgs, has_more = db.get_chat_messages(session, chat_id, before=before, after=after, limit=limit)
     except KeyError:
         raise HTTPException(404, {
             "detail": {
@@ -105,17 +150,102 @@ def get_chat_messages(chat_id: int, session: Session = Depends(db.get_session),
                 "entity_id": chat_id
             }
         })
+    except ValueError:
+        raise HTTPException(422, {
+            "type": "invalid_cursor",
+            "entity_name": "Message",
+            "entity_value": before if before is not None else after
+        })
+
+    return FastJSONResponse(message_page(msgs, has_more, forward=after is not None and before is None), headers=cache_headers(etag))
+
+
+def message_page(msgs: list[MessageInDB], has_more: bool, forward: bool) -> MessageCollection:
+    next_cursor = None
+    if has_more and msgs:
+        # paging forward continues from the newest message, otherwise
+        # from the oldest one
+        next_cursor = db.encode_message_cursor(msgs[-1] if forward else msgs[0])
+    messages = Message.many_from_db(msgs)
 
+    return MessageCollection(meta=MessageMetadata(count=len(messages), next_cursor=next_cursor), messages=messages)
 
-@chats_router.get("/{chat_id}/users", description="Gets all users participating in the chat with the given id")
-def get_chat_users(chat_id: int, session: Session = Depends(db.get_session), user: UserInDB = Depends(get_current_user)):
+
+@chats_router.get("/messages/search", description="Search the messages of the chats the current user is in, or of one of them, best matches first", response_model=MessageSearchResponse)
+def search_messages(q: Annotated[str, Query(min_length=1)], chat_id: Optional[int] = None, cursor: Optional[str] = None, limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = DEFAULT_PAGE_SIZE, session: Session = Depends(db.get_read_session), user: UserInDB = Depends(get_current_user)):
+    try:
+        hits, next_cursor = db.search_messages(session, user.id, q, chat_id=chat_id, cursor=cursor, limit=limit)
+    except ValueError:
+        raise HTTPException(422, {
+            "type": "invalid_search",
+            "entity_name": "Message",
+            "entity_value": q if cursor is None else cursor
+        })
+
+    authors: dict[int, User] = {}
+    results = [MessageSearchHit(message=Message.from_db(msg, authors), snippet=snippet) for msg, snippet in hits]
+    return FastJSONResponse(MessageSearchResponse(meta=MessageMetadata(count=len(results), next_cursor=next_cursor), hits=results))
+
+
+@chats_router.get("/{chat_id}/export", description="Streams the whole history of the chat with the given id as NDJSON, oldest message first, optionally gzipped")
+def export_chat_messages(chat_id: int, format: Literal["ndjson", "gzip"] = "ndjson", session: Session = Depends(db.get_read_session), user: UserInDB = Depends(get_current_user)):
     try:
         user_guard(session, user, chat_id)
-        chat = db.get_chat_by_id(session, chat_id)
+    except KeyError:
+        raise HTTPException(404, {
+            "detail": {
+                "type": "entity_not_found",
+                "entity_name": "Chat",
+                "entity_id": chat_id
+            }
+        })
+
+    # the request's session is closed before the body is streamed, so the
+    # export reads through a session of its own on the same database
+    lines = export_lines(session.get_bind(), chat_id)
+    if format == "gzip":
+        return StreamingResponse(gzip_chunks(lines), media_type="application/gzip", headers={
+            "Content-Disposition": f'attachment; filename="chat-{chat_id}.ndjson.gz"'
+        })
+    return StreamingResponse(lines, media_type="application/x-ndjson", headers={
+        "Content-Disposition": f'attachment; filename="chat-{chat_id}.ndjson"'
+    })
+
+
+def export_lines(bind, chat_id: int) -> Iterator[bytes]:
+    """Serialize the messages of a chat as NDJSON, in chunks of about EXPORT_CHUNK_SIZE bytes."""
+    with Session(bind) as session:
+        buffer = bytearray()
+        for message in db.iter_chat_messages(session, chat_id):
+            buffer += message.model_dump_json().encode()
+            buffer += b"\n"
+            if len(buffer) >= EXPORT_CHUNK_SIZE:
+                yield bytes(buffer)
+                buffer.clear()
+        if buffer:
+            yield bytes(buffer)
+
+
+def gzip_chunks(chunks: Iterator[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)  # gzip container
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+@chats_router.get("/{chat_id}/users", description="Gets all users participating in the chat with the given id", response_model=UserCollection)
+def get_chat_users(chat_id: int, if_none_match: Annotated[Optional[str], Header()] = None, session: Session = Depends(db.get_read_session), user: UserInDB = Depends(get_current_user)):
+    try:
+        etag = chat_etag(session, user, chat_id, "users")
+        if etag_matches(etag, if_none_match):
+            return not_modified(etag)
+        chat = db.get_chat_for_response(session, chat_id, include_messages=False, include_users=True)
         users = [User(**user.model_dump()) for user in chat.users]
         users.sort(key=lambda x: x.id)
 
-        return UserCollection(meta=Metadata(count=len(users)), users=users)
+        return FastJSONResponse(UserCollection(meta=Metadata(count=len(users)), users=users), headers=cache_headers(etag))
     except KeyError:
         raise HTTPException(404, {
             "detail": {
@@ -126,11 +256,39 @@ def get_chat_users(chat_id: int, session: Session = Depends(db.get_session), use
         })
 
 
+@chats_router.put("/{chat_id}/read", description="Marks the chat with the given id as read up to a message, the latest one by default; read cursors only move forward", response_model=ReadState)
+def mark_chat_read(chat_id: int, read: Optional[MarkRead] = None, session: Session = Depends(db.get_session), user: UserInDB = Depends(get_current_user)):
+    try:
+        member_guard(session, user, chat_id)
+    except KeyError:
+        raise HTTPException(404, {
+            "detail": {
+                "type": "entity_not_found",
+                "entity_name": "Chat",
+                "entity_id": chat_id
+            }
+        })
+    message_id = read.message_id if read is not None else None
+    try:
+        return db.mark_chat_read(session, chat_id, user.id, message_id)
+    except KeyError:
+        raise HTTPException(404, {
+            "detail": {
+                "type": "entity_not_found",
+                "entity_name": "Message",
+                "entity_id": message_id
+            }
+        })
+
+
 @chats_router.post("/{chat_id}/messages", description="Creates a new message in the given chat", status_code=201)
-def create_chat_message(chat_id: int, message: CreateMessage, session: Session = Depends(db.get_session), user: UserInDB = Depends(get_current_user)):
+async def create_chat_message(chat_id: int, message: CreateMessage, session: Session = Depends(db.get_session), user: UserInDB = Depends(get_current_user)):
     try:
-        user_guard(session, user, chat_id)
-        return {"message": Message.from_db(db.create_message(session, chat_id, message, user))}
+        writer = group_commit.message_writer
+        if writer is None:
+            return {"message": await run_in_threadpool(_create_chat_message, session, user, chat_id, message)}
+        await run_in_threadpool(member_guard, session, user, chat_id)
+        return {"message": await writer.submit(chat_id, message, user.id)}
     except KeyError:
         raise HTTPException(404, {
             "detail": {
@@ -141,6 +299,82 @@ def create_chat_message(chat_id: int, message: CreateMessage, session: Session =
         })
 
 
+def _create_chat_message(session: Session, user: UserInDB, chat_id: int, message: CreateMessage) -> Message:
+    user_guard(session, user, chat_id)
+    return Message.from_db(db.create_message(session, chat_id, message, user))
+
+
+_bulk_schema = TypeAdapter(list[BulkMessage]).json_schema()
+
+
+@chats_router.post(
+    "/messages",
+    description="Creates messages in any number of chats the current user is in, from a JSON array or an NDJSON stream, and reports the outcome of each",
+    response_model=BulkMessageResponse,
+    openapi_extra={"requestBody": {"required": True, "content": {
+        "application/json": {"schema": _bulk_schema},
+        "application/x-ndjson": {"schema": _bulk_schema["items"]},
+    }}},
+)
+async def create_messages(request: Request, session: Session = Depends(db.get_session), user: UserInDB = Depends(get_current_user)):
+    results, chunk = [], []
+    async for index, message in bulk_messages(request):
+        if message is None:
+            results.append(BulkMessageResult(index=index, status=422, error="invalid_message"))
+            continue
+        chunk.append((index, message))
+        if len(chunk) == BULK_CHUNK_SIZE:
+            results.extend(await run_in_threadpool(db.create_messages, session, user, chunk))
+            chunk = []
+    if chunk:
+        results.extend(await run_in_threadpool(db.create_messages, session, user, chunk))
+
+    results.sort(key=lambda result: result.index)
+    created = sum(result.status == 201 for result in results)
+    return FastJSONResponse(BulkMessageResponse(meta=BulkMetadata(count=len(results), created=created), results=results))
+
+
+async def bulk_messages(request: Request) -> AsyncIterator[tuple[int, Optional[BulkMessage]]]:
+    """Parse the body of a bulk import, yielding None for each invalid message."""
+    if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+        # parsed as it arrives, so an import never has to fit in memory
+        index = 0
+        async for line in _lines(request.stream()):
+            if not line.strip():
+                continue
+            try:
+                yield index, BulkMessage.model_validate_json(line)
+            except ValidationError:
+                yield index, None
+            index += 1
+        return
+
+    try:
+        items = json.loads(await request.body())
+    except ValueError:
+        items = None
+    if not isinstance(items, list):
+        raise HTTPException(422, {
+            "type": "invalid_body",
+            "entity_name": "Message",
+            "error_description": "expected a JSON array or NDJSON"
+        })
+    for index, item in enumerate(items):
+        try:
+            yield index, BulkMessage.model_validate(item)
+        except ValidationError:
+            yield index, None
+
+
+async def _lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    buffer = b""
+    async for chunk in chunks:
+        *lines, buffer = (buffer + chunk).split(b"\n")
+        for line in lines:
+            yield line
+    yield buffer
+
+
 @chats_router.put("/{chat_id}/messages/{message_id}", description="Update the text of a message with the given messaage id and chat id")
 def update_message(chat_id: int, message_id: str, update: UpdateMessage, session: Session = Depends(db.get_session), user: UserInDB = Depends(get_current_user)):
     try:
@@ -185,3 +419,87 @@ def delete_message(chat_id: int, message_id: str, session: Session = Depends(db.
                 "entity_id": chat_id
             }
         })
+
+
+def events_guard(connection: HTTPConnection, chat_id: int):
+    """
+    Require the user of an event subscription to be in a chat, raising
+    KeyError when there is no such chat.
+
+    A session dependency would hold its pooled connection for as long as the
+    subscription stays open, so the checks get a session of their own.
+    """
+    with Session(db.engine) as session:
+        member_guard(session, get_connection_user(session, connection), chat_id)
+
+
+@chats_router.websocket("/{chat_id}/events")
+async def chat_events_websocket(websocket: WebSocket, chat_id: int, since: Optional[int] = None):
+    """Stream message events of the chat with the given id over a WebSocket, resuming after `since` if given."""
+    try:
+        await run_in_threadpool(events_guard, websocket, chat_id)
+    except (HTTPException, KeyError):
+        await websocket.close(code=1008)
+        return
+
+    await websocket.accept()
+    subscription = events.hub.subscribe(chat_id, since)
+
+    async def forward():
+        while (event := await subscription.get()) is not None:
+            await websocket.send_text(event.model_dump_json())
+        # dropped as a slow consumer; the client should reconnect and refetch
+        await websocket.close(code=1013)
+
+    async def drain():
+        # clients have nothing to say, but reading is how a disconnect is noticed
+        while True:
+            await websocket.receive_text()
+
+    tasks = [asyncio.create_task(forward()), asyncio.create_task(drain())]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        events.hub.unsubscribe(subscription)
+
+    for task in done:
+        error = task.exception()
+        if error is not None and not isinstance(error, WebSocketDisconnect):
+            raise error
+
+
+@chats_router.get("/{chat_id}/events", description="Stream message events of the chat with the given id as Server-Sent Events, resuming after `since` or Last-Event-ID if given")
+async def chat_events_stream(chat_id: int, request: Request, since: Optional[int] = None, last_event_id: Annotated[Optional[int], Header()] = None):
+    try:
+        await run_in_threadpool(events_guard, request, chat_id)
+    except KeyError:
+        raise HTTPException(404, {
+            "detail": {
+                "type": "entity_not_found",
+                "entity_name": "Chat",
+                "entity_id": chat_id
+            }
+        })
+
+    async def stream():
+        subscription = events.hub.subscribe(chat_id, since if since is not None else last_event_id)
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscription.get(), SSE_KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        return
+                    yield ": keepalive\n\n"
+                    continue
+                if event is None:
+                    return
+                if event.seq is not None:
+                    yield f"id: {event.seq}\n"
+                yield f"event: {event.type}\ndata: {event.model_dump_json()}\n\n"
+        finally:
+            events.hub.unsubscribe(subscription)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
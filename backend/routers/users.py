@@ -1,54 +1,77 @@
-from fastapi import APIRouter, Depends, HTTPException
+from typing import Annotated, Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response
 from sqlmodel import Session
 from backend.auth import get_current_user
 
 from backend.entities import (
     Chat,
     ChatCollection,
-    UserCollection,
     User,
     Metadata,
     UserInDB,
+    UserMetadata,
+    UserPage,
     UserUpdate,
 )
 from backend import database as db
+from backend.etags import cache_headers, etag_matches, not_modified, weak_etag
+from backend.responses import FastJSONResponse
+from backend.routers.chats import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
 
-users_router = APIRouter(prefix="/users", tags=["Users"])
+users_router = APIRouter(prefix="/users", tags=["Users"], default_response_class=FastJSONResponse)
 
 
-@users_router.get("", description="Get all users registered under the Pony Express")
-def get_users(session: Session = Depends(db.get_session)):
-    users = db.get_all_users(session)
+@users_router.get("", description="Get a page of the users registered under the Pony Express, ordered by id, optionally only those whose username starts with a prefix", response_model=UserPage)
+def get_users(username: Optional[str] = None, cursor: Optional[str] = None, limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = DEFAULT_PAGE_SIZE, session: Session = Depends(db.get_read_session)):
+    try:
+        users, next_cursor = db.get_users_page(session, username_prefix=username, cursor=cursor, limit=limit)
+    except ValueError:
+        raise HTTPException(422, {
+            "type": "invalid_cursor",
+            "entity_name": "User",
+            "entity_value": cursor
+        })
     users = [User.from_db(user) for user in users]
-    users.sort(key=lambda x: x.id)
+    # count is the number of matching users, not the size of the page
+    meta = UserMetadata(count=db.count_users(session, username), next_cursor=next_cursor)
 
-    return UserCollection(meta=Metadata(count=len(users)), users=users)
+    return FastJSONResponse(UserPage(meta=meta, users=users))
 
 
 @users_router.get("/me")
-def get_self(user: UserInDB = Depends(get_current_user)):
+def get_self(response: Response, if_none_match: Annotated[Optional[str], Header()] = None, user: UserInDB = Depends(get_current_user)):
     """Get current user."""
-    return {"user": User.from_db(user)}
+    current = User.from_db(user)
+    etag = weak_etag("me", current.model_dump_json())
+    if etag_matches(etag, if_none_match):
+        return not_modified(etag)
+    response.headers.update(cache_headers(etag))
+    return {"user": current}
 
 
 @users_router.put("/me")
 def update_self(update: UserUpdate, user: UserInDB = Depends(get_current_user), session: Session = Depends(db.get_session)):
     """Update the username or email of the current user."""
 
+    # comes detached from the read session of `get_current_user`
+    user = session.merge(user, load=False)
     if update.username is not None:
         user.username = update.username
     if update.email is not None:
         user.email = update.email
 
-    session.add(user)
+    # chats show their members and owner
+    db.touch_user_chats(session, user.id)
     session.commit()
+    db.invalidate_user(user.id)
     session.refresh(user)
 
     return {"user": User.from_db(user)}
 
 
 @users_router.get("/{user_id}", description="Gets the user with the given id")
-def get_user(user_id: str, session: Session = Depends(db.get_session)):
+def get_user(user_id: str, session: Session = Depends(db.get_read_session)):
     try:
         user = db.get_user_by_id(session, user_id)
         return {"user": User.from_db(user)}
@@ -62,17 +85,16 @@ def get_user(user_id: str, session: Session = Depends(db.get_session)):
         })
 
 
-@users_router.get("/{user_id}/chats", description="Gets the chats of the user with the given id")
-def get_user_chats(user_id: str, session: Session = Depends(db.get_session)):
+@users_router.get("/{user_id}/chats", description="Gets the chats of the user with the given id", response_model=ChatCollection)
+def get_user_chats(user_id: str, session: Session = Depends(db.get_read_session)):
     try:
         # User presence test
         db.get_user_by_id(session, user_id)
 
         chats = db.get_user_chats(session, user_id)
-        chats = [Chat.from_db(chat) for chat in chats]
-        chats.sort(key=lambda x: x.name)
+        chats = Chat.many_from_db(chats)
 
-        return ChatCollection(meta=Metadata(count=len(chats)), chats=chats)
+        return FastJSONResponse(ChatCollection(meta=Metadata(count=len(chats)), chats=chats))
 
     except KeyError:
         raise HTTPException(404, {
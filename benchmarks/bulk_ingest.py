@@ -0,0 +1,85 @@
+"""Throughput of bulk message imports into an on-disk SQLite database.
+
+Run with `python -m benchmarks.bulk_ingest`. Measures `database.create_messages`
+on its own and the NDJSON route end to end (in process, without a network),
+both with the production SQLite profile. The target is 50k messages/sec.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from fastapi.testclient import TestClient
+from sqlmodel import Session, SQLModel, create_engine
+
+from backend import database as db
+from backend.auth import _build_access_token
+from backend.entities import BulkMessage, ChatInDB, UserInDB
+from backend.main import app
+from backend.routers.chats import BULK_CHUNK_SIZE
+
+CHATS = 10
+
+
+def seed(engine) -> UserInDB:
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        user = UserInDB(username="importer", email="importer@example.com", hashed_password="x")
+        session.add_all(ChatInDB(name=f"chat {i}", owner=user, users=[user]) for i in range(CHATS))
+        session.commit()
+        session.refresh(user)
+        return user
+
+
+def measure_database(engine, user: UserInDB, count: int) -> float:
+    messages = [(i, BulkMessage(chat_id=i % CHATS + 1, text=f"message {i}")) for i in range(count)]
+    with Session(engine) as session:
+        user = session.merge(user)
+        start = time.perf_counter()
+        for offset in range(0, count, BULK_CHUNK_SIZE):
+            db.create_messages(session, user, messages[offset:offset + BULK_CHUNK_SIZE])
+        return time.perf_counter() - start
+
+
+def measure_route(engine, user: UserInDB, count: int) -> float:
+    body = "\n".join(json.dumps({"chat_id": i % CHATS + 1, "text": f"message {i}"}) for i in range(count))
+    headers = {
+        "Authorization": f"Bearer {_build_access_token(user).access_token}",
+        "Content-Type": "application/x-ndjson",
+    }
+
+    def get_session():
+        with Session(engine) as session:
+            yield session
+
+    app.dependency_overrides[db.get_session] = get_session
+    try:
+        client = TestClient(app)
+        start = time.perf_counter()
+        response = client.post("/chats/messages", headers=headers, content=body)
+        elapsed = time.perf_counter() - start
+        assert response.json()["meta"]["created"] == count
+        return elapsed
+    finally:
+        app.dependency_overrides.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=100_000)
+    args = parser.parse_args()
+
+    print(f"{'layer':>10} {'messages':>10} {'seconds':>10} {'msgs/sec':>10}")
+    for name, measure in [("database", measure_database), ("route", measure_route)]:
+        with tempfile.TemporaryDirectory() as directory:
+            engine = create_engine(f"sqlite:///{os.path.join(directory, 'bench.db')}")
+            db.apply_sqlite_profile(engine)
+            user = seed(engine)
+            elapsed = measure(engine, user, args.count)
+            engine.dispose()
+        print(f"{name:>10} {args.count:>10} {elapsed:>10.2f} {args.count / elapsed:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""Throughput and latency of the sync and async database modes.
+
+Run with `python -m benchmarks.db_modes`. For each mode a uvicorn server
+is started on a freshly seeded SQLite database, then many concurrent
+clients page through chat histories, with a share of them posting messages.
+"""
+import argparse
+import asyncio
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import httpx
+from sqlmodel import SQLModel, create_engine
+
+from backend.auth import _build_access_token
+from backend.entities import UserInDB
+
+
+def seed(path: str, users: int, chats: int, messages_per_chat: int):
+    engine = create_engine(f"sqlite:///{path}")
+    SQLModel.metadata.create_all(engine)
+    start = datetime(2024, 1, 1)
+    raw = engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        cursor.executemany(
+            "INSERT INTO users (id, username, email, hashed_password, created_at) VALUES (?, ?, ?, ?, ?)",
+            [(i, f"user{i}", f"user{i}@example.com", "x", start) for i in range(1, users + 1)],
+        )
+        cursor.executemany(
+            "INSERT INTO chats (id, name, owner_id, created_at, message_count, user_count) VALUES (?, ?, ?, ?, ?, ?)",
+            [(i, f"chat {i}", 1, start, messages_per_chat, users) for i in range(1, chats + 1)],
+        )
+        cursor.executemany(
+            "INSERT INTO user_chat_links (user_id, chat_id) VALUES (?, ?)",
+            [(u, c) for u in range(1, users + 1) for c in range(1, chats + 1)],
+        )
+        cursor.executemany(
+            "INSERT INTO messages (text, user_id, chat_id, created_at) VALUES (?, ?, ?, ?)",
+            [
+                (f"message {m}", m % users + 1, c, start + timedelta(seconds=m))
+                for c in range(1, chats + 1)
+                for m in range(messages_per_chat)
+            ],
+        )
+        raw.commit()
+    finally:
+        raw.close()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_until_up(base_url: str):
+    async with httpx.AsyncClient() as client:
+        for _ in range(100):
+            try:
+                await client.get(base_url + "/docs")
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+    raise RuntimeError("server did not start")
+
+
+async def drive(base_url: str, tokens: list[str], chats: int, concurrency: int, duration: float, write_ratio: float):
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        async def worker():
+            nonlocal errors
+            while time.perf_counter() < deadline:
+                headers = {"Authorization": f"Bearer {random.choice(tokens)}"}
+                chat_id = random.randint(1, chats)
+                start = time.perf_counter()
+                if random.random() < write_ratio:
+                    response = await client.post(f"/chats/{chat_id}/messages", json={"text": "load"}, headers=headers)
+                else:
+                    response = await client.get(f"/chats/{chat_id}/messages", headers=headers)
+                latencies.append(time.perf_counter() - start)
+                if response.status_code >= 400:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return latencies, errors, elapsed
+
+
+def run_mode(mode: str, args) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "pony.db")
+        seed(path, args.users, args.chats, args.messages)
+        port = free_port()
+        env = {**os.environ, "PONY_DB_MODE": mode, "PONY_DB_PATH": path}
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "backend.main:app", "--port", str(port), "--no-access-log", "--log-level", "warning"],
+            env=env,
+            stdout=subprocess.DEVNULL,
+        )
+        try:
+            base_url = f"http://127.0.0.1:{port}"
+            asyncio.run(wait_until_up(base_url))
+            tokens = [_build_access_token(UserInDB(id=i, username="", email="", hashed_password="")).access_token for i in range(1, args.users + 1)]
+            latencies, errors, elapsed = asyncio.run(drive(base_url, tokens, args.chats, args.concurrency, args.duration, args.write_ratio))
+        finally:
+            server.terminate()
+            server.wait()
+
+    latencies.sort()
+    return {
+        "mode": mode,
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": len(latencies) / elapsed,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--modes", nargs="+", default=["sync", "async"])
+    parser.add_argument("--concurrency", type=int, default=500)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--write-ratio", type=float, default=0.05)
+    args = parser.parse_args()
+
+    print(f"{'mode':>6} {'requests':>9} {'errors':>7} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for mode in args.modes:
+        r = run_mode(mode, args)
+        print(f"{r['mode']:>6} {r['requests']:>9} {r['errors']:>7} {r['rps']:>8.1f} {r['p50_ms']:>8.1f} {r['p99_ms']:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Message posting throughput with and without group commit.
+
+Run with `python -m benchmarks.group_commit`. Many concurrent clients post
+messages through the app in process (without a network) on an on-disk
+SQLite database with the production profile, first with a commit per
+request and then through a `GroupCommitWriter`, whose batch sizes and
+commit latencies are reported as well.
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+import httpx
+from sqlmodel import Session, create_engine
+
+from backend import database as db
+from backend import group_commit
+from backend.auth import _build_access_token
+from backend.entities import UserInDB
+from backend.group_commit import GroupCommitWriter
+from backend.main import app
+from benchmarks.db_modes import seed
+
+
+async def drive(tokens: list[str], chats: int, concurrency: int, duration: float):
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+    # failed requests count as errors instead of stopping the run
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+        async def poster():
+            nonlocal errors
+            while time.perf_counter() < deadline:
+                headers = {"Authorization": f"Bearer {random.choice(tokens)}"}
+                start = time.perf_counter()
+                response = await client.post(f"/chats/{random.randint(1, chats)}/messages", json={"text": "load"}, headers=headers)
+                latencies.append(time.perf_counter() - start)
+                if response.status_code != 201:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(poster() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return latencies, errors, elapsed
+
+
+def run(grouped: bool, args) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "pony.db")
+        seed(path, args.users, args.chats, messages_per_chat=0)
+        engine = create_engine(f"sqlite:///{path}", pool_size=db.pool_size, max_overflow=db.pool_overflow)
+        db.apply_sqlite_profile(engine)
+        db.membership_cache.clear()
+        db.user_cache.clear()
+
+        def get_session():
+            with Session(engine) as session:
+                yield session
+
+        app.dependency_overrides[db.get_session] = get_session
+        app.dependency_overrides[db.get_read_session] = get_session
+        writer = GroupCommitWriter(engine, args.max_batch, args.max_delay / 1000) if grouped else None
+        group_commit.message_writer = writer
+        if writer is not None:
+            writer.start()
+        try:
+            tokens = [_build_access_token(UserInDB(id=i, username="", email="", hashed_password="")).access_token for i in range(1, args.users + 1)]
+            latencies, errors, elapsed = asyncio.run(drive(tokens, args.chats, args.concurrency, args.duration))
+        finally:
+            if writer is not None:
+                writer.stop()
+            group_commit.message_writer = None
+            app.dependency_overrides.clear()
+            engine.dispose()
+
+    latencies.sort()
+    result = {
+        "mode": "grouped" if grouped else "single",
+        "messages": len(latencies) - errors,
+        "errors": errors,
+        "per_sec": (len(latencies) - errors) / elapsed,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+    if writer is not None:
+        result["stats"] = writer.stats.snapshot()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--max-batch", type=int, default=group_commit.group_commit_max_batch)
+    parser.add_argument("--max-delay", type=float, default=group_commit.group_commit_max_delay * 1000, help="milliseconds")
+    args = parser.parse_args()
+
+    print(f"{'mode':>8} {'messages':>9} {'errors':>7} {'msgs/sec':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    for grouped in (False, True):
+        r = run(grouped, args)
+        print(f"{r['mode']:>8} {r['messages']:>9} {r['errors']:>7} {r['per_sec']:>9.1f} {r['p50_ms']:>8.1f} {r['p99_ms']:>8.1f}")
+        if "stats" in r:
+            stats = r["stats"]
+            print(
+                f"{'':>8} batches {stats['batches']}, batch size mean {stats['mean_batch_size']:.1f}"
+                f" p50 {stats['p50_batch_size']} p99 {stats['p99_batch_size']} max {stats['max_batch_size']},"
+                f" commit ms mean {stats['mean_commit_ms']:.2f} p50 {stats['p50_commit_ms']:.2f} p99 {stats['p99_commit_ms']:.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
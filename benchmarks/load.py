@@ -0,0 +1,354 @@
+"""Load test of the API with a mix of the requests clients make.
+
+Run with `python -m benchmarks.load`. A SQLite database is seeded with
+users, chats, members and messages, where `--skew` makes a few chats much
+busier and more crowded than the rest (0 spreads everything evenly). Many
+concurrent clients then log in, list their chats, page through histories,
+post and search through the real app, in process. The run is reported as
+JSON: throughput, latency percentiles and SQL statements per request, for
+each kind of request and overall, along with the route histograms of
+`backend.instrumentation`.
+
+Save runs with `--output` and compare two of them, typically from two
+commits, with `--compare BASE HEAD`. The seed is fixed, so runs with the
+same options do the same work. Settings of the app, such as PONY_DB_MODE or
+PONY_GROUP_COMMIT, are read from the environment as usual.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import subprocess
+import tempfile
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+
+import httpx
+
+WORDS = ["pony", "express", "mail", "saddle", "trail", "relay", "station", "rider", "letter", "parcel"]
+PASSWORD = "load-test-password"
+DEFAULT_MIX = "login=1,chats=20,history=40,post=15,search=10,users=4,chat=10"
+
+
+@dataclass
+class Dataset:
+    users: int
+    # the chats each user is in
+    memberships: dict[int, list[int]]
+
+
+@dataclass
+class Client:
+    user_id: int
+    username: str
+    headers: dict[str, str]
+    chats: list[int]
+    rng: random.Random
+
+
+@dataclass
+class Samples:
+    latencies: list[float] = field(default_factory=list)
+    statements: list[int] = field(default_factory=list)
+    errors: int = 0
+
+
+def zipf_weights(n: int, skew: float) -> list[float]:
+    return [1 / rank ** skew for rank in range(1, n + 1)]
+
+
+def seed(path: str, args) -> Dataset:
+    """
+    Fill a new database with a reproducible data set.
+
+    Users join `--chats-per-user` chats each, and messages are spread over
+    the chats, both picking chats with Zipf weights of exponent `--skew`.
+    """
+
+    from sqlmodel import Session, SQLModel, create_engine
+
+    from backend import database as db
+    from backend.passwords import pwd_context
+
+    rng = random.Random(args.seed)
+    weights = zipf_weights(args.chats, args.skew)
+    chat_ids = list(range(1, args.chats + 1))
+    per_user = min(args.chats_per_user, args.chats)
+    memberships: dict[int, list[int]] = {}
+    members: dict[int, list[int]] = {chat_id: [] for chat_id in chat_ids}
+    for user_id in range(1, args.users + 1):
+        joined: set[int] = set()
+        while len(joined) < per_user:
+            joined.update(rng.choices(chat_ids, weights, k=per_user - len(joined)))
+        memberships[user_id] = sorted(joined)
+        for chat_id in joined:
+            members[chat_id].append(user_id)
+    for chat_id, chat_members in members.items():
+        if not chat_members:
+            # every chat has at least its owner in it
+            user_id = (chat_id - 1) % args.users + 1
+            chat_members.append(user_id)
+            memberships[user_id].append(chat_id)
+
+    start = datetime(2024, 1, 1)
+    messages = []
+    for m, chat_id in enumerate(rng.choices(chat_ids, weights, k=args.messages)):
+        text = " ".join(rng.choices(WORDS, k=rng.randint(3, 12)))
+        messages.append((text, rng.choice(members[chat_id]), chat_id, start + timedelta(seconds=m)))
+
+    engine = create_engine(f"sqlite:///{path}")
+    SQLModel.metadata.create_all(engine)
+    # one hash for everybody; hashing a password per user would take minutes
+    hashed_password = pwd_context.hash(PASSWORD)
+    raw = engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        cursor.executemany(
+            "INSERT INTO users (id, username, email, hashed_password, created_at) VALUES (?, ?, ?, ?, ?)",
+            [(i, f"user{i}", f"user{i}@example.com", hashed_password, start) for i in range(1, args.users + 1)],
+        )
+        cursor.executemany(
+            "INSERT INTO chats (id, name, owner_id, created_at) VALUES (?, ?, ?, ?)",
+            [(chat_id, f"chat {chat_id}", members[chat_id][0], start) for chat_id in chat_ids],
+        )
+        cursor.executemany(
+            "INSERT INTO user_chat_links (user_id, chat_id) VALUES (?, ?)",
+            [(user_id, chat_id) for chat_id, chat_members in members.items() for user_id in chat_members],
+        )
+        cursor.executemany("INSERT INTO messages (text, user_id, chat_id, created_at) VALUES (?, ?, ?, ?)", messages)
+        raw.commit()
+    finally:
+        raw.close()
+    with Session(engine) as session:
+        db.reconcile_chat_counters(session)
+    engine.dispose()
+    return Dataset(users=args.users, memberships=memberships)
+
+
+async def login(client: httpx.AsyncClient, user: Client) -> httpx.Response:
+    return await client.post("/auth/token", data={"username": user.username, "password": PASSWORD})
+
+
+async def list_chats(client: httpx.AsyncClient, user: Client) -> httpx.Response:
+    return await client.get("/chats", params={"order": "activity"}, headers=user.headers)
+
+
+async def read_history(client: httpx.AsyncClient, user: Client) -> httpx.Response:
+    return await client.get(f"/chats/{user.rng.choice(user.chats)}/messages", params={"limit": 50}, headers=user.headers)
+
+
+async def post_message(client: httpx.AsyncClient, user: Client) -> httpx.Response:
+    text = " ".join(user.rng.choices(WORDS, k=6))
+    return await client.post(f"/chats/{user.rng.choice(user.chats)}/messages", json={"text": text}, headers=user.headers)
+
+
+async def search(client: httpx.AsyncClient, user: Client) -> httpx.Response:
+    return await client.get("/chats/messages/search", params={"q": user.rng.choice(WORDS)}, headers=user.headers)
+
+
+async def list_users(client: httpx.AsyncClient, user: Client) -> httpx.Response:
+    return await client.get("/users", params={"username": f"user{user.rng.randint(1, 9)}"}, headers=user.headers)
+
+
+async def get_chat(client: httpx.AsyncClient, user: Client) -> httpx.Response:
+    return await client.get(f"/chats/{user.rng.choice(user.chats)}", params={"include": "users"}, headers=user.headers)
+
+
+operations: dict[str, Callable] = {
+    "login": login,
+    "chats": list_chats,
+    "history": read_history,
+    "post": post_message,
+    "search": search,
+    "users": list_users,
+    "chat": get_chat,
+}
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        if name.strip() not in operations:
+            raise SystemExit(f"unknown operation {name.strip()!r}, choose from {', '.join(operations)}")
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+
+def statement_count(response: httpx.Response) -> int:
+    """:return: the statement count of a response's Server-Timing header"""
+    match = re.search(r'(?:^|, )db;[^,]*desc="(\d+) statements"', response.headers.get("server-timing", ""))
+    return int(match.group(1)) if match else 0
+
+
+async def drive(app, dataset: Dataset, args) -> tuple[dict[str, Samples], float]:
+    from backend.auth import _build_access_token
+    from backend.entities import UserInDB
+    from backend.instrumentation import route_stats
+
+    weights = parse_mix(args.mix)
+    names, shares = list(weights), list(weights.values())
+    samples = {name: Samples() for name in names}
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://load", timeout=120) as client:
+        async def worker(index: int, deadline: float, record: bool):
+            rng = random.Random(args.seed * 1_000_003 + index)
+            user_id = rng.randint(1, dataset.users)
+            token = _build_access_token(UserInDB(id=user_id, username="", email="", hashed_password="")).access_token
+            user = Client(user_id, f"user{user_id}", {"Authorization": f"Bearer {token}"}, dataset.memberships[user_id], rng)
+            while time.perf_counter() < deadline:
+                name = rng.choices(names, shares)[0]
+                start = time.perf_counter()
+                response = await operations[name](client, user)
+                elapsed = time.perf_counter() - start
+                if not record:
+                    continue
+                sample = samples[name]
+                sample.latencies.append(elapsed)
+                sample.statements.append(statement_count(response))
+                if response.status_code >= 400:
+                    sample.errors += 1
+
+        if args.warmup > 0:
+            deadline = time.perf_counter() + args.warmup
+            await asyncio.gather(*(worker(i, deadline, False) for i in range(args.concurrency)))
+        route_stats.clear()
+        started = time.perf_counter()
+        deadline = started + args.duration
+        await asyncio.gather(*(worker(i, deadline, True) for i in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+    return samples, elapsed
+
+
+def percentile(values: list[float], p: float) -> float:
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return 0.0
+    return values[min(max(int(len(values) * p / 100 + 0.5) - 1, 0), len(values) - 1)]
+
+
+def summarize(sample: Samples, elapsed: float) -> dict:
+    latencies = sorted(sample.latencies)
+    requests = len(latencies)
+    return {
+        "requests": requests,
+        "errors": sample.errors,
+        "rps": round(requests / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "sql_per_request": round(sum(sample.statements) / requests, 2) if requests else 0.0,
+        "sql_max": max(sample.statements, default=0),
+    }
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "pony.db")
+        # the backend reads its settings when it is first imported
+        os.environ["PONY_DB_PATH"] = path
+        os.environ["PONY_SERVER_TIMING"] = "on"
+        dataset = seed(path, args)
+
+        from backend import database as db
+        from backend.instrumentation import route_stats
+        from backend.main import app
+
+        # every request is slow under this much load, which the results
+        # already tell
+        logging.getLogger("backend.instrumentation").setLevel(logging.ERROR)
+
+        async def serve():
+            async with app.router.lifespan_context(app):
+                return await drive(app, dataset, args)
+
+        try:
+            samples, elapsed = asyncio.run(serve())
+        finally:
+            db.engine.dispose()
+            db.read_engine.dispose()
+
+    total = Samples()
+    for sample in samples.values():
+        total.latencies += sample.latencies
+        total.statements += sample.statements
+        total.errors += sample.errors
+    return {
+        "revision": git_revision(),
+        "config": {
+            name: value
+            for name, value in vars(args).items()
+            if name not in ("output", "compare")
+        },
+        "env": {name: value for name, value in sorted(os.environ.items()) if name.startswith("PONY_") and name not in ("PONY_DB_PATH", "PONY_SERVER_TIMING")},
+        "elapsed_s": round(elapsed, 3),
+        "operations": {name: summarize(sample, elapsed) for name, sample in sorted(samples.items())},
+        "total": summarize(total, elapsed),
+        "routes": route_stats.snapshot(),
+    }
+
+
+def compare(base: dict, head: dict):
+    print(f"base {base.get('revision')}, head {head.get('revision')}")
+    if base.get("config") != head.get("config") or base.get("env") != head.get("env"):
+        print("warning: the runs were made with different options")
+    columns = [("rps", "req/s"), ("p50_ms", "p50 ms"), ("p95_ms", "p95 ms"), ("p99_ms", "p99 ms"), ("sql_per_request", "sql/req"), ("errors", "errors")]
+    print(f"{'operation':<10}" + "".join(f" {title:>24}" for _, title in columns))
+
+    def cell(old: float, new: float) -> str:
+        change = f"{(new - old) / old * 100:+.0f}%" if old else ""
+        return f"{old:>9g} {new:>9g} {change:>5}"
+
+    names = sorted(set(base["operations"]) | set(head["operations"]))
+    for name in [*names, "total"]:
+        old = base["total"] if name == "total" else base["operations"].get(name)
+        new = head["total"] if name == "total" else head["operations"].get(name)
+        if old is None or new is None:
+            print(f"{name:<10} only in {'head' if old is None else 'base'}")
+            continue
+        print(f"{name:<10}" + "".join(f" {cell(old[key], new[key])}" for key, _ in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--chats", type=int, default=100)
+    parser.add_argument("--chats-per-user", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=50_000)
+    parser.add_argument("--skew", type=float, default=1.0, help="Zipf exponent of chat popularity, 0 for uniform")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"relative weights of {', '.join(operations)}")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=20, help="seconds")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds left out of the results")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the results to this file as well")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "HEAD"), help="compare two saved results instead of running")
+    args = parser.parse_args()
+
+    if args.compare:
+        base, head = (json.load(open(path)) for path in args.compare)
+        compare(base, head)
+        return
+
+    result = json.dumps(run(args), indent=2)
+    print(result)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(result + "\n")
+
+
+if __name__ == "__main__":
+    main()
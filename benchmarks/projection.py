@@ -0,0 +1,67 @@
+"""Cost of projecting database rows into response models.
+
+Run with `python -m benchmarks.projection`. Compares building a page of
+`Message`s the way `from_db` used to (a `model_dump` round trip and a new
+`User` per message) with `Message.many_from_db`, which builds each distinct
+author once per response.
+"""
+import argparse
+import time
+from datetime import datetime, timedelta
+
+from backend.entities import Message, MessageInDB, User, UserInDB
+
+
+def build_rows(size: int, authors: int) -> list[MessageInDB]:
+    start = datetime(2024, 1, 1)
+    users = [
+        UserInDB(id=i, created_at=start, email=f"user{i}@example.com", username=f"user{i}", hashed_password="x")
+        for i in range(authors)
+    ]
+    return [
+        MessageInDB(
+            id=i,
+            chat_id=1,
+            user_id=i % authors,
+            user=users[i % authors],
+            created_at=start + timedelta(seconds=i),
+            text=f"message number {i} about ponies",
+        )
+        for i in range(size)
+    ]
+
+
+def previous(msgs: list[MessageInDB]) -> list[Message]:
+    return [
+        Message(id=msg.id, chat_id=msg.chat_id, created_at=msg.created_at, text=msg.text, user=User(**msg.user.model_dump()))
+        for msg in msgs
+    ]
+
+
+def timed(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 10_000])
+    parser.add_argument("--authors", type=int, nargs="+", default=[1, 10])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'messages':>9} {'authors':>8} {'method':>9} {'ms':>9} {'us/msg':>8}")
+    for size in args.sizes:
+        for authors in args.authors:
+            msgs = build_rows(size, authors)
+            for name, fn in [("previous", previous), ("projected", Message.many_from_db)]:
+                elapsed = timed(lambda: fn(msgs), args.repeat)
+                print(f"{size:>9} {authors:>8} {name:>9} {elapsed * 1000:>9.2f} {elapsed / size * 1e6:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
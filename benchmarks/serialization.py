@@ -0,0 +1,72 @@
+"""Serialization time and bytes on the wire of message pages.
+
+Run with `python -m benchmarks.serialization`. Compares FastAPI's default
+path (jsonable_encoder, then json.dumps) with FastJSONResponse, and the
+size and cost of each available compression of the result.
+"""
+import argparse
+import time
+from datetime import datetime, timedelta
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from backend.compression import compressors
+from backend.entities import Message, MessageCollection, MessageMetadata, User
+from backend.responses import FastJSONResponse
+
+
+def build_page(size: int) -> MessageCollection:
+    start = datetime(2024, 1, 1)
+    users = [
+        User(id=i, created_at=start, email=f"user{i}@example.com", username=f"user{i}")
+        for i in range(10)
+    ]
+    messages = [
+        Message(
+            id=i,
+            chat_id=1,
+            user=users[i % len(users)],
+            created_at=start + timedelta(seconds=i),
+            text=f"message number {i} about ponies, express delivery and other things",
+        )
+        for i in range(size)
+    ]
+    return MessageCollection(meta=MessageMetadata(count=size), messages=messages)
+
+
+def timed(fn, repeat: int):
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def compress(encoding: str, body: bytes, level: int) -> bytes:
+    compressor = compressors[encoding](level)
+    return compressor.compress(body) + compressor.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--level", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'messages':>9} {'method':>10} {'ms':>9} {'bytes':>11}")
+    for size in args.sizes:
+        page = build_page(size)
+        default_time, body = timed(lambda: JSONResponse(jsonable_encoder(page)).body, args.repeat)
+        print(f"{size:>9} {'fastapi':>10} {default_time * 1000:>9.1f} {len(body):>11}")
+        fast_time, body = timed(lambda: FastJSONResponse(page).body, args.repeat)
+        print(f"{size:>9} {'fast':>10} {fast_time * 1000:>9.1f} {len(body):>11}")
+        for encoding in compressors:
+            elapsed, compressed = timed(lambda: compress(encoding, body, args.level), args.repeat)
+            print(f"{size:>9} {'+' + encoding:>10} {elapsed * 1000:>9.1f} {len(compressed):>11}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Latency of database.get_user_chats as the total number of chats grows.
+
+Run with `python -m benchmarks.user_chats`. The measured user is in a fixed
+number of chats, so the latency should stay flat across chat totals.
+"""
+import argparse
+import statistics
+import time
+from datetime import datetime
+
+from sqlmodel import Session, SQLModel, create_engine
+
+from backend import database as db
+
+MEMBER_OF = 20
+
+
+def seed(engine, chat_count: int):
+    SQLModel.metadata.create_all(engine)
+    now = datetime.now()
+    raw = engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        cursor.executemany(
+            "INSERT INTO users (id, username, email, hashed_password, created_at) VALUES (?, ?, ?, ?, ?)",
+            [(i, f"user{i}", f"user{i}@example.com", "x", now) for i in range(1, 101)],
+        )
+        cursor.executemany(
+            "INSERT INTO chats (id, name, owner_id, created_at) VALUES (?, ?, ?, ?)",
+            [(i, f"chat {i:06d}", i % 100 + 1, now) for i in range(1, chat_count + 1)],
+        )
+        # user 1 is in MEMBER_OF chats spread over the table, every chat has
+        # two other members
+        step = max(chat_count // MEMBER_OF, 1)
+        links = {(1, i) for i in range(1, chat_count + 1, step)}
+        links |= {(i % 99 + 2, i) for i in range(1, chat_count + 1)}
+        links |= {((i + 50) % 99 + 2, i) for i in range(1, chat_count + 1)}
+        cursor.executemany("INSERT INTO user_chat_links (user_id, chat_id) VALUES (?, ?)", sorted(links))
+        raw.commit()
+    finally:
+        raw.close()
+
+
+def measure(engine, repeat: int) -> list[float]:
+    timings = []
+    with Session(engine) as session:
+        for _ in range(repeat):
+            session.expunge_all()
+            start = time.perf_counter()
+            chats = db.get_user_chats(session, 1)
+            [chat.owner.username for chat in chats]
+            timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1_000, 10_000, 100_000])
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{'chats':>10} {'median ms':>10} {'p95 ms':>10}")
+    for size in args.sizes:
+        engine = create_engine("sqlite://")
+        seed(engine, size)
+        timings = sorted(measure(engine, args.repeat))
+        median = statistics.median(timings) * 1000
+        p95 = timings[int(len(timings) * 0.95) - 1] * 1000
+        print(f"{size:>10} {median:>10.3f} {p95:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -34,6 +34,8 @@ function ChatPreview({ chat }) {
     return (
         <Link className="chat-preview" to={`/chats/${chat.id}`}>
             <div className="font-bold">{chat.name}</div>
+            {chat.unread_count > 0 && <div className="font-bold">{chat.unread_count} unread</div>}
+            {chat.last_message && <div className="font-lighter">{chat.last_message.user.username}: {chat.last_message.text}</div>}
             <div className="font-lighter">Created at: {formatMe(chat.created_at)}</div>
         </Link>
     );
@@ -55,7 +57,7 @@ function Chats() {
     const { data, isLoading, error } = useQuery({
         queryKey: ["chats"],
         queryFn: () => (
-            fetch(`${import.meta.env.VITE_REACT_APP_BACKEND}/chats`, {headers: { "Authorization": "Bearer " + getToken()}})
+            fetch(`${import.meta.env.VITE_REACT_APP_BACKEND}/chats?order=activity`, {headers: { "Authorization": "Bearer " + getToken()}})
                 .then((response) => {
                     if (!response.ok) {
                         response.status === 404 ?
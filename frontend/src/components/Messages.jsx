@@ -1,5 +1,5 @@
-import { useQuery } from "react-query";
-import { useState } from "react";
+import { useQuery, useQueryClient } from "react-query";
+import { useEffect, useState } from "react";
 import { Navigate, useNavigate } from "react-router-dom";
 import FormInput from "./FormInput";
 import { getToken } from "../context/auth";
@@ -81,7 +81,12 @@ function MessagesList({ messages, setMessages, chatId }) {
 
 function Messages({ chatId }) {
     const navigate = useNavigate();
+    const queryClient = useQueryClient();
     const [messages, setMessages] = useState(null);
+    // cursor of the page before the oldest message shown, null once the
+    // history is exhausted
+    const [olderCursor, setOlderCursor] = useState(null);
+    const [loadingOlder, setLoadingOlder] = useState(false);
 
     const { isLoading, error } = useQuery({
         queryKey: ["chats", chatId],
@@ -94,12 +99,88 @@ function Messages({ chatId }) {
                             navigate("/error");
                     }
                     response.json().then((data) => {
+                        // the latest page only; older ones are loaded on demand
                         setMessages(data.messages);
+                        setOlderCursor(data.meta.next_cursor);
+                        // opening the chat reads it up to the latest message
+                        fetch(`${import.meta.env.VITE_REACT_APP_BACKEND}/chats/${chatId}/read`, { method: "PUT", headers: { "Authorization": "Bearer " + getToken() } });
                     });
                 })
         ),
     });
 
+    useEffect(() => {
+        const backend = import.meta.env.VITE_REACT_APP_BACKEND.replace(/^http/, "ws");
+        let socket = null;
+        let lastSeq = null;
+        let reconnect = null;
+        let closing = false;
+
+        const connect = () => {
+            const since = lastSeq === null ? "" : `&since=${lastSeq}`;
+            socket = new WebSocket(`${backend}/chats/${chatId}/events?access_token=${getToken()}${since}`);
+            socket.onmessage = (e) => {
+                const event = JSON.parse(e.data);
+                if (event.seq !== null && event.seq !== undefined) {
+                    lastSeq = event.seq;
+                }
+                if (event.type === "resync") {
+                    // too much changed to be sent event by event, so start over
+                    queryClient.invalidateQueries(["chats", chatId]);
+                    return;
+                }
+                if (!["message_created", "message_updated", "message_deleted"].includes(event.type)) {
+                    return;
+                }
+                setMessages((current) => {
+                    if (current === null) {
+                        return current;
+                    }
+                    const others = current.filter((message) => message.id !== event.message.id);
+                    if (event.type === "message_deleted") {
+                        return others;
+                    }
+                    if (event.type === "message_updated") {
+                        return current.map((message) => message.id === event.message.id ? event.message : message);
+                    }
+                    return [...others, event.message];
+                });
+            };
+            socket.onclose = (e) => {
+                // 1013: dropped for falling behind; the events missed since
+                // are replayed, or a resync is sent when too many were missed
+                if (!closing && e.code === 1013) {
+                    reconnect = setTimeout(connect, 1000);
+                }
+            };
+        };
+
+        connect();
+        return () => {
+            closing = true;
+            clearTimeout(reconnect);
+            socket.close();
+        };
+    }, [chatId, queryClient]);
+
+    const loadOlder = () => {
+        setLoadingOlder(true);
+        fetch(`${import.meta.env.VITE_REACT_APP_BACKEND}/chats/${chatId}/messages?before=${encodeURIComponent(olderCursor)}`, { headers: { "Authorization": "Bearer " + getToken() } })
+            .then((response) => {
+                if (!response.ok) {
+                    navigate("/error");
+                }
+                response.json().then((data) => {
+                    setMessages((current) => {
+                        const shown = new Set(current.map((message) => message.id));
+                        return [...data.messages.filter((message) => !shown.has(message.id)), ...current];
+                    });
+                    setOlderCursor(data.meta.next_cursor);
+                    setLoadingOlder(false);
+                });
+            });
+    };
+
     if (error) {
         return <Navigate to="/error" />
     }
@@ -116,9 +197,8 @@ function Messages({ chatId }) {
                         navigate("/error/404") :
                         navigate("/error");
                 }
-                response.json().then((data) => {
-                    const message = data.message;
-                    messages.push(message);
+                response.json().then(() => {
+                    // the new message arrives over the chat's event socket
                     setText("");
                 });
             });
@@ -128,6 +208,11 @@ function Messages({ chatId }) {
         <div id="messages" className="w-full">
             <h1>Messages</h1>
             <div className="min-w-full">
+                {(!isLoading && messages && olderCursor) && (
+                    <button className="text-slate-300 mb-4" disabled={loadingOlder} onClick={loadOlder}>
+                        {loadingOlder ? "Loading..." : "Load older messages"}
+                    </button>
+                )}
                 {!isLoading && messages ? <MessagesList messages={messages} chatId={chatId} setMessages={setMessages} /> : <></>}
             </div>
             <form onSubmit={onSubmit} className="flex flex-row w-full gap-4 mb-8">
@@ -0,0 +1,211 @@
+import threading
+import time
+
+import pytest
+from jose import jwt
+from sqlalchemy import event
+from sqlmodel import select
+
+from backend import database as db
+from backend.auth import _build_access_token, claims_cache, jwt_alg, jwt_key, load_revocation_list, refresh_revocation_list, revocation_list
+from backend.entities import RevokedTokenInDB, UserInDB
+from backend.passwords import LoginThrottle, TooManyAttempts, login_throttle, pwd_context
+from tests.conftests import client, session  # noqa: F401
+
+
+def _login(session, username="newt"):
+    user = UserInDB(username=username, email=f"{username}@example.com", hashed_password="x")
+    session.add(user)
+    session.commit()
+    return {"Authorization": f"Bearer {_build_access_token(user).access_token}"}
+
+
+def test_authenticated_requests_hit_caches(client, session):
+    headers = _login(session)
+    assert client.get("/users/me", headers=headers).status_code == 200
+    claims_hits, user_hits = claims_cache.hits, db.user_cache.hits
+
+    response = client.get("/users/me", headers=headers)
+    assert response.status_code == 200
+    assert response.json()["user"]["username"] == "newt"
+    assert claims_cache.hits == claims_hits + 1
+    assert db.user_cache.hits == user_hits + 1
+
+
+def test_authentication_reads_through_the_read_pool(client, session):
+    headers = _login(session)
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = session.get_bind()
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        db.user_cache.clear()
+        assert client.get("/users/me", headers=headers).status_code == 200
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    assert statements == []
+
+
+def test_update_self_invalidates_cached_user(client, session):
+    headers = _login(session)
+    assert client.get("/users/me", headers=headers).status_code == 200
+
+    response = client.put("/users/me", json={"username": "rebecca"}, headers=headers)
+    assert response.status_code == 200
+    session.expunge_all()
+    response = client.get("/users/me", headers=headers)
+    assert response.json()["user"]["username"] == "rebecca"
+
+
+def test_deleted_user_is_rejected(client, session):
+    headers = _login(session)
+    assert client.get("/users/me", headers=headers).status_code == 200
+
+    db.delete_user(session, 1)
+    session.commit()
+    session.expunge_all()
+    assert client.get("/users/me", headers=headers).status_code == 401
+
+
+def test_login_is_throttled_after_repeated_failures(client, session):
+    client.post("/auth/registration", json={"username": "ginny", "email": "ginny@example.com", "password": "pass"})
+    for _ in range(login_throttle.max_failures):
+        response = client.post("/auth/token", data={"username": "ginny", "password": "wrong"})
+        assert response.status_code == 401
+
+    response = client.post("/auth/token", data={"username": "ginny", "password": "pass"})
+    assert response.status_code == 429
+    assert "Retry-After" in response.headers
+
+
+def test_login_throttle_is_per_address_and_fixed_window(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    throttle = LoginThrottle(max_failures=3, window=60)
+    for _ in range(3):
+        throttle.failed("ginny", "10.0.0.1")
+    with pytest.raises(TooManyAttempts):
+        throttle.check("ginny", "10.0.0.1")
+    # somebody else failing does not lock the user out elsewhere
+    throttle.check("ginny", "10.0.0.2")
+
+    # failures late in the window do not extend it
+    now[0] += 50
+    throttle.failed("ginny", "10.0.0.1")
+    now[0] += 11
+    throttle.check("ginny", "10.0.0.1")
+
+
+def test_login_throttle_counts_concurrent_failures():
+    throttle = LoginThrottle(max_failures=1000, window=60)
+    threads = [threading.Thread(target=lambda: [throttle.failed("ginny", "10.0.0.1") for _ in range(100)]) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert throttle._failures.get(("ginny", "10.0.0.1"))[1] == 800
+
+
+def test_login_upgrades_outdated_password_hash(client, session):
+    weak_hash = pwd_context.handler("bcrypt").using(rounds=4).hash("pass")
+    session.add(UserInDB(username="walter", email="walter@example.com", hashed_password=weak_hash))
+    session.commit()
+
+    response = client.post("/auth/token", data={"username": "walter", "password": "pass"})
+    assert response.status_code == 200
+    user = session.exec(select(UserInDB).where(UserInDB.username == "walter")).one()
+    assert user.hashed_password != weak_hash
+    assert pwd_context.verify("pass", user.hashed_password)
+    assert not pwd_context.needs_update(user.hashed_password)
+
+
+def _register_and_login(client, username):
+    client.post("/auth/registration", json={"username": username, "email": f"{username}@example.com", "password": "pass"})
+    response = client.post("/auth/token", data={"username": username, "password": "pass"})
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_refresh_token_rotates(client, session):
+    tokens = _register_and_login(client, "thomas")
+
+    response = client.post("/auth/refresh", json={"refresh_token": tokens["refresh_token"]})
+    assert response.status_code == 200
+    refreshed = response.json()
+    assert refreshed["refresh_token"] != tokens["refresh_token"]
+    headers = {"Authorization": f"Bearer {refreshed['access_token']}"}
+    assert client.get("/users/me", headers=headers).status_code == 200
+
+
+def test_reused_refresh_token_revokes_its_family(client, session):
+    tokens = _register_and_login(client, "margaret")
+    refreshed = client.post("/auth/refresh", json={"refresh_token": tokens["refresh_token"]}).json()
+
+    response = client.post("/auth/refresh", json={"refresh_token": tokens["refresh_token"]})
+    assert response.status_code == 401
+    headers = {"Authorization": f"Bearer {refreshed['access_token']}"}
+    assert client.get("/users/me", headers=headers).status_code == 401
+    response = client.post("/auth/refresh", json={"refresh_token": refreshed["refresh_token"]})
+    assert response.status_code == 401
+
+
+def test_logout_revokes_tokens(client, session):
+    tokens = _register_and_login(client, "wanda")
+    headers = {"Authorization": f"Bearer {tokens['access_token']}"}
+
+    assert client.post("/auth/logout", headers=headers).status_code == 204
+    response = client.get("/users/me", headers=headers)
+    assert response.status_code == 401
+    assert response.json()["detail"]["error_description"] == "revoked access token"
+    response = client.post("/auth/refresh", json={"refresh_token": tokens["refresh_token"]})
+    assert response.status_code == 401
+
+
+def test_tokens_without_an_id_are_still_accepted(client, session):
+    # issued before access tokens carried a jti
+    user = UserInDB(username="hudson", email="hudson@example.com", hashed_password="x")
+    session.add(user)
+    session.commit()
+    token = jwt.encode({"sub": str(user.id), "exp": int(time.time()) + 60}, key=jwt_key, algorithm=jwt_alg)
+    headers = {"Authorization": f"Bearer {token}"}
+
+    assert client.get("/users/me", headers=headers).status_code == 200
+    assert client.post("/auth/logout", headers=headers).status_code == 204
+    assert client.get("/users/me", headers=headers).status_code == 200
+
+
+def test_revocations_of_other_processes_are_picked_up(session, monkeypatch):
+    revocation_list.load([], 0)
+    future = int(time.time()) + 3600
+    # written by another worker, without touching this process's list
+    session.add(RevokedTokenInDB(jti="expired", expires_at=int(time.time()) - 1))
+    session.add(RevokedTokenInDB(jti="elsewhere", expires_at=future))
+    session.commit()
+    assert "elsewhere" not in revocation_list
+
+    refresh_revocation_list(session)
+    assert "elsewhere" in revocation_list
+    seen = revocation_list.last_seen
+
+    session.add(RevokedTokenInDB(jti="later", expires_at=future))
+    session.commit()
+    refresh_revocation_list(session)
+    assert "later" in revocation_list
+    assert revocation_list.last_seen > seen
+
+    # pruning at startup keeps the newest row, even when it has expired,
+    # so rowids never go back
+    session.add(RevokedTokenInDB(jti="newest", expires_at=int(time.time()) - 1))
+    session.commit()
+    monkeypatch.setattr(db, "engine", session.get_bind())
+    load_revocation_list()
+    session.expire_all()
+    remaining = session.exec(select(RevokedTokenInDB.jti)).all()
+    assert sorted(remaining) == ["elsewhere", "later", "newest"]
+    assert "elsewhere" in revocation_list
+    refresh_revocation_list(session)
+    assert "newest" not in revocation_list
+    revocation_list.load([], 0)
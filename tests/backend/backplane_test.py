@@ -0,0 +1,97 @@
+import sqlite3
+import threading
+import time
+
+from backend.backplane import InMemoryBackplane, SqliteBackplane
+from backend.entities import ChatEvent
+
+
+def _collect(backplane):
+    received = []
+    arrived = threading.Event()
+
+    def deliver(event):
+        received.append(event)
+        arrived.set()
+
+    backplane.deliver = deliver
+    return received, arrived
+
+
+def test_in_memory_sequence_and_replay():
+    backplane = InMemoryBackplane(history_size=3)
+    received, _ = _collect(backplane)
+    for _ in range(5):
+        backplane.publish(ChatEvent(type="message_created", chat_id=1))
+    backplane.publish(ChatEvent(type="message_created", chat_id=2))
+    assert [event.seq for event in received] == [1, 2, 3, 4, 5, 1]
+    assert [event.seq for event in backplane.replay(1, 3)] == [4, 5]
+    assert backplane.replay(1, 5) == []
+    # events 2 and 3 were already evicted from the history
+    assert backplane.replay(1, 1) is None
+    assert backplane.replay(1, 9) is None
+
+
+def test_sqlite_delivers_across_instances(tmp_path):
+    path = str(tmp_path / "events.db")
+    worker_a = SqliteBackplane(path, poll_interval=0.01)
+    worker_b = SqliteBackplane(path, poll_interval=0.01)
+    received_a, _ = _collect(worker_a)
+    received_b, arrived_b = _collect(worker_b)
+    worker_a.start()
+    worker_b.start()
+    try:
+        worker_a.publish(ChatEvent(type="message_created", chat_id=7))
+        worker_a.publish(ChatEvent(type="message_deleted", chat_id=7))
+        for _ in range(100):
+            if len(received_b) == 2:
+                break
+            arrived_b.wait(0.05)
+    finally:
+        worker_a.stop()
+        worker_b.stop()
+
+    assert [(event.type, event.seq) for event in received_b] == [("message_created", 1), ("message_deleted", 2)]
+    assert [event.seq for event in received_a] == [1, 2]
+    assert [event.seq for event in worker_b.replay(7, 1)] == [2]
+    assert worker_b.replay(7, 0)[0].type == "message_created"
+
+
+def test_sqlite_survives_a_locked_database(tmp_path, caplog):
+    path = str(tmp_path / "events.db")
+    backplane = SqliteBackplane(path, poll_interval=0.01, timeout=0.01, max_backoff=0.05)
+    received, arrived = _collect(backplane)
+    blocker = sqlite3.connect(path, isolation_level=None)
+    backplane.start()
+    try:
+        blocker.execute("BEGIN EXCLUSIVE")
+        backplane.publish(ChatEvent(type="message_created", chat_id=7))
+        # the write fails with "database is locked" while the lock is held
+        for _ in range(100):
+            if "database is locked" in caplog.text:
+                break
+            time.sleep(0.01)
+        assert "database is locked" in caplog.text
+        assert not received
+        blocker.execute("ROLLBACK")
+
+        backplane.publish(ChatEvent(type="message_deleted", chat_id=7))
+        for _ in range(100):
+            if len(received) == 2:
+                break
+            arrived.wait(0.05)
+        assert backplane._thread.is_alive()
+    finally:
+        blocker.close()
+        backplane.stop()
+
+    assert [(event.type, event.seq) for event in received] == [("message_created", 1), ("message_deleted", 2)]
+
+
+def test_sqlite_caps_pending_events(tmp_path, caplog):
+    backplane = SqliteBackplane(str(tmp_path / "events.db"), max_pending=3)
+    for chat_id in range(5):
+        backplane.publish(ChatEvent(type="message_created", chat_id=chat_id))
+
+    assert [event.chat_id for event in backplane._pending] == [2, 3, 4]
+    assert caplog.text.count("dropping the oldest pending events") == 1
@@ -0,0 +1,14 @@
+from backend.cache import TTLCache
+
+
+def test_snapshot_counts_hits_and_misses():
+    cache = TTLCache(maxsize=2, ttl=60)
+    assert cache.snapshot()["hit_rate"] == 0.0
+
+    cache.set("a", 1)
+    cache.get("a")
+    cache.get("b")
+    cache.set("b", 2)
+    cache.set("c", 3)
+    cache.get("c")
+    assert cache.snapshot() == {"size": 2, "maxsize": 2, "hits": 2, "misses": 1, "hit_rate": 2 / 3}
@@ -0,0 +1,73 @@
+import gzip
+
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from fastapi.testclient import TestClient
+
+from backend.compression import CompressionMiddleware, choose_encoding
+
+
+def _client():
+    app = FastAPI()
+    app.add_middleware(CompressionMiddleware, encodings="gzip", minimum_size=100)
+
+    @app.get("/small")
+    def small():
+        return {"text": "hi"}
+
+    @app.get("/large")
+    def large():
+        return {"text": "pony " * 1000}
+
+    @app.get("/stream")
+    def stream():
+        return StreamingResponse((b'{"n": %d}\n' % i for i in range(1000)), media_type="application/x-ndjson")
+
+    @app.get("/events")
+    def events():
+        return StreamingResponse(iter([b"data: x\n\n" * 100]), media_type="text/event-stream")
+
+    @app.get("/text")
+    def text():
+        return PlainTextResponse("pony " * 1000)
+
+    return TestClient(app)
+
+
+def test_choose_encoding():
+    assert choose_encoding("gzip, br;q=0.9", ["br", "gzip"]) == "br"
+    assert choose_encoding("gzip, br;q=0", ["br", "gzip"]) == "gzip"
+    assert choose_encoding("identity", ["br", "gzip"]) is None
+    assert choose_encoding("*", ["zstd", "gzip"]) == "zstd"
+
+
+def test_compresses_large_responses_only():
+    client = _client()
+    headers = {"Accept-Encoding": "gzip"}
+
+    response = client.get("/small", headers=headers)
+    assert "content-encoding" not in response.headers
+
+    response = client.get("/large", headers=headers)
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert int(response.headers["content-length"]) < 1000
+    assert response.json()["text"].startswith("pony pony")
+
+    response = client.get("/large", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in response.headers
+
+
+def test_compresses_streams_but_not_events():
+    client = _client()
+    headers = {"Accept-Encoding": "gzip"}
+
+    with client.stream("GET", "/stream", headers=headers) as response:
+        assert response.headers["content-encoding"] == "gzip"
+        body = gzip.decompress(b"".join(response.iter_raw()))
+    assert body.count(b"\n") == 1000
+
+    response = client.get("/events", headers=headers)
+    assert "content-encoding" not in response.headers
+    response = client.get("/text", headers=headers)
+    assert response.headers["content-encoding"] == "gzip"
@@ -0,0 +1,24 @@
+import pytest
+from sqlalchemy.exc import OperationalError
+from sqlmodel import SQLModel, create_engine, text
+
+from backend import database as db
+
+
+def test_sqlite_profile_is_applied(tmp_path):
+    path = tmp_path / "pony.db"
+    engine = create_engine(f"sqlite:///{path}")
+    read_engine = create_engine(f"sqlite:///{path}")
+    db.apply_sqlite_profile(engine)
+    db.apply_sqlite_profile(read_engine, read_only=True)
+    SQLModel.metadata.create_all(engine)
+
+    with engine.connect() as conn:
+        assert conn.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert conn.execute(text("PRAGMA synchronous")).scalar() == 1  # NORMAL
+        assert conn.execute(text("PRAGMA busy_timeout")).scalar() == 5000
+
+    with read_engine.connect() as conn:
+        assert conn.execute(text("SELECT COUNT(*) FROM users")).scalar() == 0
+        with pytest.raises(OperationalError):
+            conn.execute(text("INSERT INTO users (username, email, hashed_password) VALUES ('a', 'b', 'c')"))
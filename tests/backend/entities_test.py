@@ -0,0 +1,41 @@
+from datetime import datetime
+
+from backend.entities import ChatInDB, ChatResponse, Message, MessageInDB, UserInDB
+
+CREATED_AT = datetime(2024, 1, 1)
+
+
+def user_in_db(id: int) -> UserInDB:
+    return UserInDB(id=id, created_at=CREATED_AT, email=f"user{id}@example.com", username=f"user{id}", hashed_password="x")
+
+
+def test_messages_share_their_authors():
+    alice, bob = user_in_db(1), user_in_db(2)
+    msgs = [
+        MessageInDB(id=i, chat_id=1, user_id=author.id, user=author, created_at=CREATED_AT, text=f"message {i}")
+        for i, author in enumerate([alice, bob, alice, alice])
+    ]
+
+    messages = Message.many_from_db(msgs)
+
+    assert [message.user.username for message in messages] == ["user1", "user2", "user1", "user1"]
+    assert messages[0].user is messages[2].user is messages[3].user
+    assert messages[0].user is not messages[1].user
+    assert messages[0].model_dump() == {
+        "id": 0,
+        "chat_id": 1,
+        "user": {"id": 1, "created_at": CREATED_AT, "email": "user1@example.com", "username": "user1"},
+        "created_at": CREATED_AT,
+        "text": "message 0",
+    }
+
+
+def test_chat_response_shares_users_with_messages():
+    owner, member = user_in_db(1), user_in_db(2)
+    chat = ChatInDB(id=1, name="ponies", owner_id=owner.id, owner=owner, users=[owner, member], created_at=CREATED_AT)
+    chat.messages = [MessageInDB(id=1, chat_id=1, user_id=member.id, user=member, created_at=CREATED_AT, text="hi")]
+
+    response = ChatResponse.from_db(chat, include_messages=True, include_users=True)
+
+    assert response.chat.owner is response.users[0]
+    assert response.messages[0].user is response.users[1]
@@ -0,0 +1,56 @@
+import asyncio
+from datetime import datetime
+
+from backend.entities import ChatEvent, Message, User
+from backend.events import EventHub
+
+
+def _event(chat_id, text):
+    user = User(id=1, created_at=datetime.now(), email="newt@example.com", username="newt")
+    message = Message(id=1, chat_id=chat_id, user=user, created_at=datetime.now(), text=text)
+    return ChatEvent(type="message_created", chat_id=chat_id, message=message)
+
+
+def test_publish_only_reaches_chat_subscribers():
+    async def run():
+        hub = EventHub()
+        subscription = hub.subscribe(1)
+        other = hub.subscribe(2)
+        hub.publish(_event(1, "hello"))
+        event = await asyncio.wait_for(subscription.get(), 1)
+        assert event.message.text == "hello"
+        assert other.queue.empty()
+
+    asyncio.run(run())
+
+
+def test_slow_consumer_is_dropped():
+    async def run():
+        hub = EventHub(queue_size=2)
+        slow = hub.subscribe(1)
+        fast = hub.subscribe(1)
+        for i in range(3):
+            hub.publish(_event(1, f"msg {i}"))
+            assert (await asyncio.wait_for(fast.get(), 1)).message.text == f"msg {i}"
+        await asyncio.sleep(0)
+        assert slow.dropped
+        assert await slow.get() is None
+        hub.publish(_event(1, "after"))
+        assert (await asyncio.wait_for(fast.get(), 1)).message.text == "after"
+
+    asyncio.run(run())
+
+
+def test_subscribe_replays_missed_events():
+    async def run():
+        hub = EventHub()
+        for i in range(3):
+            hub.publish(_event(1, f"msg {i}"))
+        subscription = hub.subscribe(1, since=1)
+        assert (await subscription.get()).seq == 2
+        assert (await subscription.get()).seq == 3
+
+        behind = hub.subscribe(1, since=10)
+        assert (await behind.get()).type == "resync"
+
+    asyncio.run(run())
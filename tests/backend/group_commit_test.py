@@ -0,0 +1,169 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy.exc import OperationalError
+from sqlmodel import Session, SQLModel, create_engine, select
+
+from backend import database as db
+from backend import group_commit
+from backend.auth import _build_access_token
+from backend.entities import ChatInDB, CreateMessage, MessageInDB, UserInDB
+from backend.group_commit import GroupCommitWriter, NotChatMember, WriterStopped
+from backend.main import app
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'pony.db'}")
+    db.apply_sqlite_profile(engine)
+    SQLModel.metadata.create_all(engine)
+    db.membership_cache.clear()
+    db.user_cache.clear()
+    yield engine
+    engine.dispose()
+    # the ids are reused by the tests of other databases
+    db.membership_cache.clear()
+    db.user_cache.clear()
+
+
+def _seed(engine) -> tuple[int, list[int]]:
+    with Session(engine) as session:
+        users = [UserInDB(username=f"poster{i}", email=f"poster{i}@example.com", hashed_password="x") for i in range(5)]
+        chat = ChatInDB(name="busy", owner=users[0], users=users)
+        session.add(chat)
+        session.add(UserInDB(username="outsider", email="outsider@example.com", hashed_password="x"))
+        session.commit()
+        return chat.id, [user.id for user in users]
+
+
+def _outsider_id(engine) -> int:
+    with Session(engine) as session:
+        return session.exec(select(UserInDB.id).where(UserInDB.username == "outsider")).one()
+
+
+def test_writer_commits_concurrent_messages_in_batches(engine):
+    chat_id, user_ids = _seed(engine)
+    writer = GroupCommitWriter(engine, max_batch=16, max_delay=0.05)
+    writer.start()
+
+    async def post_all():
+        return await asyncio.gather(*(
+            writer.submit(chat_id, CreateMessage(text=f"message {i}"), user_ids[i % len(user_ids)])
+            for i in range(40)
+        ))
+
+    try:
+        messages = asyncio.run(post_all())
+    finally:
+        writer.stop()
+
+    assert len({message.id for message in messages}) == 40
+    assert [message.text for message in messages] == [f"message {i}" for i in range(40)]
+    stats = writer.stats.snapshot()
+    assert stats["messages"] == 40
+    assert stats["batches"] < 40
+    assert stats["max_batch_size"] <= 16
+    with Session(engine) as session:
+        chat = session.get(ChatInDB, chat_id)
+        assert chat.message_count == 40
+        assert chat.last_message_id == max(message.id for message in messages)
+
+
+def test_writer_fails_only_the_bad_message(engine):
+    chat_id, user_ids = _seed(engine)
+    writer = GroupCommitWriter(engine, max_batch=16, max_delay=0.05)
+    writer.start()
+
+    async def post_all():
+        return await asyncio.gather(
+            writer.submit(chat_id, CreateMessage(text="first"), user_ids[0]),
+            writer.submit(chat_id + 1, CreateMessage(text="lost"), user_ids[0]),
+            writer.submit(chat_id, CreateMessage(text="intruding"), _outsider_id(engine)),
+            writer.submit(chat_id, CreateMessage(text="second"), user_ids[1]),
+            return_exceptions=True,
+        )
+
+    try:
+        first, lost, intruding, second = asyncio.run(post_all())
+    finally:
+        writer.stop()
+
+    assert isinstance(lost, KeyError)
+    assert isinstance(intruding, NotChatMember)
+    assert (first.text, second.text) == ("first", "second")
+    with Session(engine) as session:
+        assert len(session.exec(select(MessageInDB)).all()) == 2
+
+
+def test_writer_does_not_rewrite_a_committed_batch(engine, monkeypatch):
+    chat_id, user_ids = _seed(engine)
+    outsider_id = _outsider_id(engine)
+    writer = GroupCommitWriter(engine, max_batch=16, max_delay=0.05)
+    writer.start()
+
+    def locked(session, chat_id):
+        raise OperationalError("SELECT", {}, Exception("database is locked"))
+
+    monkeypatch.setattr(db, "get_chat_by_id", locked)
+
+    async def post_all():
+        return await asyncio.gather(
+            writer.submit(chat_id, CreateMessage(text="ok"), user_ids[0]),
+            writer.submit(chat_id, CreateMessage(text="intruding"), outsider_id),
+            return_exceptions=True,
+        )
+
+    try:
+        ok, intruding = asyncio.run(post_all())
+    finally:
+        writer.stop()
+
+    assert ok.text == "ok"
+    assert isinstance(intruding, OperationalError)
+    with Session(engine) as session:
+        assert session.exec(select(MessageInDB.text)).all() == ["ok"]
+        assert session.get(ChatInDB, chat_id).message_count == 1
+
+
+def test_writer_refuses_messages_once_stopped(engine):
+    chat_id, user_ids = _seed(engine)
+    writer = GroupCommitWriter(engine, max_batch=16, max_delay=0.001)
+    writer.start()
+    message = asyncio.run(writer.submit(chat_id, CreateMessage(text="before"), user_ids[0]))
+    writer.stop()
+
+    assert message.text == "before"
+    with pytest.raises(WriterStopped):
+        asyncio.run(asyncio.wait_for(writer.submit(chat_id, CreateMessage(text="after"), user_ids[0]), timeout=5))
+
+
+def test_route_goes_through_the_writer(engine, monkeypatch):
+    chat_id, user_ids = _seed(engine)
+    with Session(engine) as session:
+        user = session.get(UserInDB, user_ids[0])
+        headers = {"Authorization": f"Bearer {_build_access_token(user).access_token}"}
+    writer = GroupCommitWriter(engine, max_batch=16, max_delay=0.001)
+    writer.start()
+    monkeypatch.setattr(group_commit, "message_writer", writer)
+
+    def get_session():
+        with Session(engine) as session:
+            yield session
+
+    app.dependency_overrides[db.get_session] = get_session
+    app.dependency_overrides[db.get_read_session] = get_session
+    try:
+        client = TestClient(app)
+        response = client.post(f"/chats/{chat_id}/messages", json={"text": "grouped"}, headers=headers)
+        assert response.status_code == 201
+        assert response.json()["message"]["text"] == "grouped"
+        assert client.post(f"/chats/{chat_id + 1}/messages", json={"text": "lost"}, headers=headers).status_code == 404
+        writer.stop()
+        response = client.post(f"/chats/{chat_id}/messages", json={"text": "too late"}, headers=headers)
+        assert response.status_code == 503
+        assert response.headers["retry-after"] == "1"
+    finally:
+        app.dependency_overrides.clear()
+        writer.stop()
+    assert writer.stats.snapshot()["messages"] == 1
@@ -0,0 +1,17 @@
+from backend.ids import SnowflakeIdGenerator
+
+
+def test_snowflake_ids_are_unique_and_ordered():
+    generator = SnowflakeIdGenerator(worker_id=3)
+    ids = [generator.next_id() for _ in range(10_000)]
+    assert ids == sorted(ids)
+    assert len(set(ids)) == len(ids)
+    assert all(id < 2**63 for id in ids)
+    assert all((id >> 12) & 0x3FF == 3 for id in ids)
+
+
+def test_snowflake_workers_do_not_collide():
+    first = SnowflakeIdGenerator(worker_id=1)
+    second = SnowflakeIdGenerator(worker_id=2)
+    ids = [generator.next_id() for _ in range(1000) for generator in (first, second)]
+    assert len(set(ids)) == len(ids)
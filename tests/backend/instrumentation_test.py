@@ -0,0 +1,76 @@
+import logging
+
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+
+from backend.instrumentation import QueryTimingMiddleware, RouteStats, instrument_engine
+
+
+def _client(stats: RouteStats, **kwargs):
+    engine = create_engine("sqlite://")
+    instrument_engine(engine)
+    app = FastAPI()
+    app.add_middleware(QueryTimingMiddleware, stats=stats, **kwargs)
+
+    @app.get("/items/{count}")
+    def items(count: int):
+        # a sync route runs in the threadpool, on a copy of the context
+        with engine.connect() as connection:
+            return [connection.execute(text("SELECT :n"), {"n": n}).scalar() for n in range(count)]
+
+    @app.get("/stream")
+    def stream():
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+        return StreamingResponse(iter([b"data: x\n\n"]), media_type="text/event-stream")
+
+    return TestClient(app)
+
+
+def test_counts_statements_per_request():
+    stats = RouteStats()
+    client = _client(stats)
+
+    response = client.get("/items/3")
+    assert response.json() == [0, 1, 2]
+    db, slowest, app = response.headers["server-timing"].split(", ")
+    assert db.startswith("db;dur=") and db.endswith('desc="3 statements"')
+    assert slowest.startswith("db-slowest;dur=")
+    assert app.startswith("app;dur=")
+    assert 'desc="1 statements"' in client.get("/items/1").headers["server-timing"]
+
+    routes = stats.snapshot()
+    assert list(routes) == ["GET /items/{count}"]
+    route = routes["GET /items/{count}"]
+    assert route["requests"] == 2
+    assert route["max_statements"] == 3
+    assert route["mean_statements"] == 2
+    assert route["statements"]["le_1"] == 1
+    assert route["statements"]["le_3"] == 1
+    assert sum(route["duration_ms"].values()) == 2
+
+
+def test_logs_slow_requests(caplog):
+    stats = RouteStats()
+    client = _client(stats, slow_ms=10_000, slow_statements=5)
+
+    with caplog.at_level(logging.WARNING, logger="backend.instrumentation"):
+        client.get("/items/4")
+        assert not caplog.records
+        client.get("/items/5")
+    assert len(caplog.records) == 1
+    assert "GET /items/{count}" in caplog.text
+    assert "5 statements" in caplog.text
+
+
+def test_event_streams_are_left_out(caplog):
+    stats = RouteStats()
+    client = _client(stats, slow_ms=0, server_timing=False)
+
+    with caplog.at_level(logging.WARNING, logger="backend.instrumentation"):
+        response = client.get("/stream")
+    assert "server-timing" not in response.headers
+    assert not caplog.records
+    assert stats.snapshot() == {}
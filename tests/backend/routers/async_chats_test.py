@@ -0,0 +1,73 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import Session, SQLModel, create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from backend import async_database as adb
+from backend import database as db
+from backend.auth import _build_access_token
+from backend.entities import ChatCollection, ChatInDB, MessageCollection, MessageInDB, UserInDB
+from backend.routers.async_chats import async_chats_router
+
+
+@pytest.fixture
+def seeded(tmp_path):
+    path = tmp_path / "pony.db"
+    engine = create_engine(f"sqlite:///{path}")
+    SQLModel.metadata.create_all(engine)
+    db.membership_cache.clear()
+    with Session(engine) as session:
+        user = UserInDB(username="ripley", email="ripley@example.com", hashed_password="x")
+        chat = ChatInDB(name="nostromo", owner=user, users=[user])
+        chat.messages = [MessageInDB(text=f"msg {i}", user=user) for i in range(5)]
+        session.add(chat)
+        session.commit()
+        db.reconcile_chat_counters(session)
+        token = _build_access_token(user).access_token
+        chat_id = chat.id
+
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+
+    async def _get_async_session_override():
+        async with AsyncSession(async_engine, expire_on_commit=False) as session:
+            yield session
+
+    app = FastAPI()
+    app.include_router(async_chats_router)
+    app.dependency_overrides[adb.get_async_session] = _get_async_session_override
+    yield TestClient(app), chat_id, {"Authorization": f"Bearer {token}"}
+
+
+def test_async_chat_routes(seeded):
+    client, chat_id, headers = seeded
+    response = client.get("/chats", headers=headers)
+    assert response.status_code == 200
+    assert [chat.name for chat in ChatCollection(**response.json()).chats] == ["nostromo"]
+
+    response = client.post(f"/chats/{chat_id}/messages", json={"text": "hello"}, headers=headers)
+    assert response.status_code == 201
+
+    response = client.get(f"/chats/{chat_id}/messages", params={"limit": 3}, headers=headers)
+    assert response.status_code == 200
+    page = MessageCollection(**response.json())
+    assert [msg.text for msg in page.messages] == ["msg 3", "msg 4", "hello"]
+    assert page.meta.next_cursor is not None
+
+    response = client.get(f"/chats/{chat_id}", params={"include": "users"}, headers=headers)
+    assert response.status_code == 200
+    assert response.json()["meta"] == {"message_count": 6, "user_count": 1}
+    assert [user["username"] for user in response.json()["users"]] == ["ripley"]
+
+    response = client.get(f"/chats/{chat_id + 1}", headers=headers)
+    assert response.status_code == 404
+
+
+def test_async_chat_conditional_get(seeded):
+    client, chat_id, headers = seeded
+    etag = client.get(f"/chats/{chat_id}", headers=headers).headers["ETag"]
+
+    assert client.get(f"/chats/{chat_id}", headers={**headers, "If-None-Match": etag}).status_code == 304
+    client.post(f"/chats/{chat_id}/messages", json={"text": "hello"}, headers=headers)
+    assert client.get(f"/chats/{chat_id}", headers={**headers, "If-None-Match": etag}).status_code == 200
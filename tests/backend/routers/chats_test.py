@@ -1,7 +1,63 @@
+import asyncio
+import gzip
+import json
+import os
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import WebSocketDisconnect
 from fastapi.testclient import TestClient
-from backend.entities import Chat, ChatCollection, MessageCollection, UserCollection
+from sqlalchemy import event
+from sqlmodel import Session, SQLModel, create_engine, select
+
+from backend import database as db
+from backend.auth import _build_access_token
+from backend.entities import Chat, ChatCollection, ChatInDB, CreateMessage, MessageCollection, MessageInDB, UserChatLinkInDB, UserCollection, UserInDB
 
 from backend.main import app
+from tests.conftests import client, session  # noqa: F401
+
+
+def _seed_chat(session, message_count):
+    user = UserInDB(username="ripley", email="ripley@example.com", hashed_password="x")
+    chat = ChatInDB(name="nostromo", owner=user, users=[user])
+    start = datetime(2024, 1, 1)
+    # pairs of messages share a timestamp so ties are broken by id
+    chat.messages = [
+        MessageInDB(text=f"msg {i}", user=user, created_at=start + timedelta(seconds=i // 2))
+        for i in range(message_count)
+    ]
+    session.add(chat)
+    session.commit()
+    db.reconcile_chat_counters(session)
+    token = _build_access_token(user).access_token
+    return chat.id, {"Authorization": f"Bearer {token}"}
+
+
+@pytest.fixture
+def query_count(session):
+    """Collects the SQL statements run against the test database."""
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engines = [session.get_bind(), session.info["read_engine"]]
+    for engine in engines:
+        event.listen(engine, "before_cursor_execute", record)
+    yield statements
+    for engine in engines:
+        event.remove(engine, "before_cursor_execute", record)
+
+
+def _seed_crowded_chat(session, owner, name, size):
+    authors = [UserInDB(username=f"{name}-{i}", email=f"{name}-{i}@example.com", hashed_password="x") for i in range(size)]
+    chat = ChatInDB(name=name, owner=owner, users=[owner, *authors])
+    chat.messages = [MessageInDB(text=f"hi from {author.username}", user=author) for author in authors]
+    session.add(chat)
+    session.commit()
+    db.reconcile_chat_counters(session)
+    return chat.id
 
 
 def test_get_all_chats():
@@ -83,3 +139,551 @@ def test_get_invalid_chat_messages():
     client = TestClient(app)
     response = client.get("/chats/jtere3443d/messages")
     assert response.status_code == 404
+
+
+def test_get_chat_messages_latest_page(client, session):
+    chat_id, headers = _seed_chat(session, 25)
+    response = client.get(f"/chats/{chat_id}/messages", params={"limit": 10}, headers=headers)
+    assert response.status_code == 200
+    messages = MessageCollection(**response.json())
+    assert messages.meta.count == 10
+    assert [msg.text for msg in messages.messages] == [f"msg {i}" for i in range(15, 25)]
+    assert messages.meta.next_cursor is not None
+
+
+def test_get_chat_messages_paging_backward(client, session):
+    chat_id, headers = _seed_chat(session, 25)
+    seen = []
+    params = {"limit": 10}
+    while True:
+        response = client.get(f"/chats/{chat_id}/messages", params=params, headers=headers)
+        assert response.status_code == 200
+        page = MessageCollection(**response.json())
+        seen = [msg.text for msg in page.messages] + seen
+        if page.meta.next_cursor is None:
+            break
+        params = {"limit": 10, "before": page.meta.next_cursor}
+    assert seen == [f"msg {i}" for i in range(25)]
+
+
+def test_get_chat_messages_paging_forward(client, session):
+    chat_id, headers = _seed_chat(session, 25)
+    oldest = session.exec(select(MessageInDB).where(MessageInDB.text == "msg 0")).one()
+    seen = ["msg 0"]
+    params = {"limit": 10, "after": db.encode_message_cursor(oldest)}
+    while True:
+        response = client.get(f"/chats/{chat_id}/messages", params=params, headers=headers)
+        assert response.status_code == 200
+        page = MessageCollection(**response.json())
+        seen += [msg.text for msg in page.messages]
+        if page.meta.next_cursor is None:
+            break
+        params = {"limit": 10, "after": page.meta.next_cursor}
+    assert seen == [f"msg {i}" for i in range(25)]
+
+
+def test_get_chat_messages_invalid_cursor(client, session):
+    chat_id, headers = _seed_chat(session, 3)
+    response = client.get(f"/chats/{chat_id}/messages", params={"before": "not-a-cursor"}, headers=headers)
+    assert response.status_code == 422
+
+
+def test_chat_events_websocket(client, session):
+    chat_id, headers = _seed_chat(session, 1)
+    token = headers["Authorization"].split(" ")[1]
+    with client.websocket_connect(f"/chats/{chat_id}/events?access_token={token}") as websocket:
+        response = client.post(f"/chats/{chat_id}/messages", json={"text": "hello"}, headers=headers)
+        assert response.status_code == 201
+        event = websocket.receive_json()
+        assert event["type"] == "message_created"
+        assert event["message"]["text"] == "hello"
+
+        message_id = response.json()["message"]["id"]
+        client.delete(f"/chats/{chat_id}/messages/{message_id}", headers=headers)
+        event = websocket.receive_json()
+        assert event["type"] == "message_deleted"
+        assert event["message"]["id"] == message_id
+
+
+def test_chat_events_websocket_requires_token(client, session):
+    chat_id, _ = _seed_chat(session, 1)
+    try:
+        with client.websocket_connect(f"/chats/{chat_id}/events"):
+            raise AssertionError("connection should have been refused")
+    except WebSocketDisconnect as e:
+        assert e.code == 1008
+
+
+def test_chat_events_stream_checks_the_subscriber(client, session):
+    chat_id, headers = _seed_chat(session, 1)
+    outsider = UserInDB(username="bishop", email="bishop@example.com", hashed_password="x")
+    session.add(outsider)
+    session.commit()
+    outsider_token = _build_access_token(outsider).access_token
+
+    assert client.get(f"/chats/{chat_id}/events").status_code == 401
+    response = client.get(f"/chats/{chat_id}/events", params={"access_token": outsider_token})
+    assert response.status_code == 403
+    assert client.get(f"/chats/{chat_id + 1}/events", headers=headers).status_code == 404
+
+
+def test_chat_events_websocket_releases_its_connection(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'pony.db'}", connect_args={"check_same_thread": False})
+    SQLModel.metadata.create_all(engine)
+    db.membership_cache.clear()
+    db.user_cache.clear()
+    monkeypatch.setattr(db, "engine", engine)
+    with Session(engine) as session:
+        chat_id, headers = _seed_chat(session, 1)
+    token = headers["Authorization"].split(" ")[1]
+
+    client = TestClient(app)
+    try:
+        with client.websocket_connect(f"/chats/{chat_id}/events?access_token={token}"):
+            with client.websocket_connect(f"/chats/{chat_id}/events?access_token={token}"):
+                # idle subscribers must not keep write connections checked out
+                assert engine.pool.checkedout() == 0
+    finally:
+        db.membership_cache.clear()
+        db.user_cache.clear()
+        engine.dispose()
+
+
+def test_get_chats_only_lists_member_chats_by_name(client, session):
+    _, headers = _seed_chat(session, 0)
+    ripley = session.exec(select(UserInDB).where(UserInDB.username == "ripley")).one()
+    other = UserInDB(username="bishop", email="bishop@example.com", hashed_password="x")
+    session.add_all([
+        ChatInDB(name="acheron", owner=other, users=[other, ripley]),
+        ChatInDB(name="sulaco", owner=other, users=[other]),
+    ])
+    session.commit()
+
+    response = client.get("/chats", headers=headers)
+    assert response.status_code == 200
+    chats = ChatCollection(**response.json())
+    assert [chat.name for chat in chats.chats] == ["acheron", "nostromo"]
+    assert chats.chats[0].owner.username == "bishop"
+
+
+def test_get_chat_query_count_is_constant(client, session, query_count):
+    _, headers = _seed_chat(session, 0)
+    owner = session.exec(select(UserInDB).where(UserInDB.username == "ripley")).one()
+    small = _seed_crowded_chat(session, owner, "small", 2)
+    large = _seed_crowded_chat(session, owner, "large", 40)
+    # warm the auth caches so every measured request sees the same state
+    client.get("/chats", headers=headers)
+
+    counts = []
+    for chat_id in (small, large):
+        session.expunge_all()
+        query_count.clear()
+        response = client.get(f"/chats/{chat_id}", params={"include": ["messages", "users"]}, headers=headers)
+        assert response.status_code == 200
+        counts.append(len(query_count))
+    assert counts[0] == counts[1]
+    assert len(response.json()["messages"]) == 40
+
+    for chat_id in (small, large):
+        session.expunge_all()
+        query_count.clear()
+        response = client.get(f"/chats/{chat_id}/messages", headers=headers)
+        assert response.status_code == 200
+        counts.append(len(query_count))
+    assert counts[2] == counts[3]
+
+
+def test_chat_guard_rejects_non_members(client, session):
+    chat_id, _ = _seed_chat(session, 1)
+    outsider = UserInDB(username="burke", email="burke@example.com", hashed_password="x")
+    session.add(outsider)
+    session.commit()
+    headers = {"Authorization": f"Bearer {_build_access_token(outsider).access_token}"}
+
+    response = client.get(f"/chats/{chat_id}/messages", headers=headers)
+    assert response.status_code == 403
+    response = client.get(f"/chats/{chat_id + 1}/messages", headers=headers)
+    assert response.status_code == 404
+
+
+def test_chat_counters_follow_messages(client, session):
+    chat_id, headers = _seed_chat(session, 3)
+    newcomer = UserInDB(username="hicks", email="hicks@example.com", hashed_password="x")
+    session.add(newcomer)
+    session.commit()
+
+    created = db.create_message(session, chat_id, CreateMessage(text="hello"), newcomer)
+    response = client.get(f"/chats/{chat_id}", headers=headers)
+    assert response.status_code == 200
+    assert response.json()["meta"] == {"message_count": 4, "user_count": 2}
+    assert "messages" not in response.json()
+
+    response = client.delete(f"/chats/{chat_id}/messages/{created.id}", headers={"Authorization": f"Bearer {_build_access_token(newcomer).access_token}"})
+    assert response.status_code == 204
+    chat = session.get(ChatInDB, chat_id)
+    assert (chat.message_count, chat.user_count) == (3, 2)
+    assert chat.last_message_at == datetime(2024, 1, 1, 0, 0, 1)
+
+
+def test_create_messages_in_bulk(client, session):
+    chat_id, headers = _seed_chat(session, 2)
+    other = ChatInDB(name="sulaco", owner=UserInDB(username="hicks", email="hicks@example.com", hashed_password="x"))
+    session.add(other)
+    session.commit()
+
+    response = client.post("/chats/messages", headers=headers, json=[
+        {"chat_id": chat_id, "text": "first"},
+        {"chat_id": other.id, "text": "not a member"},
+        {"chat_id": 999, "text": "no such chat"},
+        {"chat_id": chat_id},
+        {"chat_id": chat_id, "text": "old", "created_at": "2023-06-01T12:00:00"},
+    ])
+    assert response.status_code == 200
+    body = response.json()
+    assert body["meta"] == {"count": 5, "created": 2}
+    assert [result["status"] for result in body["results"]] == [201, 403, 404, 422, 201]
+
+    session.expire_all()
+    chat = session.get(ChatInDB, chat_id)
+    assert chat.message_count == 4
+    texts = [msg.text for msg in chat.messages]
+    assert texts[0] == "old" and texts[-1] == "first"
+    assert session.get(MessageInDB, body["results"][0]["id"]).text == "first"
+
+
+def test_create_messages_in_bulk_from_ndjson(client, session):
+    chat_id, headers = _seed_chat(session, 0)
+    lines = "\n".join(f'{{"chat_id": {chat_id}, "text": "line {i}"}}' for i in range(2500))
+
+    response = client.post("/chats/messages", headers={**headers, "Content-Type": "application/x-ndjson"}, content=lines)
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert len(results) == 2500
+    assert all(result["status"] == 201 for result in results)
+    session.expire_all()
+    assert session.get(ChatInDB, chat_id).message_count == 2500
+
+
+def test_export_chat_messages(client, session):
+    chat_id, headers = _seed_chat(session, 5)
+
+    response = client.get(f"/chats/{chat_id}/export", headers=headers)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["text"] for line in lines] == [f"msg {i}" for i in range(5)]
+    assert lines[0]["user"]["username"] == "ripley"
+
+    ndjson = response.content
+    response = client.get(f"/chats/{chat_id}/export", params={"format": "gzip"}, headers=headers)
+    assert response.status_code == 200
+    assert gzip.decompress(response.content) == ndjson
+
+
+def _rss() -> int:
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def _stream_export(session, count: int) -> tuple[int, int, int]:
+    """
+    Export a chat of `count` messages, reading the response the way a
+    client that drops what it received would.
+
+    :return: the messages exported, the body chunks they came in, and the
+        growth of the process's memory while streaming
+    """
+
+    chat_id, headers = _seed_chat(session, 0)
+    created_at = datetime(2024, 1, 1)
+    raw = session.connection().connection
+    raw.executemany(
+        "INSERT INTO messages (text, user_id, chat_id, created_at) VALUES (?, 1, ?, ?)",
+        ((f"synthetic message {i}", chat_id, created_at) for i in range(count)),
+    )
+    session.commit()
+
+    exported, chunks, peak = 0, 0, 0
+    baseline = _rss()
+
+    requested = False
+
+    async def receive():
+        nonlocal requested
+        if requested:
+            # the client stays connected until the response is done
+            await asyncio.Event().wait()
+        requested = True
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        nonlocal exported, chunks, peak
+        if message["type"] == "http.response.body":
+            # counted and dropped, a buffering client would hide the
+            # server's memory use behind its own
+            exported += message["body"].count(b"\n")
+            chunks += 1
+            peak = max(peak, _rss())
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+        "scheme": "http", "path": f"/chats/{chat_id}/export", "raw_path": b"", "query_string": b"",
+        "root_path": "", "server": ("test", 80), "client": ("test", 1234),
+        "headers": [(b"authorization", headers["Authorization"].encode())],
+    }
+    asyncio.run(app(scope, receive, send))
+    return exported, chunks, peak - baseline
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/statm"), reason="needs /proc to sample memory")
+def test_export_streams_in_chunks(client, session):
+    exported, chunks, _ = _stream_export(session, 5_000)
+    assert exported == 5_000
+    assert chunks > 1
+
+
+@pytest.mark.slow
+@pytest.mark.skipif(not os.path.exists("/proc/self/statm"), reason="needs /proc to sample memory")
+def test_export_memory_is_constant(client, session):
+    exported, _, growth = _stream_export(session, 1_000_000)
+    assert exported == 1_000_000
+    assert growth < 64 * 1024 * 1024
+
+
+def test_search_messages(client, session):
+    chat_id, headers = _seed_chat(session, 0)
+    other = ChatInDB(name="sulaco", owner=UserInDB(username="hicks", email="hicks@example.com", hashed_password="x"))
+    session.add(other)
+    session.commit()
+    for text in ["the alien is in the vents", "check the vents again", "mother is silent"]:
+        client.post(f"/chats/{chat_id}/messages", json={"text": text}, headers=headers)
+    session.add(MessageInDB(text="vents sealed", user_id=other.owner_id, chat_id=other.id))
+    session.commit()
+
+    response = client.get("/chats/messages/search", params={"q": "vents"}, headers=headers)
+    assert response.status_code == 200
+    hits = response.json()["hits"]
+    assert sorted(hit["message"]["text"] for hit in hits) == ["check the vents again", "the alien is in the vents"]
+    assert "<mark>vents</mark>" in hits[0]["snippet"]
+
+    response = client.get("/chats/messages/search", params={"q": "vents", "limit": 1}, headers=headers)
+    page = response.json()
+    assert page["meta"]["count"] == 1 and page["meta"]["next_cursor"]
+    response = client.get("/chats/messages/search", params={"q": "vents", "limit": 1, "cursor": page["meta"]["next_cursor"]}, headers=headers)
+    assert response.json()["hits"][0]["message"]["id"] != page["hits"][0]["message"]["id"]
+    assert response.json()["meta"]["next_cursor"] is None
+
+
+def test_search_index_follows_updates_and_deletes(client, session):
+    chat_id, headers = _seed_chat(session, 0)
+    message = client.post(f"/chats/{chat_id}/messages", json={"text": "self destruct"}, headers=headers).json()["message"]
+
+    client.put(f"/chats/{chat_id}/messages/{message['id']}", json={"text": "override"}, headers=headers)
+    search = lambda q: client.get("/chats/messages/search", params={"q": q}, headers=headers).json()["hits"]
+    assert search("destruct") == []
+    assert len(search("override")) == 1
+    client.delete(f"/chats/{chat_id}/messages/{message['id']}", headers=headers)
+    assert search("override") == []
+    # operators are taken as plain words
+    assert client.get("/chats/messages/search", params={"q": 'NEAR( "'}, headers=headers).status_code == 200
+
+
+def test_chat_reads_answer_conditional_gets(client, session):
+    chat_id, headers = _seed_chat(session, 3)
+
+    for url in ["/chats", f"/chats/{chat_id}?include=users", f"/chats/{chat_id}/messages", f"/chats/{chat_id}/users"]:
+        response = client.get(url, headers=headers)
+        assert response.status_code == 200
+        etag = response.headers["ETag"]
+        assert etag.startswith('W/"')
+
+        response = client.get(url, headers={**headers, "If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.content == b""
+
+        client.post(f"/chats/{chat_id}/messages", json={"text": "changed"}, headers=headers)
+        response = client.get(url, headers={**headers, "If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+
+
+def test_chat_etag_follows_renames_and_edits(client, session):
+    chat_id, headers = _seed_chat(session, 1)
+    etag = client.get(f"/chats/{chat_id}", headers=headers).headers["ETag"]
+
+    client.put(f"/chats/{chat_id}", json={"name": "narcissus"}, headers=headers)
+    renamed = client.get(f"/chats/{chat_id}", headers={**headers, "If-None-Match": etag})
+    assert renamed.status_code == 200
+
+    msg_id = client.get(f"/chats/{chat_id}/messages", headers=headers).json()["messages"][0]["id"]
+    client.put(f"/chats/{chat_id}/messages/{msg_id}", json={"text": "edited"}, headers=headers)
+    edited = client.get(f"/chats/{chat_id}", headers={**headers, "If-None-Match": renamed.headers["ETag"]})
+    assert edited.status_code == 200
+
+    client.put("/users/me", json={"username": "ellen"}, headers=headers)
+    response = client.get(f"/chats/{chat_id}", headers={**headers, "If-None-Match": edited.headers["ETag"]})
+    assert response.status_code == 200
+    assert response.json()["chat"]["owner"]["username"] == "ellen"
+
+
+def _add_reader(session, chat_id, username="hicks"):
+    reader = UserInDB(username=username, email=f"{username}@example.com", hashed_password="x")
+    chat = session.get(ChatInDB, chat_id)
+    chat.users.append(reader)
+    session.commit()
+    db.reconcile_chat_counters(session)
+    return {"Authorization": f"Bearer {_build_access_token(reader).access_token}"}
+
+
+def _unread(client, headers):
+    return {chat["id"]: chat["unread_count"] for chat in client.get("/chats", headers=headers).json()["chats"]}
+
+
+def test_read_cursor_tracks_unread_counts(client, session):
+    chat_id, author = _seed_chat(session, 6)
+    reader = _add_reader(session, chat_id)
+    msg_ids = [msg["id"] for msg in client.get(f"/chats/{chat_id}/messages", headers=reader).json()["messages"]]
+    assert _unread(client, reader) == {chat_id: 6}
+
+    response = client.put(f"/chats/{chat_id}/read", json={"message_id": msg_ids[3]}, headers=reader)
+    assert response.status_code == 200
+    assert response.json() == {"chat_id": chat_id, "last_read_message_id": msg_ids[3], "unread_count": 2}
+    # cursors do not move back
+    response = client.put(f"/chats/{chat_id}/read", json={"message_id": msg_ids[1]}, headers=reader)
+    assert response.json()["unread_count"] == 2
+
+    client.post(f"/chats/{chat_id}/messages", json={"text": "new"}, headers=author)
+    assert _unread(client, reader) == {chat_id: 3}
+    # the author has read everything up to their own message
+    assert _unread(client, author) == {chat_id: 0}
+    # deleting a read message and an unread one
+    client.delete(f"/chats/{chat_id}/messages/{msg_ids[0]}", headers=author)
+    client.delete(f"/chats/{chat_id}/messages/{msg_ids[5]}", headers=author)
+    assert _unread(client, reader) == {chat_id: 2}
+
+    response = client.put(f"/chats/{chat_id}/read", headers=reader)
+    assert response.json()["unread_count"] == 0
+    assert _unread(client, reader) == {chat_id: 0}
+
+    counts = [(link.user_id, link.read_count) for link in session.exec(select(UserChatLinkInDB)).all()]
+    db.reconcile_chat_counters(session)
+    session.expire_all()
+    assert [(link.user_id, link.read_count) for link in session.exec(select(UserChatLinkInDB)).all()] == counts
+
+
+def test_read_cursor_rejects_foreign_messages_and_outsiders(client, session):
+    chat_id, author = _seed_chat(session, 1)
+    owner = session.exec(select(UserInDB).where(UserInDB.username == "ripley")).one()
+    other_chat = _seed_crowded_chat(session, owner, "other", 1)
+    foreign = session.exec(select(MessageInDB).where(MessageInDB.chat_id == other_chat)).first()
+
+    response = client.put(f"/chats/{chat_id}/read", json={"message_id": foreign.id}, headers=author)
+    assert response.status_code == 404
+    assert response.json()["detail"]["detail"]["entity_name"] == "Message"
+    assert client.put(f"/chats/{chat_id + 100}/read", headers=author).status_code == 404
+
+    outsider = UserInDB(username="burke", email="burke@example.com", hashed_password="x")
+    session.add(outsider)
+    session.commit()
+    headers = {"Authorization": f"Bearer {_build_access_token(outsider).access_token}"}
+    assert client.put(f"/chats/{chat_id}/read", headers=headers).status_code == 403
+
+
+def test_backdated_import_counts_as_read_before_the_cursor(client, session):
+    chat_id, author = _seed_chat(session, 4)
+    reader = _add_reader(session, chat_id)
+    client.put(f"/chats/{chat_id}/read", headers=reader)
+
+    messages = [
+        {"chat_id": chat_id, "text": "replayed", "created_at": "2023-06-01T00:00:00"},
+        {"chat_id": chat_id, "text": "live"},
+    ]
+    response = client.post("/chats/messages", json=messages, headers=author)
+    assert response.status_code == 200
+    assert _unread(client, reader) == {chat_id: 1}
+
+
+def test_listing_chats_with_unread_counts_takes_constant_queries(client, session, query_count):
+    _, headers = _seed_chat(session, 0)
+    owner = session.exec(select(UserInDB).where(UserInDB.username == "ripley")).one()
+    _seed_crowded_chat(session, owner, "first", 3)
+    client.get("/chats", headers=headers)
+
+    counts = []
+    for name in ("second", "third"):
+        owner = session.exec(select(UserInDB).where(UserInDB.username == "ripley")).one()
+        for i in range(20):
+            _seed_crowded_chat(session, owner, f"{name}-{i}", 2)
+        session.expunge_all()
+        query_count.clear()
+        response = client.get("/chats", headers=headers)
+        assert response.status_code == 200
+        counts.append(len(query_count))
+    assert counts[0] == counts[1]
+    assert len(response.json()["chats"]) == 42
+    assert {chat["unread_count"] for chat in response.json()["chats"]} >= {2}
+
+
+def test_chats_by_activity_with_last_messages(client, session, query_count):
+    _, headers = _seed_chat(session, 0)
+    owner = session.exec(select(UserInDB).where(UserInDB.username == "ripley")).one()
+    chat_ids = [_seed_crowded_chat(session, owner, f"chat {i}", 1) for i in range(5)]
+    empty = ChatInDB(name="empty", owner=owner, users=[owner])
+    session.add(empty)
+    session.commit()
+    # the oldest chat becomes the most recently active
+    client.post(f"/chats/{chat_ids[0]}/messages", json={"text": "latest"}, headers=headers)
+    expected = [chat_ids[0], *reversed(chat_ids[1:]), empty.id]
+
+    seen, cursor = [], None
+    while True:
+        params = {"order": "activity", "limit": 2}
+        if cursor is not None:
+            params["cursor"] = cursor
+        session.expunge_all()
+        query_count.clear()
+        response = client.get("/chats", params=params, headers=headers)
+        assert response.status_code == 200
+        page = response.json()
+        seen.extend(chat["id"] for chat in page["chats"])
+        # the ETag check and the page itself
+        assert len(query_count) == 2, query_count
+        cursor = page["meta"]["next_cursor"]
+        if cursor is None:
+            break
+    assert seen[:-1] == expected
+    # the chat seeded without messages has no activity either
+    assert len(seen) == len(expected) + 1
+
+    chats = {chat["id"]: chat for chat in client.get("/chats", params={"order": "activity"}, headers=headers).json()["chats"]}
+    assert chats[chat_ids[0]]["last_message"]["text"] == "latest"
+    assert chats[chat_ids[0]]["last_message"]["user"]["username"] == "ripley"
+    assert chats[chat_ids[1]]["last_message"]["text"] == "hi from chat 1-0"
+    assert chats[empty.id]["last_message"] is None
+
+
+def test_last_message_follows_deletes_and_imports(client, session):
+    chat_id, headers = _seed_chat(session, 3)
+    msg_ids = [msg["id"] for msg in client.get(f"/chats/{chat_id}/messages", headers=headers).json()["messages"]]
+
+    def last_text():
+        return client.get("/chats", headers=headers).json()["chats"][0]["last_message"]["text"]
+
+    assert last_text() == "msg 2"
+    client.delete(f"/chats/{chat_id}/messages/{msg_ids[2]}", headers=headers)
+    assert last_text() == "msg 1"
+    messages = [{"chat_id": chat_id, "text": "imported"}, {"chat_id": chat_id, "text": "replayed", "created_at": "2023-01-01T00:00:00"}]
+    client.post("/chats/messages", json=messages, headers=headers)
+    assert last_text() == "imported"
+
+
+def test_chats_reject_cursor_of_another_order(client, session):
+    _, headers = _seed_chat(session, 1)
+    owner = session.exec(select(UserInDB).where(UserInDB.username == "ripley")).one()
+    _seed_crowded_chat(session, owner, "other", 1)
+    cursor = client.get("/chats", params={"limit": 1}, headers=headers).json()["meta"]["next_cursor"]
+    assert cursor is not None
+
+    response = client.get("/chats", params={"order": "activity", "cursor": cursor}, headers=headers)
+    assert response.status_code == 422
+    assert response.json()["detail"]["type"] == "invalid_cursor"
@@ -1,7 +1,8 @@
 from fastapi.testclient import TestClient
-from backend.entities import ChatCollection, User, UserCollection
+from backend.entities import ChatCollection, User, UserCollection, UserInDB, UserPage
 
 from backend.main import app
+from tests.conftests import client, session  # noqa: F401
 
 
 def test_get_all_users():
@@ -63,3 +64,52 @@ def test_get_invalid_user_chats():
     client = TestClient(app)
     response = client.get("/users/jtere3443d/chats")
     assert response.status_code == 404
+
+
+def _seed_users(session, usernames):
+    session.add_all(UserInDB(username=name, email=f"{name}@example.com", hashed_password="x") for name in usernames)
+    session.commit()
+
+
+def test_get_users_pages_by_id(client, session):
+    _seed_users(session, [f"user{i:02}" for i in range(25)])
+
+    seen, cursor = [], None
+    while True:
+        params = {"limit": 10} if cursor is None else {"limit": 10, "cursor": cursor}
+        response = client.get("/users", params=params)
+        assert response.status_code == 200
+        page = UserPage(**response.json())
+        assert page.meta.count == 25
+        seen.extend(user.id for user in page.users)
+        cursor = page.meta.next_cursor
+        if cursor is None:
+            break
+    assert seen == list(range(1, 26))
+
+
+def test_get_users_by_username_prefix(client, session):
+    _seed_users(session, ["bishop", "bishopp", "bisho", "ripley", "ash"])
+
+    response = client.get("/users", params={"username": "bishop"})
+    assert response.status_code == 200
+    page = UserPage(**response.json())
+    assert [user.username for user in page.users] == ["bishop", "bishopp"]
+    assert page.meta.count == 2
+    assert page.meta.next_cursor is None
+
+
+def test_get_users_rejects_bad_cursor_and_limit(client):
+    response = client.get("/users", params={"cursor": "not a cursor"})
+    assert response.status_code == 422
+    assert response.json()["detail"]["type"] == "invalid_cursor"
+    assert client.get("/users", params={"limit": 100_000}).status_code == 422
+
+
+def test_user_count_is_refreshed_by_registration(client, session):
+    _seed_users(session, ["ripley"])
+    assert client.get("/users").json()["meta"]["count"] == 1
+
+    response = client.post("/auth/registration", json={"username": "bishop", "email": "bishop@example.com", "password": "pw"})
+    assert response.status_code == 201
+    assert client.get("/users").json()["meta"]["count"] == 2
@@ -1,29 +1,45 @@
 import pytest
 from fastapi.testclient import TestClient
-from sqlmodel import Session, SQLModel, StaticPool, create_engine
+from sqlmodel import Session, SQLModel, create_engine
 
 from backend.main import app
 from backend import database as db
 
 
 @pytest.fixture
-def session():
-    engine = create_engine(
-        "sqlite://",
-        connect_args={"check_same_thread": False},
-        poolclass=StaticPool,
-    )
+def session(tmp_path):
+    # a file, so that the read-only engine of the read routes can open the
+    # same database
+    url = f"sqlite:///{tmp_path / 'pony_express.db'}"
+    engine = create_engine(url, connect_args={"check_same_thread": False})
+    read_engine = create_engine(url, connect_args={"check_same_thread": False})
+    db.apply_sqlite_profile(engine)
+    db.apply_sqlite_profile(read_engine, read_only=True)
     SQLModel.metadata.create_all(engine)
-    with Session(engine) as session:
+    # process-wide caches would otherwise leak ids between test databases
+    db.membership_cache.clear()
+    db.user_cache.clear()
+    db.user_count_cache.clear()
+    with Session(engine, info={"read_engine": read_engine}) as session:
         yield session
+    engine.dispose()
+    read_engine.dispose()
 
 
 @pytest.fixture
-def client(session):
+def client(session, monkeypatch):
     def _get_session_override():
         return session
 
+    def _get_read_session_override():
+        with Session(session.info["read_engine"]) as read_session:
+            yield read_session
+
     app.dependency_overrides[db.get_session] = _get_session_override
+    app.dependency_overrides[db.get_read_session] = _get_read_session_override
+    # for the routes that open short sessions of their own
+    monkeypatch.setattr(db, "engine", session.get_bind())
+    monkeypatch.setattr(db, "read_engine", session.info["read_engine"])
 
     yield TestClient(app)
 